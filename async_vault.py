@@ -0,0 +1,79 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from profiles import Profile
+from search_index import DEFAULT_LIMIT
+from vault import DEFAULT_PAGE_SIZE, Vault, WrongPasswordError
+
+# Threads running vault calls. Key derivation, Fernet and SQLite all release the GIL,
+# so a few threads keep the event loop free without a process pool
+DEFAULT_THREADS = 4
+
+
+def decrypted(profile):
+    # Copy of a profile with every field already decrypted. Vault reads return profiles that decrypt on first use,
+    # they are decrypted here on the pool thread, so the event loop never runs Fernet
+    return None if profile is None else Profile.from_values(profile.id, list(profile))
+
+
+class AsyncVault:
+    # asyncio front end for Vault. Every call runs on a thread pool, the event loop only awaits the result.
+    # The wrapped Vault is opened in concurrent mode, so calls from different threads may overlap
+    def __init__(self, name, password, threads=DEFAULT_THREADS, **vault_options):
+        self.vault = Vault(name, password, concurrent=True, **vault_options)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='vault')
+
+    async def run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def open_vault(self):
+        return await self.run(self.vault.open_vault)
+
+    async def create_vault(self, kdf_params=None):
+        return await self.run(self.vault.create_vault, kdf_params)
+
+    async def get_profile(self, profile_name):
+        return await self.run(lambda: decrypted(self.vault.get_profile(profile_name)))
+
+    async def add_new_profile(self, profile_name, password, username=None, link=None):
+        return await self.run(self.vault.add_new_profile, profile_name, password, username, link)
+
+    async def update_profile(self, profile_name, username, password, link):
+        return await self.run(self.vault.update_profile, profile_name, username, password, link)
+
+    async def delete_profile(self, profile_name):
+        return await self.run(self.vault.delete_profile, profile_name)
+
+    async def get_vault_content(self):
+        return await self.run(lambda: [decrypted(profile) for profile in self.vault.get_vault_content()])
+
+    async def search(self, query, limit=DEFAULT_LIMIT):
+        return await self.run(self.vault.search, query, limit)
+
+    async def iter_vault_content(self, page_size=DEFAULT_PAGE_SIZE):
+        # "async for profile in vault.iter_vault_content()" - one page is read and decrypted at a time
+        after_id = 0
+        while after_id is not None:
+            profiles, after_id = await self.run(self.get_decrypted_page, after_id, page_size)
+            for profile in profiles:
+                yield profile
+
+    def get_decrypted_page(self, after_id, page_size):
+        profiles, next_after_id = self.vault.get_vault_page(after_id, page_size)
+        return [decrypted(profile) for profile in profiles], next_after_id
+
+    async def close_vault(self):
+        # Also stops the thread pool, the AsyncVault can not be opened again
+        await self.run(self.vault.close_vault)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        if self.vault.connection is None and not await self.open_vault():
+            await self.close_vault()
+            raise WrongPasswordError(f'Wrong master password for "{self.vault.vault_name}"')
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_vault()
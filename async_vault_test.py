@@ -0,0 +1,73 @@
+import asyncio
+import time
+import unittest
+
+from async_vault import AsyncVault
+from profiles import NOT_DECRYPTED
+from vault import WrongPasswordError
+from vault_test import VaultDirTestCase
+
+# Longest pause of the event loop allowed while a vault is unlocked next to it
+MAX_LOOP_STALL = 0.1
+
+
+class TestAsyncVault(VaultDirTestCase, unittest.IsolatedAsyncioTestCase):
+    async def test_loop_stays_responsive_during_unlock(self):
+        # The fixture vault uses the legacy 600000 PBKDF2 iterations, a few hundred milliseconds to derive
+        vault = AsyncVault('test', '123', use_agent=False)
+        stalls = []
+        unlocked = asyncio.Event()
+
+        async def heartbeat():
+            last = time.perf_counter()
+            while not unlocked.is_set():
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                stalls.append(now - last)
+                last = now
+
+        beats = asyncio.create_task(heartbeat())
+        start = time.perf_counter()
+        self.assertTrue(await vault.open_vault())
+        unlock_time = time.perf_counter() - start
+        unlocked.set()
+        await beats
+
+        self.assertLess(max(stalls), MAX_LOOP_STALL)
+        # The heartbeat kept running for the whole unlock, not only after it
+        self.assertGreater(len(stalls), unlock_time / MAX_LOOP_STALL)
+        await vault.close_vault()
+
+    async def test_profile_operations(self):
+        async with AsyncVault('test', '123', use_agent=False) as vault:
+            self.assertEqual((await vault.get_profile('vk'))[0], 'vk')
+            await vault.add_new_profile('github', 'pw', 'user')
+            await vault.update_profile('github', 'user', 'changed', None)
+            self.assertEqual(await vault.get_profile('github'), ['github', 'user', 'changed', None])
+            await vault.delete_profile('github')
+            self.assertEqual(await vault.get_profile('github'), None)
+
+            content = await vault.get_vault_content()
+            pages = [profile async for profile in vault.iter_vault_content(page_size=2)]
+            self.assertEqual(pages, content)
+
+            # Profiles arrive decrypted, using them never runs Fernet on the event loop
+            for profile in [await vault.get_profile('vk')] + content + pages:
+                self.assertIsNone(profile.cipher)
+                self.assertNotIn(NOT_DECRYPTED, profile.values)
+
+    async def test_concurrent_calls(self):
+        async with AsyncVault('test', '123', use_agent=False) as vault:
+            names = [f'profile-{index}' for index in range(20)]
+            await asyncio.gather(*(vault.add_new_profile(name, name) for name in names))
+            profiles = await asyncio.gather(*(vault.get_profile(name) for name in names))
+            self.assertEqual([profile[2] for profile in profiles], names)
+
+    async def test_wrong_password(self):
+        with self.assertRaises(WrongPasswordError):
+            async with AsyncVault('test', 'qwerty', use_agent=False):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
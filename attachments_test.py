@@ -0,0 +1,107 @@
+import io
+import os
+import unittest
+
+from data_encryption import new_kdf_params
+from main_test import run_main
+from vault import AttachmentError, Vault
+from vault_test import VaultDirTestCase
+
+
+class TestAttachments(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vault = Vault('test', '123', use_agent=False)
+        self.vault.open_vault()
+        self.content = os.urandom(10000)
+
+    def read(self, attachment_id):
+        return b''.join(self.vault.iter_attachment(attachment_id))
+
+    def test_round_trip(self):
+        attachment_id = self.vault.add_attachment('gmail', 'id_ed25519', io.BytesIO(self.content), chunk_size=1024)
+        empty_id = self.vault.add_attachment('gmail', 'empty.txt', io.BytesIO(b''))
+        exact_id = self.vault.add_attachment('vk', 'exact.bin', io.BytesIO(self.content[:2048]), chunk_size=1024)
+
+        self.assertEqual(self.read(attachment_id), self.content)
+        self.assertEqual(len(list(self.vault.iter_attachment(attachment_id))), 10)
+        self.assertEqual(self.read(empty_id), b'')
+        self.assertEqual(self.read(exact_id), self.content[:2048])
+        self.assertEqual(self.vault.list_attachments('gmail'), [(attachment_id, 'id_ed25519', 10000),
+                                                                (empty_id, 'empty.txt', 0)])
+        self.assertEqual(self.vault.list_attachments('missing'), None)
+        self.assertEqual(self.vault.add_attachment('missing', 'file', io.BytesIO(b'data')), None)
+
+        # Names and contents are never stored in the clear
+        stored = b''.join(row[0] for row in self.vault.connection.execute('SELECT data FROM attachment_chunks'))
+        self.assertNotIn(self.content[:64], stored)
+
+        self.vault.delete_attachment(exact_id)
+        with self.assertRaises(AttachmentError):
+            self.read(exact_id)
+        self.vault.delete_profile('gmail')
+        self.assertEqual(self.vault.connection.execute('SELECT COUNT(*) FROM attachment_chunks').fetchone()[0], 0)
+
+    def test_tampering(self):
+        attachment_id = self.vault.add_attachment('gmail', 'key', io.BytesIO(self.content), chunk_size=1024)
+        with self.vault.transaction() as cursor:
+            # Swap two chunks
+            cursor.execute('UPDATE attachment_chunks SET chunk_index = -1 WHERE chunk_index = 0')
+            cursor.execute('UPDATE attachment_chunks SET chunk_index = 0 WHERE chunk_index = 1')
+            cursor.execute('UPDATE attachment_chunks SET chunk_index = 1 WHERE chunk_index = -1')
+        with self.assertRaises(AttachmentError):
+            self.read(attachment_id)
+
+        other_id = self.vault.add_attachment('vk', 'key', io.BytesIO(self.content), chunk_size=1024)
+        with self.vault.transaction() as cursor:
+            # Cut the last chunk off
+            cursor.execute('DELETE FROM attachment_chunks WHERE attachment_id = ? AND chunk_index = 9', (other_id,))
+            cursor.execute('UPDATE attachments SET chunk_count = 9 WHERE id = ?', (other_id,))
+        with self.assertRaises(AttachmentError):
+            self.read(other_id)
+
+    def test_rekey_keeps_attachments(self):
+        attachment_id = self.vault.add_attachment('gmail', 'key', io.BytesIO(self.content), chunk_size=4096)
+        self.vault.change_kdf(new_kdf_params('pbkdf2', iterations=1000))
+        self.assertEqual(self.read(attachment_id), self.content)
+        self.assertEqual(self.vault.list_attachments('gmail')[0][1], 'key')
+
+    def test_snapshot_mode(self):
+        # Attachments are never copied into memory: a snapshot session falls back to the file
+        with Vault('test', '123', use_agent=False, snapshot=True) as vault:
+            self.assertTrue(vault.snapshot)
+            attachment_id = vault.add_attachment('gmail', 'key', io.BytesIO(self.content), chunk_size=1024)
+            self.assertFalse(vault.snapshot)
+            self.assertNotEqual(vault.connection.execute('PRAGMA database_list').fetchone()[2], '')
+            self.assertEqual(b''.join(vault.iter_attachment(attachment_id)), self.content)
+            vault.add_new_profile('github', 'pw')
+
+        with Vault('test', '123', use_agent=False, snapshot=True) as vault:
+            self.assertFalse(vault.snapshot)
+            self.assertEqual(vault.get_profile('github').password, 'pw')
+
+    def test_attachment_added_during_snapshot_session(self):
+        with Vault('emptyvault', 'qwerty', use_agent=False, snapshot=True) as vault:
+            vault.add_new_profile('github', 'pw')
+            with Vault('emptyvault', 'qwerty', use_agent=False) as other:
+                other.add_attachment('github', 'key', io.BytesIO(self.content))
+            self.assertEqual(vault.list_attachments('github')[0][1:], ('key', 10000))
+            self.assertFalse(vault.snapshot)
+
+    def test_commands(self):
+        with open('cert.pem', 'wb') as file:
+            file.write(self.content)
+        self.assertEqual(run_main('attach', 'vk', 'cert.pem', '-v', 'test').stdout, '1\n')
+        self.assertEqual(run_main('attachments', 'vk', '-v', 'test').stdout, '1\tcert.pem\t10000\n')
+        self.assertEqual(run_main('fetch', '1', '-v', 'test', '-o', 'copy.pem').returncode, 0)
+        with open('copy.pem', 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(run_main('fetch', '2', '-v', 'test').returncode, 1)
+
+    def tearDown(self):
+        self.vault.close_vault()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import math
+from collections import namedtuple
+
+from data_encryption import AUDIT_PURPOSE, blind_index, derive_subkey
+from password_generator import CHARACTER_CLASSES
+
+# Password reuse and strength audit of a vault in one pass over its profiles.
+#
+# Profiles are streamed page by page, and a plaintext password lives only while its profile is looked at.
+# Reuse is found through keyed digests of the passwords (HMAC under a subkey of the vault key), so what
+# is kept in memory is a digest and a name per profile, never a password. Only the name and the password
+# of a profile are read: legacy rows decrypt just these two fields, a packed record (every row written since
+# schema version 3 or converted by compact) is decrypted as a whole, its username and link included
+
+# Disjoint classes a password is scored against. 'letters' is left out: it is lower and upper together
+SCORED_CLASSES = tuple(CHARACTER_CLASSES[name] for name in ('lower', 'upper', 'digits', 'special'))
+# Characters outside every class (spaces, non-ASCII) count as one more class of this size
+OTHER_CLASS_SIZE = len(CHARACTER_CLASSES['special'])
+# Passwords with a lower estimate are reported as weak
+DEFAULT_MIN_BITS = 60
+
+# reused - lists of the names of the profiles that share a password, each list sorted
+# weak - names of the profiles with a weak password
+# profiles - number of profiles audited
+AuditReport = namedtuple('AuditReport', ['reused', 'weak', 'profiles'])
+
+
+def password_bits(password):
+    # Upper bound of the entropy of password: its length times the bits per character of a random password
+    # over the classes it uses. A password is never stronger than a random one with the same classes
+    pool_size = 0
+    remaining = set(password)
+    for characters in SCORED_CLASSES:
+        if not remaining.isdisjoint(characters):
+            pool_size += len(characters)
+            remaining.difference_update(characters)
+    if remaining:
+        pool_size += OTHER_CLASS_SIZE
+    return len(password) * math.log2(pool_size) if pool_size else 0.0
+
+
+def audit_vault(vault, min_bits=DEFAULT_MIN_BITS):
+    # Audit an opened vault. Returns an AuditReport
+    digest_key = derive_subkey(vault.key, AUDIT_PURPOSE)
+    names_by_digest = {}
+    weak = []
+    profiles = 0
+    for profile in vault.iter_vault_content():
+        profiles += 1
+        password = profile.password or ''
+        if password_bits(password) < min_bits:
+            weak.append(profile.name)
+
+        digest = blind_index(password, digest_key)
+        names = names_by_digest.get(digest)
+        if names is None:
+            # Most passwords are unique, a bare name costs less than a list
+            names_by_digest[digest] = profile.name
+        elif isinstance(names, list):
+            names.append(profile.name)
+        else:
+            names_by_digest[digest] = [names, profile.name]
+
+    reused = sorted(sorted(names) for names in names_by_digest.values() if isinstance(names, list))
+    return AuditReport(reused, sorted(weak), profiles)
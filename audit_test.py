@@ -0,0 +1,52 @@
+import unittest
+
+from audit import audit_vault, password_bits
+from main_test import run_main
+from vault import Vault
+from vault_test import VaultDirTestCase
+
+
+class TestAudit(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vault = Vault('test', '123', use_agent=False)
+        self.vault.open_vault()
+
+    def test_password_bits(self):
+        self.assertEqual(password_bits(''), 0.0)
+        self.assertAlmostEqual(password_bits('aaaa'), 4 * 4.70, places=2)
+        self.assertAlmostEqual(password_bits('qwerty123'), 9 * 5.17, places=2)
+        # Classes only count when used, and anything outside them counts once
+        self.assertGreater(password_bits('aA1!'), password_bits('aA1a'))
+        self.assertEqual(password_bits('пароль'), password_bits('ключик'))
+
+    def test_audit(self):
+        # The fixture has one weak password and no reuse
+        report = audit_vault(self.vault)
+        self.assertEqual(report, ([], ['vk'], 5))
+        self.assertEqual(audit_vault(self.vault, min_bits=70).weak, ['ozon', 'vk'])
+
+        self.vault.add_new_profile('github', 'qwerty123')
+        self.vault.add_new_profile('gitlab', '6"T[~$v!vJf`<g/ea;0)bz')
+        self.vault.add_new_profile('bitbucket', 'qwerty123')
+        report = audit_vault(self.vault, min_bits=40)
+        self.assertEqual(report.reused, [['bitbucket', 'github', 'vk'], ['gitlab', 'gmail']])
+        self.assertEqual(report.weak, [])
+        self.assertEqual(report.profiles, 8)
+
+    def test_audit_command(self):
+        self.vault.add_new_profile('github', 'securepassword')
+        result = run_main('audit', '-v', 'test')
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout, '1 reused passwords\n  github, ozon\n'
+                                        '1 weak passwords (below 60 bits)\n  vk\n'
+                                        '6 profiles audited\n')
+        self.assertNotIn('securepassword', result.stdout)
+
+    def tearDown(self):
+        self.vault.close_vault()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
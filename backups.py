@@ -0,0 +1,212 @@
+import base64
+import json
+import os
+import struct
+import zlib
+
+import cryptography
+
+from data_encryption import BACKUP_PURPOSE, Fernet, derive_key, derive_subkey
+from vault import Vault, WrongPasswordError
+
+# Incremental encrypted backups built on the change log of a vault.
+#
+# A delta holds the current state of every profile changed after from_seq, up to to_seq, as stored in the
+# vault (ciphertext), and the ids of the profiles deleted in that range. A delta since seq 0 is a full backup.
+# Restoring replays a chain of deltas, each starting where the previous one ended, into a vault file.
+#
+# File layout: a magic line, a JSON header line and a Fernet token under a key derived from the vault key.
+# The token holds the zlib-compressed header line again (so the header is authenticated) and the entries.
+# The header is readable without the password, because the KDF parameters are needed to derive the key
+
+DELTA_MAGIC = b'BASEDPASS-DELTA 1\n'
+# Stored columns of a profile in a delta entry
+DELTA_COLUMNS = ('record', 'name', 'username', 'password', 'link', 'name_index')
+UPSERT_ENTRY = b'U'
+DELETE_ENTRY = b'D'
+# Length prefix of a column that is NULL
+NULL_LENGTH = 0xFFFFFFFF
+# Changed profiles read from the vault at once
+EXPORT_PAGE_SIZE = 1000
+
+
+class DeltaError(Exception):
+    pass
+
+
+def pack_columns(values):
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(struct.pack('>I', NULL_LENGTH))
+        else:
+            data = value.encode() if isinstance(value, str) else value
+            parts.append(struct.pack('>I', len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_columns(data, position, count):
+    # Returns the columns and the position after them
+    values = []
+    for _ in range(count):
+        length, = struct.unpack_from('>I', data, position)
+        position += 4
+        if length == NULL_LENGTH:
+            values.append(None)
+        else:
+            values.append(data[position:position + length])
+            position += length
+    return values, position
+
+
+def backup_fernet(key):
+    return Fernet(base64.urlsafe_b64encode(derive_subkey(key, BACKUP_PURPOSE)))
+
+
+def last_change_seq(vault):
+    return vault.read('SELECT IFNULL(MAX(seq), 0) FROM changes').fetchone()[0]
+
+
+def iter_changes(vault, from_seq, to_seq):
+    # (profile id, stored columns or None for a deleted profile) for every profile changed in the range,
+    # each profile once with its current state
+    after_id = 0
+    while True:
+        rows = vault.read(
+            'SELECT changed.profile_id, vault.id, vault.record, vault.name, vault.username, vault.password, '
+            'vault.link, vault.name_index FROM (SELECT DISTINCT profile_id FROM changes '
+            'WHERE seq > ? AND seq <= ? AND profile_id > ? ORDER BY profile_id LIMIT ?) AS changed '
+            'LEFT JOIN vault ON vault.id = changed.profile_id ORDER BY changed.profile_id',
+            (from_seq, to_seq, after_id, EXPORT_PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+
+        for row in rows:
+            yield row[0], None if row[1] is None else row[2:]
+        after_id = rows[-1][0]
+
+
+def export_delta(vault, path, since_seq=0):
+    # Write the changes of an opened vault after since_seq to path.
+    # Returns the seq to pass as since_seq next time and the number of changed profiles
+    to_seq = last_change_seq(vault)
+    if since_seq > to_seq:
+        raise DeltaError(f'Sequence {since_seq} is ahead of the change log of "{vault.vault_name}" ({to_seq})')
+
+    plain_text, encrypted_text = vault.read(
+        'SELECT plain_text, encrypted_text FROM validation WHERE id = ?', (vault.validation_row_id,)).fetchone()
+    encrypted_text = encrypted_text.decode() if isinstance(encrypted_text, bytes) else encrypted_text
+    header = json.dumps({'vault': vault.vault_name, 'kdf': vault.kdf_params, 'from_seq': since_seq,
+                         'to_seq': to_seq, 'validation': [plain_text, encrypted_text]}).encode() + b'\n'
+
+    compressor = zlib.compressobj()
+    body = [compressor.compress(header)]
+    changed = 0
+    for profile_id, columns in iter_changes(vault, since_seq, to_seq):
+        if columns is None:
+            entry = DELETE_ENTRY + struct.pack('>q', profile_id)
+        else:
+            entry = UPSERT_ENTRY + struct.pack('>q', profile_id) + pack_columns(columns)
+        body.append(compressor.compress(entry))
+        changed += 1
+    body.append(compressor.flush())
+
+    token = backup_fernet(vault.key).encrypt(b''.join(body))
+    # Written next to the target first, so an interrupted export never leaves a truncated delta behind
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(DELTA_MAGIC)
+        file.write(header)
+        file.write(token)
+    os.replace(temp_path, path)
+    return to_seq, changed
+
+
+def read_delta(path, password, keys=None):
+    # Returns the header and the entries: [(entry type, profile id, stored columns or None)].
+    # keys caches derived keys by KDF parameters between the deltas of a chain
+    with open(path, 'rb') as file:
+        if file.readline() != DELTA_MAGIC:
+            raise DeltaError(f'"{path}" is not a basedpass delta')
+        header_line = file.readline()
+        token = file.read()
+    header = json.loads(header_line)
+
+    kdf_id = json.dumps(header['kdf'], sort_keys=True)
+    key = keys.get(kdf_id) if keys is not None else None
+    if key is None:
+        key = derive_key(password, header['kdf'])
+        if keys is not None:
+            keys[kdf_id] = key
+
+    try:
+        body = zlib.decompress(backup_fernet(key).decrypt(token))
+    except cryptography.fernet.InvalidToken:
+        raise WrongPasswordError(f'Wrong master password for "{path}" or the file is damaged')
+    if not body.startswith(header_line):
+        raise DeltaError(f'The header of "{path}" has been modified')
+
+    entries = []
+    position = len(header_line)
+    while position < len(body):
+        entry_type = body[position:position + 1]
+        profile_id, = struct.unpack_from('>q', body, position + 1)
+        position += 9
+        columns = None
+        if entry_type == UPSERT_ENTRY:
+            columns, position = unpack_columns(body, position, len(DELTA_COLUMNS))
+        entries.append((entry_type, profile_id, columns))
+    return header, entries
+
+
+def apply_delta(vault, header, entries):
+    # Replay one delta into an opened vault. Deletes go first, so a name freed in the range can be reused
+    with vault.transaction() as cursor:
+        found = cursor.execute("SELECT value FROM meta WHERE key = 'restored_seq'").fetchone()
+        if found is None and cursor.execute('SELECT EXISTS (SELECT 1 FROM vault) OR EXISTS (SELECT 1 FROM changes)'
+                                            ).fetchone()[0]:
+            # Replaying by id would overwrite the profiles and the password of a vault with data of its own
+            raise DeltaError(f'"{vault.vault_name}" already holds data that was not restored from deltas. '
+                             'Restore into a new vault')
+        restored_seq = int(found[0]) if found is not None else 0
+        if header['from_seq'] != restored_seq:
+            raise DeltaError(f'The delta starts at sequence {header["from_seq"]}, '
+                             f'but "{vault.vault_name}" has been restored up to {restored_seq}')
+
+        deleted = [(profile_id,) for entry_type, profile_id, _ in entries if entry_type == DELETE_ENTRY]
+        cursor.executemany('DELETE FROM vault WHERE id = ?', deleted)
+        cursor.executemany(f'INSERT OR REPLACE INTO vault (id, {", ".join(DELTA_COLUMNS)}) '
+                           f'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(profile_id, *columns) for entry_type, profile_id, columns in entries
+                            if entry_type == UPSERT_ENTRY])
+        cursor.executemany('INSERT INTO changes (profile_id) VALUES (?)',
+                           [(profile_id,) for _, profile_id, _ in entries])
+
+        # The key changes with the master password or the KDF parameters
+        plain_text, encrypted_text = header['validation']
+        cursor.execute('UPDATE validation SET plain_text = ?, encrypted_text = ? WHERE id = ?',
+                       (plain_text, encrypted_text.encode(), vault.validation_row_id))
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('kdf', ?)", (json.dumps(header['kdf']),))
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('restored_seq', ?)", (str(header['to_seq']),))
+
+
+def restore_deltas(vault_name, password, paths, vaults_dir=None):
+    # Replay the deltas in paths, in order, into the vault vault_name. The vault is created from the first
+    # delta when it does not exist. Returns the seq the vault has been restored up to
+    vault = Vault(vault_name, password, use_agent=False, vaults_dir=vaults_dir)
+    keys = {}
+    to_seq = None
+    try:
+        for path in paths:
+            header, entries = read_delta(path, password, keys)
+            if vault.connection is None:
+                if not os.path.exists(vault.vault_path()):
+                    vault.create_vault(header['kdf'])
+                elif not vault.open_vault():
+                    raise WrongPasswordError(f'Wrong master password for "{vault_name}"')
+            apply_delta(vault, header, entries)
+            to_seq = header['to_seq']
+    finally:
+        vault.close_vault()
+    return to_seq
@@ -0,0 +1,125 @@
+import os
+import unittest
+
+from backups import DELTA_MAGIC, DeltaError, export_delta, read_delta, restore_deltas
+from data_encryption import new_kdf_params
+from main_test import run_main
+from vault import Vault, WrongPasswordError
+from vault_test import VaultDirTestCase
+
+
+class TestBackups(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vault = Vault('test', '123', use_agent=False)
+        self.vault.open_vault()
+
+    def restored_content(self, name='restored', password='123'):
+        with Vault(name, password, use_agent=False) as vault:
+            return [list(profile) for profile in vault.get_vault_content()]
+
+    def test_change_log(self):
+        # The migration logs every existing profile, each change appends one row.
+        # Id 6 was used by a profile deleted from the fixture
+        self.assertEqual(self.vault.connection.execute('SELECT COUNT(*) FROM changes').fetchone()[0], 5)
+        self.vault.add_new_profile('github', 'pw')
+        self.vault.update_profile('github', None, 'changed', None)
+        self.vault.delete_profile('github')
+        self.vault.add_profiles_bulk([('gitlab', None, 'pw', None), ('bitbucket', None, 'pw', None)])
+        self.vault.add_new_profile('vk', 'duplicate')
+        self.assertEqual(self.vault.connection.execute('SELECT seq, profile_id FROM changes WHERE seq > 5').fetchall(),
+                         [(6, 7), (7, 7), (8, 7), (9, 8), (10, 9)])
+
+    def test_incremental_chain(self):
+        full_seq, changed = export_delta(self.vault, 'full.delta')
+        self.assertEqual((full_seq, changed), (5, 5))
+
+        self.vault.add_new_profile('github', 'pw', link='github.com')
+        self.vault.update_profile('vk', 'newbox@yandex.ru', 'changed', 'vk.com')
+        self.vault.delete_profile('ozon')
+        delta_seq, changed = export_delta(self.vault, 'first.delta', full_seq)
+        self.assertEqual((delta_seq, changed), (8, 3))
+
+        # Deleted and added back under the same name within one delta
+        self.vault.delete_profile('github')
+        self.vault.add_new_profile('github', 'new')
+        last_seq, changed = export_delta(self.vault, 'second.delta', delta_seq)
+        self.assertEqual(changed, 2)
+        empty_seq, changed = export_delta(self.vault, 'empty.delta', last_seq)
+        self.assertEqual((empty_seq, changed), (last_seq, 0))
+        # Only the changed profiles are written
+        self.assertLess(os.path.getsize('second.delta'), os.path.getsize('full.delta'))
+
+        deltas = ['full.delta', 'first.delta', 'second.delta', 'empty.delta']
+        self.assertEqual(restore_deltas('restored', '123', deltas), last_seq)
+        expected = [list(profile) for profile in self.vault.get_vault_content()]
+        self.assertEqual(self.restored_content(), expected)
+
+        # A restored vault can be extended with later deltas only
+        self.vault.add_new_profile('later', 'pw')
+        export_delta(self.vault, 'later.delta', last_seq)
+        with self.assertRaises(DeltaError):
+            restore_deltas('restored', '123', ['first.delta'])
+        restore_deltas('restored', '123', ['later.delta'])
+        self.assertEqual(self.restored_content()[-1], ['later', None, 'pw', None])
+
+    def test_rekey_in_chain(self):
+        export_delta(self.vault, 'full.delta')
+        self.vault.change_kdf(new_kdf_params('pbkdf2', iterations=1000))
+        # Re-encryption rewrites every profile
+        self.assertEqual(export_delta(self.vault, 'rekeyed.delta', 5), (10, 5))
+
+        restore_deltas('restored', '123', ['full.delta', 'rekeyed.delta'])
+        with Vault('restored', '123', use_agent=False) as restored:
+            self.assertEqual(restored.kdf_params['iterations'], 1000)
+            self.assertEqual(restored.get_profile('steam').password, r'7JcS%<r<!Nn-]&c([87zT')
+
+    def test_wrong_password_and_tampering(self):
+        export_delta(self.vault, 'full.delta')
+        with self.assertRaises(WrongPasswordError):
+            read_delta('full.delta', 'wrong')
+        self.assertFalse(os.path.exists(os.path.join('vaults', 'restored.db')))
+
+        with open('full.delta', 'rb') as file:
+            content = file.read()
+        with open('tampered.delta', 'wb') as file:
+            file.write(content.replace(b'"to_seq": 5', b'"to_seq": 9'))
+        with self.assertRaises(DeltaError):
+            read_delta('tampered.delta', '123')
+
+    def test_restore_into_existing_vault(self):
+        export_delta(self.vault, 'full.delta')
+        mine = Vault('mine', '123', use_agent=False)
+        mine.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+        mine.add_new_profile('my-bank', 'pw')
+        mine.close_vault()
+
+        with self.assertRaises(DeltaError):
+            restore_deltas('mine', '123', ['full.delta'])
+        self.assertEqual(self.restored_content('mine'), [['my-bank', None, 'pw', None]])
+
+    def test_commands(self):
+        result = run_main('backup', '-v', 'test', '-o', 'full.delta')
+        self.assertEqual(result.stdout, '5\n')
+        run_main('add', 'github', '-v', 'test', stdin='pw\n')
+        self.assertEqual(run_main('backup', '-v', 'test', '-o', 'next.delta', '--since', '5').stdout, '6\n')
+
+        result = run_main('restore', '-v', 'copy', 'full.delta', 'next.delta')
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(run_main('get', 'github', '-v', 'copy').stdout, 'pw\n')
+        self.assertEqual(run_main('restore', '-v', 'copy', 'full.delta').returncode, 1)
+
+        # A delta with a damaged header is reported, not raised
+        with open('broken.delta', 'wb') as file:
+            file.write(DELTA_MAGIC + b'{}\n')
+        result = run_main('restore', '-v', 'other', 'broken.delta')
+        self.assertEqual(result.returncode, 1)
+        self.assertNotIn('Traceback', result.stderr)
+
+    def tearDown(self):
+        self.vault.close_vault()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Write contention load test: writer and reader processes, each with its own Vault, against one generated vault,
+# the way several shells or cron jobs share a vault file. Reports throughput, latency and failed operations
+# (locks still held after every retry and any other error) for each kind of operation.
+#
+# Usage: python -m benchmarks.contention_load [--profiles 10000] [--writers 4] [--readers 4] [--seconds 5]
+#                                             [--concurrent] [--busy-timeout 5.0]
+import argparse
+import multiprocessing
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.fixtures import BENCH_PASSWORD, generate_vault, profile_name
+from benchmarks.run import summarize
+from vault import Vault
+
+WRITE_OPERATIONS = ('add_new_profile', 'update_profile', 'delete_profile')
+READ_OPERATIONS = ('get_profile', 'get_vault_page')
+
+
+def writer_actions(vault, worker_idx, round_idx):
+    name = f'load-{worker_idx}-{round_idx}'
+    return [('add_new_profile', lambda: vault.add_new_profile(name, 'pw')),
+            ('update_profile', lambda: vault.update_profile(name, 'user', 'changed', None)),
+            ('delete_profile', lambda: vault.delete_profile(name))]
+
+
+def reader_actions(vault, profile_count, generator):
+    name = profile_name(generator.randrange(profile_count))
+    after_id = generator.randrange(profile_count)
+    # Fields are decrypted, like a real read would
+    return [('get_profile', lambda: list(vault.get_profile(name))),
+            ('get_vault_page', lambda: [list(profile) for profile in vault.get_vault_page(after_id, 20)[0]])]
+
+
+def worker(role, worker_idx, directory, vault_name, profile_count, seconds, vault_options, start_barrier, results):
+    # One process. The vault is opened before the barrier, so the key derivation is not measured
+    generator = random.Random(f'{role}-{worker_idx}')
+    vault = Vault(vault_name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory, **vault_options)
+    vault.open_vault()
+    samples = {}
+    failures = Counter()
+    start_barrier.wait()
+    deadline = time.perf_counter() + seconds
+    round_idx = 0
+    try:
+        while time.perf_counter() < deadline:
+            if role == 'writer':
+                actions = writer_actions(vault, worker_idx, round_idx)
+            else:
+                actions = reader_actions(vault, profile_count, generator)
+            for operation, action in actions:
+                start = time.perf_counter()
+                try:
+                    action()
+                except Exception as error:
+                    failures[(operation, type(error).__name__)] += 1
+                    continue
+                samples.setdefault(operation, []).append(time.perf_counter() - start)
+            round_idx += 1
+    finally:
+        vault.close_vault()
+    results.put((samples, failures))
+
+
+def run(directory, profiles, writers, readers, seconds, vault_options=None):
+    # Returns {operation: summary with 'ops_per_sec' over the whole run and 'failed'},
+    # and {(operation, error type): count}
+    name = generate_vault(directory, profiles)
+    vault_options = vault_options or {}
+    if vault_options.get('concurrent'):
+        # Switch the file to WAL before the workers race to do it
+        Vault(name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory, **vault_options).connect_file().close()
+
+    start_barrier = multiprocessing.Barrier(writers + readers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(role, worker_idx, directory, name, profiles, seconds,
+                                                              vault_options, start_barrier, results))
+                 for role, count in (('writer', writers), ('reader', readers)) for worker_idx in range(count)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    samples = {}
+    failures = Counter()
+    for worker_samples, worker_failures in collected:
+        for operation, operation_samples in worker_samples.items():
+            samples.setdefault(operation, []).extend(operation_samples)
+        failures.update(worker_failures)
+
+    operations = (WRITE_OPERATIONS if writers else ()) + (READ_OPERATIONS if readers else ())
+    summaries = {}
+    for operation in operations:
+        operation_samples = samples.get(operation, [])
+        failed = sum(count for (failed_operation, _), count in failures.items() if failed_operation == operation)
+        summary = summarize(operation_samples) if operation_samples else {'p50': None, 'p99': None}
+        # Throughput of all processes together, not of a single one as in summarize
+        summary['ops_per_sec'] = len(operation_samples) / seconds
+        summary['samples'] = len(operation_samples)
+        summary['failed'] = failed
+        summaries[operation] = summary
+    return summaries, dict(failures)
+
+
+def format_milliseconds(seconds):
+    return f'{"-":>8}' if seconds is None else f'{seconds * 1000:>8.2f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write contention load test')
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--concurrent', action='store_true', help='open the vaults in concurrent (WAL) mode')
+    parser.add_argument('--busy-timeout', type=float, default=5.0,
+                        help='seconds SQLite waits for a lock before the vault retries')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='basedpass-bench-')
+    try:
+        summaries, failures = run(directory, args.profiles, args.writers, args.readers, args.seconds,
+                                  {'concurrent': args.concurrent, 'busy_timeout': args.busy_timeout})
+    finally:
+        shutil.rmtree(directory)
+
+    print(f'{args.writers} writers, {args.readers} readers, {args.seconds:g} s, '
+          f'{"concurrent (WAL)" if args.concurrent else "rollback journal"}, busy timeout {args.busy_timeout:g} s')
+    print(f'{"operation":<16} {"ops/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"failed":>7}')
+    for operation, summary in summaries.items():
+        print(f'{operation:<16} {summary["ops_per_sec"]:>10.1f} {format_milliseconds(summary["p50"])} '
+              f'{format_milliseconds(summary["p99"])} {summary["failed"]:>7}')
+    for (operation, error_type), count in sorted(failures.items()):
+        print(f'  {operation}: {count} x {error_type}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Load test of the vault daemon: requests/sec of get and batched get_many against a generated vault,
+# next to the cost of opening the vault in a new process for every access.
+#
+# Usage: python -m benchmarks.daemon_load [--profiles 10000] [--clients 1 4] [--batch 50] [--seconds 3]
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fixtures import BENCH_PASSWORD, generate_vault, profile_name
+from benchmarks.run import summarize
+from local_rpc import Client
+from vault import Vault
+
+
+def wait_for_socket(socket_path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(socket_path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'The daemon did not create {socket_path}')
+        time.sleep(0.05)
+
+
+def client_loop(socket_path, vault_name, profile_count, batch, seconds, seed, results):
+    # One client process: keeps its connection open and sends requests for the given number of seconds
+    generator = random.Random(seed)
+    with Client(socket_path) as client:
+        token = client.call({'op': 'open', 'vault': vault_name, 'password': BENCH_PASSWORD})['token']
+        requests = 0
+        samples = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = [profile_name(generator.randrange(profile_count)) for _ in range(batch)]
+            if batch == 1:
+                request = {'op': 'get', 'token': token, 'name': names[0]}
+            else:
+                request = {'op': 'get_many', 'token': token, 'names': names}
+            start = time.perf_counter()
+            response = client.call(request)
+            samples.append(time.perf_counter() - start)
+            if not response['ok']:
+                raise RuntimeError(response['error'])
+            requests += 1
+    results.put((requests, samples))
+
+
+def run_load(socket_path, vault_name, profile_count, clients, batch, seconds):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client_loop,
+                                         args=(socket_path, vault_name, profile_count, batch, seconds, seed, results))
+                 for seed in range(clients)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    requests = sum(count for count, _ in collected)
+    samples = [sample for _, client_samples in collected for sample in client_samples]
+    return requests / seconds, summarize(samples)
+
+
+def cold_access(directory, vault_name, repeat=5):
+    # What every access costs without the daemon: a new Vault, the key derivation and a new connection
+    samples = []
+    for index in range(repeat):
+        start = time.perf_counter()
+        vault = Vault(vault_name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory)
+        vault.open_vault()
+        list(vault.get_profile(profile_name(index)))
+        vault.close_vault()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vault daemon load test')
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--batch', type=int, default=50, help='names per get_many request')
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--production-kdf', action='store_true', help='generate the vault with the default KDF')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='basedpass-bench-')
+    socket_path = os.path.join(directory, 'daemon.sock')
+    daemon = None
+    try:
+        name = generate_vault(directory, args.profiles, production_kdf=args.production_kdf)
+        cold = cold_access(directory, name)
+        print(f'Without the daemon: {cold["p50"] * 1000:.1f} ms per access, {1 / cold["p50"]:.1f} accesses/s')
+
+        daemon = subprocess.Popen([sys.executable, 'vault_daemon.py', 'start', '--socket', socket_path,
+                                   '--vaults-dir', directory], stdout=subprocess.DEVNULL)
+        wait_for_socket(socket_path)
+
+        print(f'{"clients":>8} {"op":<9} {"batch":>6} {"req/s":>10} {"profiles/s":>11} {"p50 ms":>8} {"p99 ms":>8}')
+        for clients in args.clients:
+            for batch in (1, args.batch):
+                rate, summary = run_load(socket_path, name, args.profiles, clients, batch, args.seconds)
+                op = 'get' if batch == 1 else 'get_many'
+                print(f'{clients:>8} {op:<9} {batch:>6} {rate:>10.1f} {rate * batch:>11.1f} '
+                      f'{summary["p50"] * 1000:>8.3f} {summary["p99"] * 1000:>8.3f}')
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
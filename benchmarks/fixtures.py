@@ -0,0 +1,64 @@
+# Synthetic vaults for benchmarks and load tests.
+#
+# Usage: python -m benchmarks.fixtures DIRECTORY [--sizes 10 1000 10000 100000]
+import argparse
+import os
+import random
+
+from data_encryption import new_kdf_params
+from vault import Vault
+
+BENCH_PASSWORD = 'benchmark'
+DEFAULT_SIZES = (10, 1000, 10000, 100000)
+# Cheap key derivation, so the benchmarks measure the vault and not the KDF.
+# Pass production_kdf=True to generate_vault to get the default parameters instead
+BENCH_KDF_ITERATIONS = 10000
+
+
+def profile_name(index):
+    return f'profile-{index:07d}'
+
+
+def make_profiles(count, seed=0):
+    # Deterministic, so two runs of a benchmark work on the same data
+    generator = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!@#$%^&*'
+    for index in range(count):
+        password = ''.join(generator.choice(alphabet) for _ in range(20))
+        link = f'https://service-{index % 997}.example.com/login' if index % 3 else None
+        yield profile_name(index), f'user{index}@example.com', password, link
+
+
+def vault_name(count):
+    return f'bench-{count}'
+
+
+# Create a vault with count profiles in directory and return its name. Existing vaults are reused
+def generate_vault(directory, count, password=BENCH_PASSWORD, production_kdf=False):
+    name = vault_name(count)
+    if os.path.exists(os.path.join(directory, f'{name}.db')):
+        return name
+
+    kdf_params = new_kdf_params() if production_kdf else new_kdf_params('pbkdf2', iterations=BENCH_KDF_ITERATIONS)
+    vault = Vault(name, password, use_agent=False, vaults_dir=directory)
+    vault.create_vault(kdf_params)
+    vault.add_profiles_bulk(make_profiles(count))
+    vault.close_vault()
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic benchmark vaults')
+    parser.add_argument('directory')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--production-kdf', action='store_true', help='use the default (slow) KDF parameters')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    for count in args.sizes:
+        name = generate_vault(args.directory, count, production_kdf=args.production_kdf)
+        print(os.path.join(args.directory, f'{name}.db'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Benchmark of whole-vault decryption with 1/2/4/8 workers.
+# Rows are encrypted in memory, so only decryption is measured.
+#
+# Usage: python -m benchmarks.parallel_bench [--sizes 1000 10000 100000] [--workers 1 2 4 8] [--threads]
+import argparse
+import os
+import time
+
+from data_encryption import Cipher, Fernet, ParallelDecryptor, choose_chunk_size
+
+
+def make_encrypted_rows(cipher, count):
+    rows = [(f'profile-{i}', f'user{i}@example.com', f'password-{i:08d}', f'https://example.com/{i}')
+            for i in range(count)]
+    return cipher.encrypt_rows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel decryption benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads', action='store_true', help='use a thread pool instead of processes')
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    cipher = Cipher(key)
+    print(f'{os.cpu_count()} CPUs, {"threads" if args.threads else "processes"}')
+    print(f'{"profiles":>9} {"workers":>8} {"chunk":>6} {"seconds":>9} {"speedup":>8}')
+
+    for size in args.sizes:
+        rows = make_encrypted_rows(cipher, size)
+        expected = None
+        baseline = None
+
+        for workers in args.workers:
+            decryptor = ParallelDecryptor(key, workers, use_processes=not args.threads)
+            # Warm the pool up, so worker start-up is not counted
+            decryptor.decrypt_rows(rows[:choose_chunk_size(size, workers) * workers * 2])
+
+            start = time.perf_counter()
+            result = decryptor.decrypt_rows(rows)
+            elapsed = time.perf_counter() - start
+            decryptor.close()
+
+            # Every mode has to give exactly the sequential output
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise AssertionError(f'{workers} workers returned rows in a different order')
+
+            baseline = baseline or elapsed
+            print(f'{size:>9} {workers:>8} {choose_chunk_size(size, workers):>6} {elapsed:>9.3f} '
+                  f'{baseline / elapsed:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
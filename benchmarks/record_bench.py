@@ -0,0 +1,115 @@
+# Storage and decryption cost of the two vault row formats: legacy rows with a Fernet token per field
+# and packed rows with one token per profile.
+#
+# Usage: python -m benchmarks.record_bench [--profiles 10000] [--lookups 200]
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.fixtures import BENCH_PASSWORD, generate_vault, profile_name
+from vault import Vault
+
+
+class CountingFernet:
+    # Stands in for the Fernet object of a Cipher and counts the decrypt calls
+    def __init__(self, fernet):
+        self.fernet = fernet
+        self.decrypts = 0
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, token):
+        self.decrypts += 1
+        return self.fernet.decrypt(token)
+
+
+def open_bench_vault(directory, name):
+    vault = Vault(name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory)
+    vault.open_vault()
+    return vault
+
+
+def make_legacy_copy(directory, name):
+    # Copy of the vault with every row rewritten in the legacy format, one token per field
+    legacy_name = f'{name}-legacy'
+    shutil.copyfile(os.path.join(directory, f'{name}.db'), os.path.join(directory, f'{legacy_name}.db'))
+
+    vault = open_bench_vault(directory, legacy_name)
+    with vault.transaction() as cursor:
+        rows = cursor.execute('SELECT id, record FROM vault').fetchall()
+        fields = vault.cipher.encrypt_rows([vault.cipher.decrypt_record(record) for _, record in rows])
+        cursor.executemany('UPDATE vault SET record = NULL, name = ?, username = ?, password = ?, link = ? '
+                           'WHERE id = ?', [encrypted + (row[0],) for row, encrypted in zip(rows, fields)])
+    vault.vacuum()
+    vault.close_vault()
+    return legacy_name
+
+
+def measure(directory, name, lookup_names):
+    vault = open_bench_vault(directory, name)
+    vault.vacuum()
+    try:
+        count = vault.connection.execute('SELECT COUNT(*) FROM vault').fetchone()[0]
+        payload = vault.connection.execute('SELECT SUM(IFNULL(LENGTH(record), 0) + IFNULL(LENGTH(name), 0) + '
+                                           'IFNULL(LENGTH(username), 0) + IFNULL(LENGTH(password), 0) + '
+                                           'IFNULL(LENGTH(link), 0)) FROM vault').fetchone()[0]
+
+        counter = CountingFernet(vault.cipher.fernet)
+        vault.cipher.fernet = counter
+        start = time.perf_counter()
+        for lookup_name in lookup_names:
+            list(vault.get_profile(lookup_name))
+        lookup_seconds = (time.perf_counter() - start) / len(lookup_names)
+        decrypts_per_lookup = counter.decrypts / len(lookup_names)
+
+        counter.decrypts = 0
+        start = time.perf_counter()
+        [list(profile) for profile in vault.get_vault_content()]
+        content_seconds = time.perf_counter() - start
+    finally:
+        vault.close_vault()
+
+    return {
+        'file_bytes_per_profile': os.path.getsize(os.path.join(directory, f'{name}.db')) / count,
+        'payload_bytes_per_profile': payload / count,
+        'decrypts_per_lookup': decrypts_per_lookup,
+        'lookup_ms': lookup_seconds * 1000,
+        'get_vault_content_ms': content_seconds * 1000,
+    }
+
+
+def run(directory, profiles, lookups, seed=0):
+    # Returns {format: measurements}
+    name = generate_vault(directory, profiles)
+    legacy_name = make_legacy_copy(directory, name)
+    generator = random.Random(seed)
+    lookup_names = [profile_name(generator.randrange(profiles)) for _ in range(lookups)]
+    return {'legacy': measure(directory, legacy_name, lookup_names), 'packed': measure(directory, name, lookup_names)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Row format benchmark')
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='basedpass-bench-')
+    try:
+        results = run(directory, args.profiles, args.lookups)
+    finally:
+        shutil.rmtree(directory)
+
+    metrics = list(results['packed'])
+    print(f'{args.profiles} profiles, {args.lookups} lookups')
+    print(f'{"metric":<26} {"legacy":>10} {"packed":>10} {"ratio":>7}')
+    for metric in metrics:
+        legacy, packed = results['legacy'][metric], results['packed'][metric]
+        print(f'{metric:<26} {legacy:>10.2f} {packed:>10.2f} {legacy / packed if packed else 0:>6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
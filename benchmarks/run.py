@@ -0,0 +1,189 @@
+# Benchmark runner for Vault operations on synthetic vaults of different sizes.
+#
+# Usage:
+#   python -m benchmarks.run run [--dir DIR] [--sizes 10 1000 10000] [--repeat 200] [--output results.json]
+#   python -m benchmarks.run compare BASE.json NEW.json [--threshold 0.2]
+#
+# Results are saved as JSON: {"meta": {...}, "results": {size: {operation: summary}}}.
+# compare exits with status 1 when an operation got slower than the threshold allows
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fixtures import BENCH_PASSWORD, DEFAULT_SIZES, generate_vault, profile_name
+from vault import Vault
+
+DEFAULT_REPEAT = 200
+# open_vault and get_vault_content are much slower than single profile operations
+SLOW_OPERATION_REPEAT = 5
+PERCENTILES = (50, 90, 99)
+# Median slowdown allowed by compare before an operation is reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def percentile(samples, rank):
+    # Nearest-rank percentile of sorted samples
+    index = max(0, -(-len(samples) * rank // 100) - 1)
+    return samples[index]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    summary = {f'p{rank}': percentile(samples, rank) for rank in PERCENTILES}
+    summary['mean'] = sum(samples) / len(samples)
+    summary['ops_per_sec'] = len(samples) / sum(samples) if sum(samples) else float('inf')
+    summary['samples'] = len(samples)
+    return summary
+
+
+def timed(action, arguments):
+    # Time every call separately and return the list of durations in seconds
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter()
+        action(argument)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def open_and_close(vault):
+    vault.open_vault()
+    vault.close_vault()
+
+
+def benchmark_size(directory, size, repeat, seed=0):
+    # Work on a copy, so adds and deletes do not change the generated fixture
+    fixture_name = generate_vault(directory, size)
+    work_name = f'{fixture_name}-work'
+    shutil.copyfile(os.path.join(directory, f'{fixture_name}.db'), os.path.join(directory, f'{work_name}.db'))
+
+    generator = random.Random(seed)
+    existing_names = [profile_name(generator.randrange(size)) for _ in range(repeat)]
+    new_names = [f'new-profile-{index}' for index in range(repeat)]
+    slow_repeat = range(min(repeat, SLOW_OPERATION_REPEAT))
+
+    def new_vault():
+        return Vault(work_name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory)
+
+    results = {'open_vault': timed(lambda _: open_and_close(new_vault()), slow_repeat)}
+
+    vault = new_vault()
+    vault.open_vault()
+    try:
+        # Profiles decrypt their fields on first use, so every field is read to measure the decryption too
+        results['get_profile'] = timed(lambda name: list(vault.get_profile(name)), existing_names)
+        results['add_new_profile'] = timed(lambda name: vault.add_new_profile(name, 'password', 'user', None),
+                                           new_names)
+        results['update_profile'] = timed(lambda name: vault.update_profile(name, 'user', 'changed', 'link'),
+                                          new_names)
+        results['delete_profile'] = timed(vault.delete_profile, new_names)
+        results['get_vault_content'] = timed(lambda _: [list(profile) for profile in vault.get_vault_content()],
+                                             slow_repeat)
+    finally:
+        vault.close_vault()
+        os.remove(os.path.join(directory, f'{work_name}.db'))
+
+    return {operation: summarize(samples) for operation, samples in results.items()}
+
+
+def run_benchmarks(directory, sizes, repeat):
+    results = {}
+    for size in sizes:
+        print(f'Benchmarking {size} profiles...', file=sys.stderr)
+        results[str(size)] = benchmark_size(directory, size, repeat)
+
+    return {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def print_results(report):
+    print(f'{"profiles":>9} {"operation":<18} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"ops/s":>10}')
+    for size, operations in report['results'].items():
+        for operation, summary in operations.items():
+            print(f'{size:>9} {operation:<18} {summary["p50"] * 1000:>9.3f} {summary["p90"] * 1000:>9.3f} '
+                  f'{summary["p99"] * 1000:>9.3f} {summary["ops_per_sec"]:>10.1f}')
+
+
+# Returns [(size, operation, base p50, new p50, ratio)] for every operation present in both reports,
+# and the subset of them that got slower by more than threshold
+def compare_reports(base, new, threshold=DEFAULT_THRESHOLD):
+    rows = []
+    for size, operations in base['results'].items():
+        for operation, summary in operations.items():
+            new_summary = new['results'].get(size, {}).get(operation)
+            if new_summary is None:
+                continue
+            ratio = new_summary['p50'] / summary['p50'] if summary['p50'] else 1.0
+            rows.append((size, operation, summary['p50'], new_summary['p50'], ratio))
+
+    regressions = [row for row in rows if row[4] > 1 + threshold]
+    return rows, regressions
+
+
+def compare_command(args):
+    with open(args.base) as base_file, open(args.new) as new_file:
+        rows, regressions = compare_reports(json.load(base_file), json.load(new_file), args.threshold)
+
+    print(f'{"profiles":>9} {"operation":<18} {"base ms":>9} {"new ms":>9} {"change":>8}')
+    for size, operation, base_p50, new_p50, ratio in rows:
+        flag = '  REGRESSION' if ratio > 1 + args.threshold else ''
+        print(f'{size:>9} {operation:<18} {base_p50 * 1000:>9.3f} {new_p50 * 1000:>9.3f} {ratio - 1:>+8.1%}{flag}')
+
+    return 1 if regressions else 0
+
+
+def run_command(args):
+    directory = args.dir or tempfile.mkdtemp(prefix='basedpass-bench-')
+    os.makedirs(directory, exist_ok=True)
+    try:
+        report = run_benchmarks(directory, args.sizes, args.repeat)
+    finally:
+        # Generated vaults are only kept when the directory was chosen explicitly
+        if args.dir is None:
+            shutil.rmtree(directory)
+
+    print_results(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Vault benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--dir', help='directory for generated vaults, reused between runs')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    run_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    run_parser.add_argument('--output', '-o', help='save the results as JSON')
+    run_parser.set_defaults(handler=run_command)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help='allowed median slowdown, 0.2 = 20%%')
+    compare_parser.set_defaults(handler=compare_command)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# Benchmark of the in-memory search index: build time and query latency.
+#
+# Usage: python -m benchmarks.search_bench [--profiles 50000] [--repeat 20]
+import argparse
+import random
+import time
+
+from benchmarks.run import summarize
+from search_index import SearchIndex
+
+WORDS = ['google', 'github', 'amazon', 'steam', 'bank', 'mail', 'work', 'vpn', 'router', 'shop', 'forum', 'cloud']
+QUERIES = ['github', 'gthub', 'git', 'gi', 'example', 'steam-bank', 'zzz', 'githbu-vpn', 'router-shop-123']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search index benchmark')
+    parser.add_argument('--profiles', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    generator = random.Random(0)
+    index = SearchIndex()
+    start = time.perf_counter()
+    for profile_id in range(args.profiles):
+        name = f'{generator.choice(WORDS)}-{generator.choice(WORDS)}-{profile_id}'
+        index.add(profile_id, name, f'https://{name}.example.com' if profile_id % 2 else None)
+    print(f'Indexed {args.profiles} profiles in {time.perf_counter() - start:.2f} s')
+
+    print(f'{"query":<18} {"p50 ms":>8} {"p99 ms":>8} {"results":>8}')
+    for query in QUERIES:
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results = index.search(query)
+            samples.append(time.perf_counter() - start)
+        summary = summarize(samples)
+        print(f'{query:<18} {summary["p50"] * 1000:>8.2f} {summary["p99"] * 1000:>8.2f} {len(results):>8}')
+
+
+if __name__ == '__main__':
+    main()
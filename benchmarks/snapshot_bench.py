@@ -0,0 +1,67 @@
+# Query latency of a file-backed vault against the same vault loaded into memory (snapshot mode).
+#
+# Usage: python -m benchmarks.snapshot_bench [--profiles 10000] [--repeat 500]
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.fixtures import BENCH_PASSWORD, generate_vault, profile_name
+from benchmarks.run import summarize, timed
+from vault import Vault
+
+MODES = {'file': {}, 'snapshot': {'snapshot': True}}
+
+
+def benchmark_mode(directory, name, lookup_names, mode_options):
+    start = time.perf_counter()
+    vault = Vault(name, BENCH_PASSWORD, use_agent=False, vaults_dir=directory, **mode_options)
+    vault.open_vault()
+    results = {'open_vault': summarize([time.perf_counter() - start])}
+    try:
+        # Only the queries are measured, profiles are not decrypted
+        results['get_profile_id'] = summarize(timed(vault.get_profile_id, lookup_names))
+        vault.name_cache.clear()
+        results['get_profiles'] = summarize(timed(lambda _: vault.get_profiles(lookup_names[:50]), range(20)))
+        results['get_vault_page'] = summarize(timed(lambda after_id: vault.get_vault_page(after_id, 100),
+                                                    range(0, len(lookup_names) * 10, 10)))
+        results['add_new_profile'] = summarize(timed(lambda index: vault.add_new_profile(f'new-{index}', 'pw'),
+                                                     range(20)))
+        for index in range(20):
+            vault.delete_profile(f'new-{index}')
+    finally:
+        vault.close_vault()
+    return results
+
+
+def run(directory, profiles, repeat, seed=0):
+    # Returns {mode: {operation: summary}}
+    name = generate_vault(directory, profiles)
+    generator = random.Random(seed)
+    lookup_names = [profile_name(generator.randrange(profiles)) for _ in range(repeat)]
+    return {mode: benchmark_mode(directory, name, lookup_names, options) for mode, options in MODES.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot mode benchmark')
+    parser.add_argument('--profiles', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='basedpass-bench-')
+    try:
+        results = run(directory, args.profiles, args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    print(f'{args.profiles} profiles')
+    print(f'{"operation":<16} {"file p50 ms":>12} {"memory p50 ms":>14} {"file p99 ms":>12} {"memory p99 ms":>14}')
+    for operation in results['file']:
+        file_summary, memory_summary = results['file'][operation], results['snapshot'][operation]
+        print(f'{operation:<16} {file_summary["p50"] * 1000:>12.3f} {memory_summary["p50"] * 1000:>14.3f} '
+              f'{file_summary["p99"] * 1000:>12.3f} {memory_summary["p99"] * 1000:>14.3f}')
+
+
+if __name__ == '__main__':
+    main()
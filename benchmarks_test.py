@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.fixtures import BENCH_PASSWORD, generate_vault, profile_name
+from benchmarks import contention_load, record_bench, snapshot_bench
+from benchmarks.run import benchmark_size, compare_reports, percentile
+from vault import Vault
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def test_generate_vault(self):
+        name = generate_vault(self.temp_dir, 25)
+        vault = Vault(name, BENCH_PASSWORD, use_agent=False, vaults_dir=self.temp_dir)
+        self.assertTrue(vault.open_vault())
+        self.assertEqual(len(vault.get_vault_content()), 25)
+        self.assertEqual(vault.get_profile(profile_name(24))[0], profile_name(24))
+        vault.close_vault()
+
+    def test_benchmark_size(self):
+        results = benchmark_size(self.temp_dir, 10, repeat=3)
+        self.assertEqual(set(results), {'open_vault', 'get_profile', 'add_new_profile', 'update_profile',
+                                        'delete_profile', 'get_vault_content'})
+        self.assertEqual(results['get_profile']['samples'], 3)
+        # The fixture itself is left untouched
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['bench-10.db'])
+
+    def test_record_bench(self):
+        results = record_bench.run(self.temp_dir, 20, lookups=5)
+        # Every field that is not None costs a decrypt in the legacy format
+        self.assertGreater(results['legacy']['decrypts_per_lookup'], 3)
+        self.assertEqual(results['packed']['decrypts_per_lookup'], 1)
+        self.assertLess(results['packed']['payload_bytes_per_profile'], results['legacy']['payload_bytes_per_profile'])
+
+    def test_snapshot_bench(self):
+        results = snapshot_bench.run(self.temp_dir, 20, repeat=5)
+        self.assertEqual(set(results), {'file', 'snapshot'})
+        self.assertEqual(results['snapshot']['get_profile_id']['samples'], 5)
+
+    def test_contention_load(self):
+        summaries, failures = contention_load.run(self.temp_dir, 20, writers=2, readers=1, seconds=0.3)
+        self.assertEqual(set(summaries), {'add_new_profile', 'update_profile', 'delete_profile', 'get_profile',
+                                          'get_vault_page'})
+        self.assertGreater(summaries['add_new_profile']['samples'], 0)
+        self.assertEqual(failures, {})
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([7], 90), 7)
+
+    def test_compare_reports(self):
+        base = {'results': {'10': {'get_profile': {'p50': 1.0}, 'open_vault': {'p50': 2.0}}}}
+        new = {'results': {'10': {'get_profile': {'p50': 1.5}, 'open_vault': {'p50': 2.1}}}}
+        rows, regressions = compare_reports(base, new, threshold=0.2)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual([(size, operation) for size, operation, *_ in regressions], [('10', 'get_profile')])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
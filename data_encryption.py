@@ -1,21 +1,63 @@
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.fernet import Fernet
+from functools import partial
 import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
 
+from instrumentation import InstrumentedFernet, instrumented, is_enabled
 
-def generate_key(password, salt):
+# Purpose labels for subkeys derived from the vault key
+NAME_INDEX_PURPOSE = 'basedpass name index'
+BACKUP_PURPOSE = 'basedpass backup'
+AUDIT_PURPOSE = 'basedpass audit'
+
+# Key derivation defaults. Vaults store their own parameters, these are used for new vaults
+PBKDF2_ITERATIONS = 600000
+SCRYPT_N = 2 ** 17
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+KDF_ALGORITHMS = ('pbkdf2', 'scrypt')
+
+# Row formats of the vault table. The first byte of a record says which one the row uses.
+# Legacy rows have no record and keep every field as a separate Fernet token in its own column
+LEGACY_RECORD_FORMAT = 0
+# All fields packed together and encrypted as a single Fernet token, stored as raw bytes instead of base64
+PACKED_RECORD_FORMAT = 1
+# Length prefix of a field that is None
+NONE_FIELD_LENGTH = 0xFFFFFFFF
+
+# Plain bytes in one encrypted chunk of an attachment
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+# Calibration never goes below these values
+MIN_PBKDF2_ITERATIONS = 10000
+MIN_SCRYPT_N = 2 ** 12
+# 1 GiB of memory at r = 8
+MAX_SCRYPT_N = 2 ** 20
+
+
+@instrumented('kdf')
+def generate_key(password, salt, iterations=PBKDF2_ITERATIONS):
     # Make byte strings out of character ones
     password_bytes = password.encode()
-    salt_byte = salt.encode()
+    salt_byte = salt.encode() if isinstance(salt, str) else salt
 
     # Create a key based on hashed password
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt_byte,
-        iterations=600000,
+        iterations=iterations,
         backend=default_backend()
     )
     key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
@@ -23,6 +65,113 @@ def generate_key(password, salt):
     return key
 
 
+@instrumented('kdf')
+def generate_scrypt_key(password, salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    kdf = Scrypt(salt=salt, length=32, n=n, r=r, p=p, backend=default_backend())
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+
+# KDF parameters are kept as a dict: {'algorithm': ..., 'salt': <base64>, ...algorithm parameters}
+def new_kdf_params(algorithm='pbkdf2', **params):
+    salt = base64.b64encode(os.urandom(SALT_SIZE)).decode()
+    if algorithm == 'pbkdf2':
+        return {'algorithm': 'pbkdf2', 'iterations': params.get('iterations', PBKDF2_ITERATIONS), 'salt': salt}
+    if algorithm == 'scrypt':
+        return {'algorithm': 'scrypt', 'n': params.get('n', SCRYPT_N), 'r': params.get('r', SCRYPT_R),
+                'p': params.get('p', SCRYPT_P), 'salt': salt}
+
+    raise ValueError(f'Unknown KDF algorithm "{algorithm}". Use one of: {", ".join(KDF_ALGORITHMS)}')
+
+
+# Parameters of vaults created before they were stored in the vault: the vault name was the salt
+def legacy_kdf_params(vault_name):
+    return {'algorithm': 'pbkdf2', 'iterations': PBKDF2_ITERATIONS,
+            'salt': base64.b64encode(vault_name.encode()).decode()}
+
+
+def derive_key(password, kdf_params):
+    salt = base64.b64decode(kdf_params['salt'])
+    if kdf_params['algorithm'] == 'pbkdf2':
+        return generate_key(password, salt, kdf_params['iterations'])
+    if kdf_params['algorithm'] == 'scrypt':
+        return generate_scrypt_key(password, salt, kdf_params['n'], kdf_params['r'], kdf_params['p'])
+
+    raise ValueError(f'Unknown KDF algorithm "{kdf_params["algorithm"]}"')
+
+
+def time_derivation(kdf_params):
+    start = time.perf_counter()
+    derive_key('calibration', kdf_params)
+    return time.perf_counter() - start
+
+
+# Benchmark this host and pick KDF parameters that take about target_seconds to unlock a vault
+def calibrate_kdf(target_seconds=0.5, algorithm='pbkdf2'):
+    if algorithm == 'pbkdf2':
+        # PBKDF2 time grows linearly with the iteration count
+        sample = new_kdf_params('pbkdf2', iterations=100000)
+        per_iteration = time_derivation(sample) / sample['iterations']
+        iterations = int(target_seconds / per_iteration) // 10000 * 10000
+        return new_kdf_params('pbkdf2', iterations=max(MIN_PBKDF2_ITERATIONS, iterations))
+
+    if algorithm == 'scrypt':
+        # Scrypt time grows linearly with n, which has to be a power of two
+        sample = new_kdf_params('scrypt', n=2 ** 14)
+        per_n = time_derivation(sample) / sample['n']
+        n = MIN_SCRYPT_N
+        while n * 2 <= MAX_SCRYPT_N and n * 2 * per_n <= target_seconds:
+            n *= 2
+        return new_kdf_params('scrypt', n=n)
+
+    raise ValueError(f'Unknown KDF algorithm "{algorithm}". Use one of: {", ".join(KDF_ALGORITHMS)}')
+
+
+def derive_subkey(key, purpose):
+    # Derive an independent 32-byte key for a single purpose from the Fernet key,
+    # so the master key itself is never reused outside of Fernet
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=purpose.encode(),
+        backend=default_backend()
+    )
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+
+def blind_index(plain_text, index_key):
+    # Deterministic keyed digest of plain_text.
+    # Equal inputs give equal digests, so values can be looked up without decrypting them
+    return hmac.new(index_key, plain_text.encode(), hashlib.sha256).digest()
+
+
+def pack_fields(values):
+    # Every field is written as a 4-byte length followed by its UTF-8 bytes
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(struct.pack('>I', NONE_FIELD_LENGTH))
+        else:
+            data = value.encode()
+            parts.append(struct.pack('>I', len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_fields(data):
+    values = []
+    position = 0
+    while position < len(data):
+        length, = struct.unpack_from('>I', data, position)
+        position += 4
+        if length == NONE_FIELD_LENGTH:
+            values.append(None)
+        else:
+            values.append(data[position:position + length].decode())
+            position += length
+    return values
+
+
 def encrypt(plain_text, key):
     cipher_suite = Fernet(key)
 
@@ -53,3 +202,191 @@ def decrypt_many(data_list, key):
             data_list[i] = decrypt(data, key)
 
     return data_list
+
+
+class SessionClosedError(Exception):
+    pass
+
+
+class ClosedFernet:
+    # Stands in for the Fernet object of a closed session: its key is gone, nothing can be encrypted or decrypted
+    def encrypt(self, data):
+        raise SessionClosedError('The vault has been closed')
+
+    def decrypt(self, token):
+        raise SessionClosedError('The vault has been closed')
+
+
+class Cipher:
+    # Encryption session for one opened vault.
+    # The key is parsed and the subkeys are derived once, instead of on every field
+    def __init__(self, key):
+        self.key = key
+        self.fernet = Fernet(key)
+        if is_enabled():
+            self.fernet = InstrumentedFernet(self.fernet)
+        self.index_key = derive_subkey(key, NAME_INDEX_PURPOSE)
+
+    def close(self):
+        # Drop the key. Profiles still holding this session can not decrypt their fields anymore
+        self.key = None
+        self.fernet = ClosedFernet()
+        self.index_key = None
+
+    def encrypt(self, plain_text):
+        return self.fernet.encrypt(plain_text.encode())
+
+    def decrypt(self, encrypted_text):
+        return self.fernet.decrypt(encrypted_text).decode()
+
+    def blind_index(self, plain_text):
+        if plain_text is None:
+            return None
+        return blind_index(plain_text, self.index_key)
+
+    def encrypt_column(self, values):
+        # Returns a new list, None values are kept as they are
+        encrypt_bytes = self.fernet.encrypt
+        return [None if value is None else encrypt_bytes(value.encode()) for value in values]
+
+    def decrypt_column(self, values):
+        decrypt_bytes = self.fernet.decrypt
+        return [None if value is None else decrypt_bytes(value).decode() for value in values]
+
+    def encrypt_rows(self, rows):
+        # Encrypt every field of every row. Rows are returned as new tuples
+        encrypt_bytes = self.fernet.encrypt
+        return [tuple(None if value is None else encrypt_bytes(value.encode()) for value in row) for row in rows]
+
+    def decrypt_rows(self, rows):
+        decrypt_bytes = self.fernet.decrypt
+        return [[None if value is None else decrypt_bytes(value).decode() for value in row] for row in rows]
+
+    def wrap_key(self, data_key):
+        # Encrypt a random key of another cipher, such as the key of an attachment
+        return self.fernet.encrypt(data_key)
+
+    def unwrap_key(self, token):
+        return self.fernet.decrypt(token)
+
+    def encrypt_record(self, values):
+        # One packed record for all fields of a row: a format byte and the raw Fernet token
+        token = self.fernet.encrypt(pack_fields(values))
+        return bytes([PACKED_RECORD_FORMAT]) + base64.urlsafe_b64decode(token)
+
+    def decrypt_record(self, record):
+        if record[0] != PACKED_RECORD_FORMAT:
+            raise ValueError(f'Unknown record format {record[0]}')
+        return unpack_fields(self.fernet.decrypt(base64.urlsafe_b64encode(record[1:])))
+
+    def encrypt_records(self, rows):
+        return [self.encrypt_record(row) for row in rows]
+
+    def decrypt_records(self, rows):
+        # Rows as stored in the vault table: (record, *legacy fields).
+        # Rows with a record are decrypted with a single call, legacy rows field by field
+        decrypt_bytes = self.fernet.decrypt
+        return [self.decrypt_record(row[0]) if row[0] is not None
+                else [None if value is None else decrypt_bytes(value).decode() for value in row[1:]]
+                for row in rows]
+
+
+class ChunkCipher:
+    # Authenticated encryption of the chunks of one attachment under its own random key (AES-256-GCM).
+    # The nonce is the chunk index, which is never repeated under a key. The associated data binds every chunk
+    # to its attachment, its position and whether it is the last one, so chunks can not be reordered,
+    # moved to another attachment or cut off the end without failing to decrypt
+    def __init__(self, data_key):
+        self.aead = AESGCM(data_key)
+
+    @staticmethod
+    def new_key():
+        return AESGCM.generate_key(bit_length=256)
+
+    @staticmethod
+    def associated_data(attachment_id, index, last):
+        return struct.pack('>qQ?', attachment_id, index, last)
+
+    def encrypt_chunk(self, attachment_id, index, last, data):
+        return self.aead.encrypt(index.to_bytes(12, 'big'), data, self.associated_data(attachment_id, index, last))
+
+    def decrypt_chunk(self, attachment_id, index, last, data):
+        # Raises cryptography.exceptions.InvalidTag when the chunk has been modified or moved
+        return self.aead.decrypt(index.to_bytes(12, 'big'), data, self.associated_data(attachment_id, index, last))
+
+
+# Work units of the parallel decryptor. Small chunks balance the load between workers,
+# large ones amortize the cost of sending rows to another process
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 4096
+CHUNKS_PER_WORKER = 4
+
+# Cipher of the current worker process, set up once by the pool initializer
+_worker_cipher = None
+
+
+def _init_worker(key):
+    global _worker_cipher
+    _worker_cipher = Cipher(key)
+
+
+def _decrypt_chunk(method, rows):
+    return getattr(_worker_cipher, method)(rows)
+
+
+def choose_chunk_size(row_count, workers):
+    # Give every worker a few chunks, so one slow chunk does not leave the others idle
+    chunk_size = -(-row_count // (workers * CHUNKS_PER_WORKER))
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, chunk_size))
+
+
+class ParallelDecryptor:
+    # Decrypts rows on a pool of workers. Processes are used by default, because Fernet holds the GIL
+    # for most of its work. The pool is started on first use and reused until close()
+    def __init__(self, key, workers, use_processes=True):
+        self.cipher = Cipher(key)
+        self.key = key
+        self.workers = workers
+        self.use_processes = use_processes
+        self.executor = None
+
+    def decrypt_rows(self, rows, chunk_size=None):
+        # Result order matches rows, exactly as Cipher.decrypt_rows
+        return self.map_chunks('decrypt_rows', rows, chunk_size)
+
+    def decrypt_records(self, rows, chunk_size=None):
+        # Same as Cipher.decrypt_records
+        return self.map_chunks('decrypt_records', rows, chunk_size)
+
+    def map_chunks(self, method, rows, chunk_size=None):
+        # Run the Cipher method on chunks of rows and join the results in order
+        if chunk_size is None:
+            chunk_size = choose_chunk_size(len(rows), self.workers)
+
+        # Not worth a round trip to the pool
+        if self.workers <= 1 or len(rows) <= chunk_size:
+            return getattr(self.cipher, method)(rows)
+
+        if self.executor is None:
+            # Imported here, process pools are slow to import and most sessions never use one
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            if self.use_processes:
+                self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.key,))
+            else:
+                self.executor = ThreadPoolExecutor(self.workers)
+
+        chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+        if self.use_processes:
+            decrypt_chunk = partial(_decrypt_chunk, method)
+        else:
+            decrypt_chunk = getattr(self.cipher, method)
+
+        decrypted = []
+        for chunk in self.executor.map(decrypt_chunk, chunks):
+            decrypted.extend(chunk)
+        return decrypted
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,69 @@
+import csv
+import json
+import os
+
+# Column names of the supported CSV exports, mapped to (name, username, password, link)
+CSV_FORMATS = {
+    'bitwarden': ('name', 'login_username', 'login_password', 'login_uri'),
+    'keepass': ('Title', 'Username', 'Password', 'URL'),
+    'basedpass': ('Name', 'Username', 'Password', 'Link'),
+}
+
+
+def empty_to_none(value):
+    if value is None or value == '':
+        return None
+    return value
+
+
+# Pick the CSV format by the columns present in the header
+def detect_csv_format(header):
+    for format_name, columns in CSV_FORMATS.items():
+        if all(column in header for column in columns):
+            return format_name
+
+    return None
+
+
+# Yield (name, username, password, link) for every row of a Bitwarden, KeePass or basedpass CSV export
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        format_name = detect_csv_format(reader.fieldnames or [])
+        if format_name is None:
+            raise ValueError(f'Unknown CSV format. Expected columns of one of: {", ".join(CSV_FORMATS)}')
+
+        columns = CSV_FORMATS[format_name]
+        for row in reader:
+            yield tuple(empty_to_none(row.get(column)) for column in columns)
+
+
+# Yield (name, username, password, link) for every item of a Bitwarden JSON export
+# or of a plain list of {"name", "username", "password", "link"} objects
+def read_json(path):
+    with open(path, encoding='utf-8') as file:
+        data = json.load(file)
+
+    if isinstance(data, dict) and 'items' in data:
+        for item in data['items']:
+            login = item.get('login') or {}
+            uris = login.get('uris') or [{}]
+            yield (empty_to_none(item.get('name')), empty_to_none(login.get('username')),
+                   empty_to_none(login.get('password')), empty_to_none(uris[0].get('uri')))
+    elif isinstance(data, list):
+        for item in data:
+            yield (empty_to_none(item.get('name')), empty_to_none(item.get('username')),
+                   empty_to_none(item.get('password')), empty_to_none(item.get('link')))
+    else:
+        raise ValueError('Unknown JSON format. Expected a Bitwarden export or a list of profiles')
+
+
+# Choose the reader by file extension
+def read_profiles(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return read_csv(path)
+    if extension == '.json':
+        return read_json(path)
+
+    raise ValueError(f'Unsupported file type "{extension}". Use a .csv or .json export')
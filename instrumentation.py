@@ -0,0 +1,151 @@
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+# Counters and timers of the hot paths: key derivation, Fernet calls, SQL statements and table rendering.
+# Everything is off by default. Instrumented functions then cost a single flag check, and connections
+# and ciphers are only wrapped when they are created while instrumentation is on.
+# Stats are process-wide: worker processes of the parallel decryptor are not counted
+
+# Runs of placeholders such as "IN (?, ?, ?)" are collapsed, so batches of any size share one entry
+PLACEHOLDERS_PATTERN = re.compile(r'\?(?:\s*,\s*\?)+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # name -> [calls, seconds]
+        self.timers = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+
+    def snapshot(self):
+        # {name: {'calls': ..., 'seconds': ...}}, a copy that does not change with later calls
+        with self.lock:
+            return {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.timers.items()}
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+
+
+STATS = Stats()
+
+
+def enable():
+    STATS.enabled = True
+
+
+def disable():
+    STATS.enabled = False
+
+
+def is_enabled():
+    return STATS.enabled
+
+
+def snapshot():
+    return STATS.snapshot()
+
+
+def reset():
+    STATS.reset()
+
+
+def instrumented(name):
+    # Decorator timing every call of the function under name while instrumentation is on
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not STATS.enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                STATS.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def statement_name(sql):
+    sql = WHITESPACE_PATTERN.sub(' ', sql.strip())
+    return f'sql: {PLACEHOLDERS_PATTERN.sub("?, ...", sql)}'
+
+
+def timed_call(name, function, *args):
+    start = time.perf_counter()
+    try:
+        return function(*args)
+    finally:
+        STATS.record(name, time.perf_counter() - start)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Only execute is timed. Rows fetched later are mostly produced while the statement runs
+    def execute(self, sql, parameters=()):
+        return timed_call(statement_name(sql), super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return timed_call(statement_name(sql), super().executemany, sql, parameters)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Pass as factory to sqlite3.connect
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class InstrumentedFernet:
+    # Stands in for a Fernet object and times its encrypt and decrypt calls
+    def __init__(self, fernet):
+        self.fernet = fernet
+
+    def encrypt(self, data):
+        return timed_call('encrypt', self.fernet.encrypt, data)
+
+    def decrypt(self, token):
+        return timed_call('decrypt', self.fernet.decrypt, token)
+
+
+def connection_factory():
+    # Connection class for sqlite3.connect
+    return InstrumentedConnection if STATS.enabled else sqlite3.Connection
+
+
+def breakdown_line(calls, seconds, wall_seconds, name):
+    share = f'{seconds / wall_seconds:>6.1%}' if wall_seconds else f'{"":>6}'
+    return f'{calls:>9} {seconds * 1000:>10.2f} {seconds / calls * 1e6:>12.1f} {share}  {name}'
+
+
+def format_breakdown(stats, wall_seconds=None):
+    # Table of the timers, slowest first, with the total of all SQL statements
+    lines = [f'{"calls":>9} {"total ms":>10} {"per call us":>12} {"share":>6}  name']
+    for name, timer in sorted(stats.items(), key=lambda item: -item[1]['seconds']):
+        lines.append(breakdown_line(timer['calls'], timer['seconds'], wall_seconds, name))
+
+    sql_timers = [timer for name, timer in stats.items() if name.startswith('sql: ')]
+    if sql_timers:
+        lines.append(breakdown_line(sum(timer['calls'] for timer in sql_timers),
+                                    sum(timer['seconds'] for timer in sql_timers), wall_seconds, 'sql, all statements'))
+    if wall_seconds is not None:
+        lines.append(f'{"":>9} {wall_seconds * 1000:>10.2f} {"":>12} {"":>6}  wall time')
+    return '\n'.join(lines)
@@ -0,0 +1,62 @@
+import os
+import unittest
+
+import instrumentation
+from data_encryption import Cipher, Fernet, new_kdf_params
+from main_test import run_main
+from menu_options import display_content
+from vault import Vault
+from vault_test import VaultDirTestCase
+
+
+class TestInstrumentation(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        instrumentation.reset()
+
+    def test_disabled_by_default(self):
+        with Vault('test', '123', use_agent=False) as vault:
+            vault.get_profile('vk')
+            self.assertNotIsInstance(vault.connection, instrumentation.InstrumentedConnection)
+            self.assertNotIsInstance(vault.cipher.fernet, instrumentation.InstrumentedFernet)
+        self.assertEqual(Vault.stats(), {})
+
+    def test_vault_stats(self):
+        instrumentation.enable()
+        try:
+            vault = Vault('created', 'secret', use_agent=False)
+            vault.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+            vault.add_profiles_bulk([(f'profile-{index}', None, 'pw', None) for index in range(3)])
+            [list(profile) for profile in vault.get_profiles(['profile-0', 'profile-1'])]
+            display_content([vault.get_profile('profile-2')])
+            stats = vault.stats()
+            vault.close_vault()
+        finally:
+            instrumentation.disable()
+
+        self.assertEqual(stats['kdf']['calls'], 1)
+        self.assertEqual(stats['encrypt']['calls'], 4)
+        self.assertEqual(stats['decrypt']['calls'], 3)
+        self.assertEqual(stats['render']['calls'], 1)
+        self.assertEqual(stats['sql: SELECT id, name_index FROM vault WHERE name_index IN (?, ...)']['calls'], 1)
+        self.assertGreater(stats['sql: BEGIN IMMEDIATE']['seconds'], 0)
+
+        # Snapshots do not follow later calls
+        Cipher(Fernet.generate_key()).encrypt('more')
+        self.assertEqual(stats['encrypt']['calls'], 4)
+
+    def test_profile_flag(self):
+        result = run_main('--profile', '--profile-output', 'get.prof', 'get', 'vk', '-v', 'test')
+        self.assertEqual(result.stdout, 'qwerty123\n')
+        self.assertIn('kdf', result.stderr)
+        self.assertIn('sql, all statements', result.stderr)
+        self.assertIn('wall time', result.stderr)
+        self.assertTrue(os.path.getsize('get.prof') > 0)
+
+    def tearDown(self):
+        instrumentation.reset()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import local_rpc
+from local_rpc import LocalServer
+
+# Path of the agent socket, exported by "key_agent.py start" like SSH_AUTH_SOCK
+AGENT_SOCKET_ENV = 'BASEDPASS_AGENT_SOCK'
+
+# Keys are dropped this many seconds after they were added...
+DEFAULT_TTL = 3600
+# ...or after they have not been used for this many seconds, whichever comes first
+DEFAULT_IDLE_TIMEOUT = 900
+
+# Seconds between checks for expired keys
+EVICTION_INTERVAL = 5
+# Seconds a client waits for the agent before deriving the key itself
+CLIENT_TIMEOUT = 2
+
+
+class KeyStore:
+    # Derived keys held in memory.
+    # Entries are found by a keyed digest of the vault id and the master password,
+    # so a key is only handed out to whoever knows the password it was derived from
+    def __init__(self, ttl=DEFAULT_TTL, idle_timeout=DEFAULT_IDLE_TIMEOUT, clock=time.monotonic):
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.secret = os.urandom(32)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def entry_id(self, vault_id, password):
+        return hmac.new(self.secret, f'{vault_id}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def get(self, vault_id, password):
+        with self.lock:
+            self.evict_expired()
+            entry = self.entries.get(self.entry_id(vault_id, password))
+            if entry is None:
+                return None
+
+            # entry is [key, added at, last used at]
+            entry[2] = self.clock()
+            return entry[0]
+
+    def put(self, vault_id, password, key):
+        with self.lock:
+            now = self.clock()
+            self.entries[self.entry_id(vault_id, password)] = [key, now, now]
+
+    def evict_expired(self):
+        now = self.clock()
+        expired = [entry_id for entry_id, (_, added, used) in self.entries.items()
+                   if now - added >= self.ttl or now - used >= self.idle_timeout]
+        for entry_id in expired:
+            del self.entries[entry_id]
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class KeyAgent(LocalServer):
+    def __init__(self, socket_path, store):
+        self.store = store
+        super().__init__(socket_path)
+        self.last_eviction = time.monotonic()
+
+    def dispatch(self, request):
+        match request['op']:
+            case 'get':
+                key = self.store.get(request['vault'], request['password'])
+                return {'ok': True, 'key': None if key is None else key.decode()}
+            case 'put':
+                self.store.put(request['vault'], request['password'], request['key'].encode())
+                return {'ok': True}
+            case 'lock':
+                self.store.flush()
+                return {'ok': True}
+            case 'stop':
+                self.store.flush()
+                # shutdown() waits for serve_forever, so it can not be called from a request thread directly
+                threading.Thread(target=self.shutdown).start()
+                return {'ok': True}
+            case _:
+                return {'ok': False, 'error': f'unknown operation "{request["op"]}"'}
+
+    def service_actions(self):
+        # Called by serve_forever between requests
+        if time.monotonic() - self.last_eviction >= EVICTION_INTERVAL:
+            with self.store.lock:
+                self.store.evict_expired()
+            self.last_eviction = time.monotonic()
+
+    def server_close(self):
+        super().server_close()
+        self.store.flush()
+
+
+# Send one request to the agent. Returns None when no agent is configured or reachable
+def agent_request(request, socket_path=None):
+    return local_rpc.request(socket_path or os.environ.get(AGENT_SOCKET_ENV), request, CLIENT_TIMEOUT)
+
+
+# Key derived earlier for this vault and password, or None
+def get_cached_key(vault_id, password, socket_path=None):
+    response = agent_request({'op': 'get', 'vault': vault_id, 'password': password}, socket_path)
+    if not response or not response.get('ok') or response.get('key') is None:
+        return None
+
+    key = response['key'].encode()
+    # Anything that is not a Fernet key is ignored, the caller derives the key instead
+    if len(base64.urlsafe_b64decode(key)) != 32:
+        return None
+    return key
+
+
+def cache_key(vault_id, password, key, socket_path=None):
+    agent_request({'op': 'put', 'vault': vault_id, 'password': password, 'key': key.decode()}, socket_path)
+
+
+# Make the agent forget every key
+def lock_agent(socket_path=None):
+    response = agent_request({'op': 'lock'}, socket_path)
+    return bool(response and response.get('ok'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='basedpass key agent')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    start_parser = subparsers.add_parser('start', help='run the agent in the foreground')
+    start_parser.add_argument('--socket', help='socket path (default: a new private temporary directory)')
+    start_parser.add_argument('--ttl', type=float, default=DEFAULT_TTL, help='seconds a key is kept')
+    start_parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                              help='seconds an unused key is kept')
+    subparsers.add_parser('lock', help='forget all keys')
+    subparsers.add_parser('stop', help='forget all keys and stop the agent')
+    args = parser.parse_args(argv)
+
+    if args.command == 'start':
+        socket_path = args.socket or os.path.join(tempfile.mkdtemp(prefix='basedpass-'), 'agent.sock')
+        agent = KeyAgent(socket_path, KeyStore(args.ttl, args.idle_timeout))
+        print(f'{AGENT_SOCKET_ENV}={socket_path}; export {AGENT_SOCKET_ENV};', flush=True)
+        try:
+            agent.serve_forever(poll_interval=1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            agent.server_close()
+        return 0
+
+    response = agent_request({'op': args.command})
+    if not response or not response.get('ok'):
+        print(f'No agent is reachable. Is {AGENT_SOCKET_ENV} set?', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
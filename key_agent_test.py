@@ -0,0 +1,106 @@
+import os
+import stat
+import threading
+import unittest
+from unittest import mock
+
+import data_encryption
+import key_agent
+from key_agent import KeyAgent, KeyStore, cache_key, get_cached_key, lock_agent
+from vault import Vault
+from vault_test import VaultDirTestCase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = KeyStore(ttl=100, idle_timeout=10, clock=self.clock)
+        self.store.put('vault', 'password', b'key')
+
+    def test_key_needs_password(self):
+        self.assertEqual(self.store.get('vault', 'password'), b'key')
+        self.assertEqual(self.store.get('vault', 'wrong'), None)
+        self.assertEqual(self.store.get('other', 'password'), None)
+
+    def test_idle_timeout(self):
+        for _ in range(5):
+            self.clock.now += 9
+            self.assertEqual(self.store.get('vault', 'password'), b'key')
+        self.clock.now += 10
+        self.assertEqual(self.store.get('vault', 'password'), None)
+        self.assertEqual(len(self.store), 0)
+
+    def test_ttl(self):
+        for _ in range(12):
+            self.clock.now += 9
+            self.store.get('vault', 'password')
+        self.assertEqual(self.store.get('vault', 'password'), None)
+
+    def test_flush(self):
+        self.store.flush()
+        self.assertEqual(self.store.get('vault', 'password'), None)
+
+
+class TestKeyAgent(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket_path = os.path.join(self.temp_dir, 'agent.sock')
+        self.agent = KeyAgent(self.socket_path, KeyStore())
+        self.thread = threading.Thread(target=self.agent.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.environment = mock.patch.dict(os.environ, {key_agent.AGENT_SOCKET_ENV: self.socket_path})
+        self.environment.start()
+
+    def test_socket_permissions(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+    def test_round_trip_and_lock(self):
+        key = data_encryption.Fernet.generate_key()
+        cache_key('vault', 'password', key)
+        self.assertEqual(get_cached_key('vault', 'password'), key)
+        self.assertEqual(get_cached_key('vault', 'other'), None)
+
+        self.assertTrue(lock_agent())
+        self.assertEqual(get_cached_key('vault', 'password'), None)
+
+    def test_open_vault_uses_agent(self):
+        vault = Vault('test', '123')
+        self.assertTrue(vault.open_vault())
+        vault.close_vault()
+        self.assertEqual(len(self.agent.store), 1)
+
+        with mock.patch('vault.derive_key', side_effect=AssertionError('key derived twice')):
+            vault = Vault('test', '123')
+            self.assertTrue(vault.open_vault())
+            self.assertEqual(vault.get_profile('vk')[2], 'qwerty123')
+            vault.close_vault()
+
+        # Wrong passwords still fail and are not cached
+        self.assertFalse(Vault('test', 'qwerty').open_vault())
+        self.assertEqual(len(self.agent.store), 1)
+
+    def test_missing_agent(self):
+        with mock.patch.dict(os.environ, {key_agent.AGENT_SOCKET_ENV: os.path.join(self.temp_dir, 'none.sock')}):
+            self.assertEqual(get_cached_key('vault', 'password'), None)
+            vault = Vault('test', '123')
+            self.assertTrue(vault.open_vault())
+            vault.close_vault()
+
+    def tearDown(self):
+        self.environment.stop()
+        self.agent.shutdown()
+        self.thread.join()
+        self.agent.server_close()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import abc
+import json
+import os
+import socket
+import socketserver
+import struct
+
+# Longest request line a server reads. Longer requests close the connection
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # One JSON object per line in both directions. A client may send any number of requests on one connection
+    def handle(self):
+        if not self.server.is_peer_allowed(self.request):
+            return
+
+        while True:
+            line = self.rfile.readline(self.server.max_request_size + 1)
+            if not line or len(line) > self.server.max_request_size:
+                break
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except (ValueError, KeyError, TypeError) as error:
+                response = {'ok': False, 'error': f'bad request: {error}'}
+            except Exception as error:
+                # A bug in dispatch fails the request, the connection stays open
+                self.server.handle_error(self.request, self.client_address)
+                response = {'ok': False, 'error': f'internal error: {error}'}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class LocalServer(abc.ABC, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # JSON lines server on a Unix socket that only the owner can connect to.
+    # Subclasses implement dispatch(request) and return the response object
+    daemon_threads = True
+    max_request_size = MAX_REQUEST_SIZE
+
+    def __init__(self, socket_path):
+        # Socket is created with owner-only permissions
+        previous_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(previous_umask)
+        os.chmod(socket_path, 0o600)
+
+    def is_peer_allowed(self, connection):
+        # On Linux also refuse processes of other users, in case the socket permissions get changed
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    @abc.abstractmethod
+    def dispatch(self, request):
+        pass
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class Client:
+    # Connection to a LocalServer that is kept open between requests
+    def __init__(self, socket_path, timeout=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.connection.settimeout(timeout)
+            self.connection.connect(socket_path)
+        except OSError:
+            self.connection.close()
+            raise
+        self.responses = self.connection.makefile('rb')
+
+    def call(self, request):
+        self.connection.sendall(json.dumps(request).encode() + b'\n')
+        line = self.responses.readline()
+        if not line:
+            raise ConnectionError('Server closed the connection')
+        return json.loads(line)
+
+    def close(self):
+        self.responses.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Send one request on a new connection. Returns None when the server is not reachable
+def request(socket_path, request_object, timeout=None):
+    if not socket_path or not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    try:
+        with Client(socket_path, timeout) as client:
+            return client.call(request_object)
+    except (OSError, ValueError):
+        return None
@@ -1,7 +1,550 @@
-from menu_options import main_menu
+import argparse
+import os
+import sys
 
+# Only the standard library modules above are imported at start-up.
+# Vault, cryptography, tabulate and pyperclip are imported by the commands that use them,
+# so "--help" and argument errors return without loading any of them
+
+# Master password for scripted commands. When it is not set the password is prompted for
+PASSWORD_ENV = 'BASEDPASS_PASSWORD'
+# Same values as data_encryption.KDF_ALGORITHMS, repeated to keep cryptography out of start-up
+KDF_ALGORITHMS = ('pbkdf2', 'scrypt')
+PROFILE_FIELDS = ('name', 'username', 'password', 'link')
+EXPORT_FIELDS = ['Name', 'Username', 'Password', 'Link']
+# Exit status of a command that found the vault locked by another process (EX_TEMPFAIL), so scripts can retry it
+LOCKED_EXIT_CODE = 75
+
+
+def error(message):
+    print(message, file=sys.stderr)
+    return 1
+
+
+def read_master_password():
+    password = os.environ.get(PASSWORD_ENV)
+    if password is None:
+        import getpass
+        password = getpass.getpass("Enter master password: ")
+    return password
+# Open the vault named in args. Returns None when it does not exist, is not a vault or the password is wrong
+
+# Open the vault named in args. Returns None when it does not exist or the password is wrong
+def open_vault(args, **vault_options):
+    from vault import NotAVaultError, Vault
+
+    vault = Vault(args.vault, read_master_password(), **vault_options)
+    if not os.path.exists(vault.vault_path()):
+        error(f'Vault "{args.vault}" does not exist. Try creating it first')
+        return None
+    try:
+        opened = vault.open_vault()
+    except NotAVaultError as not_a_vault:
+        vault.close_vault()
+        error(str(not_a_vault))
+        return None
+    if not opened:
+        vault.close_vault()
+        error(f'Wrong master password! Failed to access "{args.vault}"')
+        return None
+    return vault
+
+
+def get_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    profile = vault.get_profile(args.name)
+    # Decrypted before the vault is closed, profiles can not decrypt anything after that
+    fields = None if profile is None else list(profile)
+    vault.close_vault()
+    if fields is None:
+        return error(f'Profile "{args.name}" does not exist in this vault')
+
+    if args.json:
+        import json
+        print(json.dumps(dict(zip(PROFILE_FIELDS, fields)), ensure_ascii=False))
+    else:
+        print(fields[PROFILE_FIELDS.index(args.field)] or '')
+    return 0
+
+
+def add_command(args):
+    if args.generate:
+        from password_generator import generate_pass
+        try:
+            password = generate_pass(args.generate)
+        except ValueError as length_error:
+            return error(str(length_error))
+    else:
+        # The profile password comes from stdin, so it never shows up in the process list
+        password = sys.stdin.readline().rstrip('\n')
+    if password == '':
+        return error("Password can not be empty")
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    exists = vault.get_profile_id(args.name) is not None
+    if not exists:
+        vault.add_new_profile(args.name, password, username=args.username, link=args.link)
+    vault.close_vault()
+    if exists:
+        return error(f'Profile name should be unique. "{args.name}" already exists')
+
+    if args.generate:
+        print(password)
+    return 0
+
+
+def list_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    for profile in vault.iter_vault_content():
+        print(profile.name)
+    vault.close_vault()
+    return 0
+
+
+def search_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    matches = vault.search(args.query, args.limit)
+    vault.close_vault()
+    for name, link in matches:
+        print(f'{name}\t{link or ""}')
+    return 0 if matches else 1
+
+
+def search_all_command(args):
+    from multi_vault import SEARCHED, search_vaults
+
+    matches, statuses = search_vaults(args.query, read_master_password(), args.vaults, limit=args.limit,
+                                      timeout=args.timeout)
+    for vault_name, status in statuses.items():
+        if status != SEARCHED:
+            print(f'{vault_name}: {status}', file=sys.stderr)
+    for vault_name, name, link, _ in matches:
+        print(f'{vault_name}\t{name}\t{link or ""}')
+    return 0 if matches else 1
+
+
+def audit_command(args):
+    from audit import audit_vault
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    report = audit_vault(vault, args.min_bits)
+    vault.close_vault()
+
+    # Names only: the report never shows a password or its score
+    print(f'{len(report.reused)} reused passwords')
+    for names in report.reused:
+        print(f'  {", ".join(names)}')
+    print(f'{len(report.weak)} weak passwords (below {args.min_bits:g} bits)')
+    for name in report.weak:
+        print(f'  {name}')
+    print(f'{report.profiles} profiles audited')
+    return 1 if report.reused or report.weak else 0
+
+
+def rm_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    exists = vault.get_profile_id(args.name) is not None
+    vault.delete_profile(args.name)
+    vault.close_vault()
+    if not exists:
+        return error(f'Profile "{args.name}" does not exist in this vault')
+    return 0
+
+
+def attach_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    try:
+        with open(args.file, 'rb') as file:
+            attachment_id = vault.add_attachment(args.name, args.as_name or os.path.basename(args.file), file)
+    except OSError as attach_error:
+        return error(f'Failed to read "{args.file}": {attach_error}')
+    finally:
+        vault.close_vault()
+
+    if attachment_id is None:
+        return error(f'Profile "{args.name}" does not exist in this vault')
+    print(attachment_id)
+    return 0
+
+
+def attachments_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    attachments = vault.list_attachments(args.name)
+    vault.close_vault()
+    if attachments is None:
+        return error(f'Profile "{args.name}" does not exist in this vault')
+
+    for attachment_id, name, size in attachments:
+        print(f'{attachment_id}\t{name}\t{size}')
+    return 0
+
+
+def fetch_command(args):
+    from vault import AttachmentError
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in vault.iter_attachment(args.id):
+            output.write(chunk)
+    except AttachmentError as fetch_error:
+        return error(str(fetch_error))
+    finally:
+        vault.close_vault()
+        if output is not sys.stdout.buffer:
+            output.close()
+    return 0
+
+
+def export_command(args):
+    vault = open_vault(args, workers=args.workers)
+    if vault is None:
+        return 1
+
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            # Same layout as the basedpass CSV format read by importers.read_csv
+            import csv
+            writer = csv.writer(output)
+            writer.writerow(EXPORT_FIELDS)
+            profiles = vault.get_vault_content() if args.workers > 1 else vault.iter_vault_content()
+            writer.writerows(profiles)
+        else:
+            import json
+            profiles = [dict(zip(PROFILE_FIELDS, profile))
+                        for profile in vault.get_vault_content()]
+            json.dump(profiles, output, ensure_ascii=False, indent=2)
+            output.write('\n')
+    finally:
+        vault.close_vault()
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def import_command(args):
+    from importers import read_profiles
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    try:
+        added, conflicts = vault.add_profiles_bulk(read_profiles(args.file))
+    except (OSError, ValueError) as import_error:
+        return error(f'Failed to import "{args.file}": {import_error}')
+    finally:
+        vault.close_vault()
+
+    for row_number, profile_name, reason in conflicts:
+        print(f'row {row_number} ({profile_name}): {reason}', file=sys.stderr)
+    print(f'{added} profiles have been imported, {len(conflicts)} rows have been skipped')
+    return 0
+
+
+def passgen_command(args):
+    from password_generator import CHARACTER_CLASSES, PasswordPolicy, PasswordSampler
+
+    classes = [CHARACTER_CLASSES[name] for name in args.classes.split(',')]
+    try:
+        sampler = PasswordSampler(args.length, classes, PasswordPolicy(args.min_per_class, args.exclude))
+    except ValueError as policy_error:
+        return error(str(policy_error))
+
+    # Entropy goes to stderr, so stdout holds nothing but the passwords
+    print(f'{sampler.entropy():.1f} bits of entropy per password', file=sys.stderr)
+    for _ in range(args.count):
+        print(sampler.generate())
+    return 0
+
+
+def class_names(value):
+    from password_generator import CHARACTER_CLASSES
+
+    unknown = [name for name in value.split(',') if name not in CHARACTER_CLASSES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown classes {", ".join(unknown)}')
+    return value
+
+
+def calibrate(args):
+    import json
+    from data_encryption import calibrate_kdf
+
+    kdf_params = calibrate_kdf(args.target, args.algorithm)
+    print(json.dumps(kdf_params))
+    return 0
+
+
+def set_kdf(args):
+    import json
+    from data_encryption import calibrate_kdf
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    kdf_params = calibrate_kdf(args.target, args.algorithm)
+    vault.change_kdf(kdf_params)
+    vault.close_vault()
+    print(f'The vault "{args.vault}" has been re-encrypted with {json.dumps(kdf_params)}')
+    return 0
+
+
+def passwd_command(args):
+    # The new password comes from stdin, so it never shows up in the process list
+    new_password = sys.stdin.readline().rstrip('\n')
+    if new_password == '':
+        return error("Password can not be empty")
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    def progress(done, total):
+        print(f'\rRe-encrypted {done}/{total} profiles', end='', file=sys.stderr)
+
+    try:
+        vault.rekey(new_password, progress)
+    finally:
+        vault.close_vault()
+    print(file=sys.stderr)
+    print(f'The master password of "{args.vault}" has been changed')
+    return 0
+
+
+def compact_command(args):
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    try:
+        converted = vault.convert_records()
+        vault.vacuum()
+    finally:
+        vault.close_vault()
+    print(f'{converted} profiles have been converted to the packed format')
+    return 0
+
+
+def backup_command(args):
+    from backups import DeltaError, export_delta
+
+    vault = open_vault(args)
+    if vault is None:
+        return 1
+
+    try:
+        to_seq, changed = export_delta(vault, args.output, args.since)
+    except (OSError, DeltaError) as backup_error:
+        return error(f'Failed to write "{args.output}": {backup_error}')
+    finally:
+        vault.close_vault()
+
+    # The sequence goes to stdout alone, to be passed as --since to the next backup
+    print(f'{changed} changed profiles have been written to "{args.output}"', file=sys.stderr)
+    print(to_seq)
+    return 0
+
+
+def restore_command(args):
+    import sqlite3
+    from backups import DeltaError, restore_deltas
+    from vault import WrongPasswordError
+
+    try:
+        to_seq = restore_deltas(args.vault, read_master_password(), args.deltas)
+    except (OSError, ValueError, KeyError, sqlite3.IntegrityError, DeltaError, WrongPasswordError) as restore_error:
+        return error(f'Failed to restore "{args.vault}": {restore_error}')
+
+    print(f'The vault "{args.vault}" has been restored up to sequence {to_seq}')
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='basedpass password manager. Runs the interactive menu '
+                                                 'when no command is given. Scripted commands read the master '
+                                                 f'password from ${PASSWORD_ENV} or prompt for it')
+    parser.add_argument('--profile', action='store_true',
+                        help='print where the time went (KDF, SQL, encryption, rendering) to stderr on exit')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, also save cProfile statistics to FILE (read them with pstats)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    # Options shared by every command that works on a vault
+    vault_parser = argparse.ArgumentParser(add_help=False)
+    vault_parser.add_argument('--vault', '-v', required=True, help='vault name')
+
+    get_parser = subparsers.add_parser('get', parents=[vault_parser], help='print a field of a profile')
+    get_parser.add_argument('name', help='profile name')
+    get_parser.add_argument('--field', '-f', choices=PROFILE_FIELDS, default='password')
+    get_parser.add_argument('--json', action='store_true', help='print the whole profile as JSON')
+    get_parser.set_defaults(handler=get_command)
+
+    add_parser = subparsers.add_parser('add', parents=[vault_parser],
+                                       help='add a profile, the password is read from stdin')
+    add_parser.add_argument('name', help='profile name')
+    add_parser.add_argument('--username', '-u')
+    add_parser.add_argument('--link', '-l')
+    add_parser.add_argument('--generate', '-g', type=int, metavar='LENGTH',
+                            help='generate a random password of this length and print it')
+    add_parser.set_defaults(handler=add_command)
+
+    list_parser = subparsers.add_parser('list', parents=[vault_parser], help='print all profile names')
+    list_parser.set_defaults(handler=list_command)
+
+    search_parser = subparsers.add_parser('search', parents=[vault_parser],
+                                          help='print profiles whose name or link matches a query')
+    search_parser.add_argument('query')
+    search_parser.add_argument('--limit', type=int, default=10)
+    search_parser.set_defaults(handler=search_command)
+
+    search_all_parser = subparsers.add_parser('search-all',
+                                              help='unlock several vaults in parallel with one master password '
+                                                   'and search all of them')
+    search_all_parser.add_argument('query')
+    search_all_parser.add_argument('--vaults', nargs='+', metavar='VAULT', help='vault names (default: all vaults)')
+    search_all_parser.add_argument('--limit', type=int, default=10)
+    search_all_parser.add_argument('--timeout', type=float, default=30.0,
+                                   help='seconds to wait for all vaults, slower ones are skipped')
+    search_all_parser.set_defaults(handler=search_all_command)
+
+    audit_parser = subparsers.add_parser('audit', parents=[vault_parser],
+                                         help='list the profiles with reused or weak passwords, exits with 1 '
+                                              'when there are any')
+    audit_parser.add_argument('--min-bits', type=float, default=60,
+                              help='passwords with a lower strength estimate are weak (default: 60)')
+    audit_parser.set_defaults(handler=audit_command)
+
+    rm_parser = subparsers.add_parser('rm', parents=[vault_parser], help='delete a profile')
+    rm_parser.add_argument('name', help='profile name')
+    rm_parser.set_defaults(handler=rm_command)
+
+    attach_parser = subparsers.add_parser('attach', parents=[vault_parser],
+                                          help='store a file next to a profile and print its attachment id')
+    attach_parser.add_argument('name', help='profile name')
+    attach_parser.add_argument('file')
+    attach_parser.add_argument('--as', dest='as_name', metavar='NAME', help='attachment name (default: file name)')
+    attach_parser.set_defaults(handler=attach_command)
+
+    attachments_parser = subparsers.add_parser('attachments', parents=[vault_parser],
+                                               help='print the id, name and size of the attachments of a profile')
+    attachments_parser.add_argument('name', help='profile name')
+    attachments_parser.set_defaults(handler=attachments_command)
+
+    fetch_parser = subparsers.add_parser('fetch', parents=[vault_parser], help='write out an attachment')
+    fetch_parser.add_argument('id', type=int, help='attachment id')
+    fetch_parser.add_argument('--output', '-o', help='output file (default: stdout)')
+    fetch_parser.set_defaults(handler=fetch_command)
+
+    export_parser = subparsers.add_parser('export', parents=[vault_parser], help='export all profiles')
+    export_parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    export_parser.add_argument('--output', '-o', help='output file (default: stdout)')
+    export_parser.add_argument('--workers', type=int, default=1, help='decrypt on this many processes')
+    export_parser.set_defaults(handler=export_command)
+
+    import_parser = subparsers.add_parser('import', parents=[vault_parser],
+                                          help='import a Bitwarden/KeePass CSV or JSON export')
+    import_parser.add_argument('file', help='path to the export')
+    import_parser.set_defaults(handler=import_command)
+
+    passgen_parser = subparsers.add_parser('passgen', help='print random passwords, one per line')
+    passgen_parser.add_argument('--count', '-n', type=int, default=1)
+    passgen_parser.add_argument('--length', '-l', type=int, default=20)
+    passgen_parser.add_argument('--classes', '-c', type=class_names, default='letters,digits,special',
+                                help='comma separated: lower, upper, letters, digits, special')
+    passgen_parser.add_argument('--min-per-class', type=int, default=1)
+    passgen_parser.add_argument('--exclude', default='', help='characters to leave out')
+    passgen_parser.set_defaults(handler=passgen_command)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='pick KDF parameters for this host')
+    calibrate_parser.add_argument('--target', type=float, default=0.5, help='unlock time in seconds')
+    calibrate_parser.add_argument('--algorithm', choices=KDF_ALGORITHMS, default='pbkdf2')
+    calibrate_parser.set_defaults(handler=calibrate)
+
+    set_kdf_parser = subparsers.add_parser('set-kdf', parents=[vault_parser],
+                                           help='re-encrypt a vault with calibrated KDF parameters')
+    set_kdf_parser.add_argument('--target', type=float, default=0.5, help='unlock time in seconds')
+    set_kdf_parser.add_argument('--algorithm', choices=KDF_ALGORITHMS, default='pbkdf2')
+    set_kdf_parser.set_defaults(handler=set_kdf)
+
+    passwd_parser = subparsers.add_parser('passwd', parents=[vault_parser],
+                                          help='change the master password, the new one is read from stdin')
+    passwd_parser.set_defaults(handler=passwd_command)
+
+    compact_parser = subparsers.add_parser('compact', parents=[vault_parser],
+                                           help='convert old profiles to the packed format and shrink the file')
+    compact_parser.set_defaults(handler=compact_command)
+
+    backup_parser = subparsers.add_parser('backup', parents=[vault_parser],
+                                          help='write the changes since a sequence number to an encrypted delta '
+                                               'and print the sequence number to continue from')
+    backup_parser.add_argument('--output', '-o', required=True, help='delta file')
+    backup_parser.add_argument('--since', type=int, default=0, help='0 writes a full backup (default)')
+    backup_parser.set_defaults(handler=backup_command)
+
+    restore_parser = subparsers.add_parser('restore', parents=[vault_parser],
+                                           help='replay a chain of deltas into a vault, creating it if needed')
+    restore_parser.add_argument('deltas', nargs='+', help='delta files, oldest first')
+    restore_parser.set_defaults(handler=restore_command)
+
+    return parser.parse_args(argv)
+
+
+def run_profiled(args, run):
+    # Instrumentation is imported only here, it loads sqlite3
+    import time
+    import instrumentation
+
+    instrumentation.enable()
+    profiler = None
+    if args.profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        return run(args)
+    finally:
+        wall_seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_output)
+        print(instrumentation.format_breakdown(instrumentation.snapshot(), wall_seconds), file=sys.stderr)
+
+
+def run_menu(args):
+    from menu_options import main_menu
 
-def main():
     print(r'''
                _                        _   ____                             
               | |__   __ _ ___  ___  __| | |  _ \ __ _ ___ ___               
@@ -10,7 +553,28 @@ def main():
               |_.__/ \__,_|___/\___|\__,_| |_|   \__,_|___/___/              
 ''')
     main_menu()
+    return 0
+
+
+def run_command(args, run):
+    try:
+        return run(args)
+    except Exception as run_error:
+        # A locked vault can only be reported once the command has imported vault
+        vault_module = sys.modules.get('vault')
+        if vault_module is None or not isinstance(run_error, vault_module.VaultLockedError):
+            raise
+        error(str(run_error))
+        return LOCKED_EXIT_CODE
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    run = args.handler if args.command is not None else run_menu
+    if args.profile:
+        return run_profiled(args, lambda args: run_command(args, run))
+    return run_command(args, run)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
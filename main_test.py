@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from vault_test import VaultDirTestCase
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+# Modules that must not be loaded by commands that do not touch a vault
+HEAVY_MODULES = ('cryptography', 'sqlite3', 'tabulate', 'pyperclip', 'vault', 'data_encryption')
+# Generous bound for "python main.py --help" on top of a bare interpreter start
+MAX_HELP_IMPORT_SECONDS = 0.5
+
+
+def run_main(*args, password='123', stdin=''):
+    environment = dict(os.environ, BASEDPASS_PASSWORD=password)
+    return subprocess.run([sys.executable, MAIN_PATH, *args], input=stdin, capture_output=True, text=True,
+                          env=environment, encoding='utf-8')
+
+
+# Parse the output of "python -X importtime": returns [(module, cumulative microseconds, nesting depth)]
+def import_times(*args):
+    result = subprocess.run([sys.executable, '-X', 'importtime', MAIN_PATH, *args], capture_output=True, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        # Nested imports are indented by two spaces per level
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        times.append((module.strip(), int(cumulative), depth))
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_help_does_not_import_heavy_modules(self):
+        times = import_times('--help')
+        self.assertEqual([module for module, _, _ in times if module.split('.')[0] in HEAVY_MODULES], [])
+
+        # Top level imports only, nested ones are already counted in their parents' cumulative time
+        total_seconds = sum(cumulative for _, cumulative, depth in times if depth == 0) / 1e6
+        print(f'\n"main.py --help" import time: {total_seconds * 1000:.1f} ms')
+        self.assertLess(total_seconds, MAX_HELP_IMPORT_SECONDS)
+
+
+class TestPassgen(unittest.TestCase):
+    def test_passgen(self):
+        result = run_main('passgen', '-n', '50', '-l', '16', '-c', 'lower,digits')
+        passwords = result.stdout.split()
+        self.assertEqual(len(passwords), 50)
+        self.assertTrue(all(len(password) == 16 and password.isalnum() for password in passwords))
+        self.assertIn('bits of entropy', result.stderr)
+
+        self.assertEqual(run_main('passgen', '-l', '1', '-c', 'lower,digits').returncode, 1)
+
+
+class TestScriptedCommands(VaultDirTestCase):
+    def test_get_and_list(self):
+        self.assertEqual(run_main('get', 'vk', '--vault', 'test').stdout, 'qwerty123\n')
+        self.assertEqual(run_main('get', 'steam', '-v', 'test', '-f', 'username').stdout, 'playerone\n')
+        self.assertEqual(run_main('list', '-v', 'test').stdout.split(), ['gmail', 'vk', 'steam', 'ozon', 'Яндекс'])
+
+    def test_add_and_rm(self):
+        result = run_main('add', 'github', '-v', 'test', '-u', 'octocat', stdin='secret\n')
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(run_main('get', 'github', '-v', 'test').stdout, 'secret\n')
+        self.assertEqual(run_main('add', 'github', '-v', 'test', stdin='other\n').returncode, 1)
+
+        self.assertEqual(run_main('rm', 'github', '-v', 'test').returncode, 0)
+        self.assertEqual(run_main('get', 'github', '-v', 'test').returncode, 1)
+
+    def test_add_generated(self):
+        self.assertEqual(run_main('add', 'github', '-v', 'test', '-g', '20').returncode, 0)
+        self.assertEqual(len(run_main('get', 'github', '-v', 'test').stdout), 21)
+        for length in ('2', '300'):
+            result = run_main('add', 'gitlab', '-v', 'test', '-g', length)
+            self.assertEqual(result.returncode, 1)
+            self.assertNotIn('Traceback', result.stderr)
+        self.assertEqual(run_main('get', 'gitlab', '-v', 'test').returncode, 1)
+
+    def test_not_a_vault(self):
+        open(os.path.join('vaults', 'typo.db'), 'wb').close()
+        result = run_main('get', 'vk', '-v', 'typo')
+        self.assertEqual((result.returncode, result.stderr), (1, '"typo" is not a basedpass vault\n'))
+
+    def test_export(self):
+        result = run_main('export', '-v', 'test')
+        self.assertEqual(result.stdout.splitlines()[:2], ['Name,Username,Password,Link',
+                                                          'gmail,username@gmail.com,"6""T[~$v!vJf`<g/ea;0)bz",gmail.com'])
+
+    def test_passwd(self):
+        self.assertEqual(run_main('passwd', '-v', 'test', stdin='changed\n').returncode, 0)
+        self.assertEqual(run_main('get', 'vk', '-v', 'test', password='changed').stdout, 'qwerty123\n')
+        self.assertEqual(run_main('get', 'vk', '-v', 'test').returncode, 1)
+
+    def test_compact(self):
+        result = run_main('compact', '-v', 'test')
+        self.assertEqual(result.stdout, '5 profiles have been converted to the packed format\n')
+        self.assertEqual(run_main('get', 'steam', '-v', 'test', '--json').stdout,
+                         '{"name": "steam", "username": "playerone", "password": "7JcS%<r<!Nn-]&c([87zT", "link": null}\n')
+
+    def test_errors(self):
+        self.assertEqual(run_main('list', '-v', 'test', password='wrong').returncode, 1)
+        self.assertEqual(run_main('list', '-v', 'missing').returncode, 1)
+        self.assertFalse(os.path.exists(os.path.join('vaults', 'missing.db')))
+
+    def test_locked_exit_code(self):
+        import main
+        from vault import VaultLockedError
+
+        def locked_command(args):
+            raise VaultLockedError('Vault "test" is locked by another process. Try again later')
+        self.assertEqual(main.run_command(None, locked_command), main.LOCKED_EXIT_CODE)
+
+
+if __name__ == '__main__':
+    unittest.main()
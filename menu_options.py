@@ -1,10 +1,10 @@
-import sqlite3
-
 from password_generator import generate_pass
 from secrets import choice
 import pyperclip
 from tabulate import tabulate
-from vault import Vault
+from importers import read_profiles
+from instrumentation import instrumented
+from vault import NotAVaultError, Vault, VaultExistsError, VaultLockedError, VaultNotFoundError
 
 MAIN_MENU = '''\nMenu options:
     [C] - Create a new vault
@@ -14,6 +14,7 @@ VAULT_MENU = '''\nVault options:
     [A] - Add a new profile
     [F] - Find a profile
     [S] - Show all data
+    [I] - Import profiles from a file
     [E] - Exit'''
 PROFILE_MENU = '''\nProfile options:
     [U] - Update profile
@@ -22,22 +23,21 @@ PROFILE_MENU = '''\nProfile options:
 PASSWORD_MENU = '''Options:
     [R] - Generate random password
     [M] - Manual input'''
+PAGE_MENU = '''Page options:
+    [N] - Next page
+    [P] - Previous page
+    [R] - Reveal/hide passwords
+    [E] - Exit'''
 FIELDS = ['Name', 'Username', 'Password', 'Link']
-
-PROFILE_NAME_IDX = 0
-USERNAME_IDX = 1
-PASSWORD_IDX = 2
-LINK_IDX = 3
+PAGE_SIZE = 20
+# Shown instead of the passwords in listings. Masking only keeps passwords off the screen: a packed record
+# (every row written since schema version 3) is decrypted as a whole, its password included
+PASSWORD_MASK = '********'
 
 
 # Check if new profile name is unique for vault
 def is_in_db(vault, new_name):
-    names = vault.extract_all_profile_names()
-
-    if new_name in names.values():
-        return True
-
-    return False
+    return vault.get_profile_id(new_name) is not None
 
 
 # Set a password
@@ -105,19 +105,40 @@ def make_new_profile(vault):
         print("The new profile has been successfully added")
 
 
+# Pick a profile among the search results for query. Returns None if nothing is picked
+def choose_match(vault, query):
+    matches = vault.search(query)
+    if not matches:
+        print("Profile does not exist in this vault")
+        return None
+
+    print(f'Profile "{query}" does not exist. Similar profiles:')
+    for number, (name, link) in enumerate(matches, start=1):
+        print(f'    [{number}] - {name}' + (f' ({link})' if link else ''))
+
+    while True:
+        option = input("Choose a profile (to cancel - press Enter): ")
+        if option == '':
+            return None
+        if option.isdigit() and 1 <= int(option) <= len(matches):
+            return matches[int(option) - 1][0]
+        print("Wrong input. Try again")
+
+
 # Find a profile in the vault
 def find_profile(vault):
     profile_name = input("Enter a profile name: ")
 
-    # Check if profile_name exists in the vault
+    # Check if profile_name exists in the vault, otherwise offer the closest matches
     if not is_in_db(vault, profile_name):
-        print("Profile does not exist in this vault")
-        return
+        profile_name = choose_match(vault, profile_name)
+        if profile_name is None:
+            return
 
     found_profile = vault.get_profile(profile_name)
 
-    profile_name = found_profile[PROFILE_NAME_IDX]
-    password = found_profile[PASSWORD_IDX]
+    profile_name = found_profile.name
+    password = found_profile.password
 
     if (profile_name is None or profile_name == '') or (password is None or password == ''):
         print("Error occurred whilst trying to extract the profile data.")
@@ -132,11 +153,76 @@ def find_profile(vault):
         profile_menu(vault, profile_name)
 
 
+# Import profiles from a CSV/JSON export of another password manager
+def import_profiles(vault):
+    path = input("Enter a path to the CSV or JSON export: ")
+
+    try:
+        added, conflicts = vault.add_profiles_bulk(read_profiles(path))
+    except (OSError, ValueError) as error:
+        print(f'Failed to import "{path}": {error}')
+        return
+
+    print(f'{added} profiles have been imported')
+    if conflicts:
+        print(f'{len(conflicts)} rows have been skipped:')
+        for row_number, profile_name, reason in conflicts:
+            print(f'    row {row_number} ({profile_name}): {reason}')
+
+
 # Display data from the vault
+@instrumented('render')
 def display_content(data):
     print(tabulate(data, headers=FIELDS, tablefmt='fancy_grid'))
 
 
+# Rows of a listing. Legacy rows decrypt only the fields that are shown, packed records decrypt all of them
+def listing_rows(profiles, reveal_passwords=False):
+    return [[profile.name, profile.username, profile.password if reveal_passwords else PASSWORD_MASK, profile.link]
+            for profile in profiles]
+
+
+# Display the vault content page by page
+def display_pages(vault, page_size=PAGE_SIZE):
+    # Ids after which every visited page starts. The last one is the current page
+    page_starts = [0]
+    reveal_passwords = False
+
+    while True:
+        profiles, next_after_id = vault.get_vault_page(page_starts[-1], page_size)
+        if not profiles and len(page_starts) == 1:
+            print("The vault is empty")
+            return
+
+        print(f'Page {len(page_starts)}')
+        display_content(listing_rows(profiles, reveal_passwords))
+
+        print(PAGE_MENU)
+        option = input("Choose an option: ").upper()
+
+        match option:
+            case 'N':
+                if next_after_id is None:
+                    print("\nThis is the last page")
+                else:
+                    page_starts.append(next_after_id)
+
+            case 'P':
+                if len(page_starts) == 1:
+                    print("\nThis is the first page")
+                else:
+                    page_starts.pop()
+
+            case 'R':
+                reveal_passwords = not reveal_passwords
+
+            case 'E':
+                return
+
+            case _:
+                print("\nWrong input. Try again")
+
+
 # Change existing profile in the vault
 def change_profile(vault, profile_name, profile_data):
     print("Updating a profile...")
@@ -144,19 +230,19 @@ def change_profile(vault, profile_name, profile_data):
     # Username update (If Enter is pressed leave the same value)
     username = input("Enter a new username (to skip - press Enter): ")
     if username == '':
-        username = profile_data[USERNAME_IDX]
+        username = profile_data.username
 
     # Password update
     password = input("Entering a new password [Enter] - to skip, [Any key] - to continue: ")
     if password == '':
-        password = profile_data[PASSWORD_IDX]
+        password = profile_data.password
     else:
         password = set_password()
 
     # Link update
     link = input("Enter a new link to the service (to skip - press Enter): ")
     if link == '':
-        link = profile_data[LINK_IDX]
+        link = profile_data.link
 
     vault.update_profile(profile_name, username=username, password=password, link=link)
     print(f'The profile "{profile_name}" has been successfully updated')
@@ -204,31 +290,40 @@ def vault_menu(vault):
         print(VAULT_MENU)
         option = input("Choose an option: ").upper()
 
-        match option:
-            # Exit the vault to the main menu
-            case 'E':
-                vault.close_vault()
-                print("\nExiting the vault...")
-                break
+        # A write that could not get the lock leaves the vault as it was, the user can simply try again
+        try:
+            match option:
+                # Exit the vault to the main menu
+                case 'E':
+                    vault.close_vault()
+                    print("\nExiting the vault...")
+                    break
 
-            # Add a new profile to the opened vault
-            case 'A':
-                print()
-                make_new_profile(vault)
+                # Add a new profile to the opened vault
+                case 'A':
+                    print()
+                    make_new_profile(vault)
 
-            # Find a profile in the opened vault
-            case 'F':
-                print()
-                find_profile(vault)
+                # Find a profile in the opened vault
+                case 'F':
+                    print()
+                    find_profile(vault)
 
-            # Show all data in the opened vault
-            case 'S':
-                print()
-                display_content(vault.get_vault_content())
+                # Show all data in the opened vault
+                case 'S':
+                    print()
+                    display_pages(vault)
 
-            # Wrong user input
-            case _:
-                print("\nWrong input. Try again")
+                # Import profiles from another password manager
+                case 'I':
+                    print()
+                    import_profiles(vault)
+
+                # Wrong user input
+                case _:
+                    print("\nWrong input. Try again")
+        except VaultLockedError as error:
+            print(f'\n{error}')
 
 
 # Main (starting) menu
@@ -242,30 +337,40 @@ def main_menu():
             case 'C':
                 vault_name = input("Enter the new vault name: ")
                 master_password = input(f'Enter master password for {vault_name}: ')
-                vault = Vault(vault_name, master_password)
+                # Interactive sessions read from an in-memory copy of the vault, writes go to the file as well
+                vault = Vault(vault_name, master_password, snapshot=True)
                 try:
                     vault.create_vault()
+                except (VaultExistsError, VaultLockedError) as error:
+                    print(error)
+                    vault.close_vault()
+                    continue
 
-                    print(f'The vault "{vault_name}" has been successfully created')
-                    vault_menu(vault)
-                except sqlite3.OperationalError:
-                    print(f'Vault "{vault_name}" already exists')
+                print(f'The vault "{vault_name}" has been successfully created')
+                vault_menu(vault)
 
             # Open an existing vault
             case 'O':
                 vault_name = input("Enter the vault name: ")
                 master_password = input("Enter master password: ")
-                vault = Vault(vault_name, master_password)
+                vault = Vault(vault_name, master_password, snapshot=True)
 
                 try:
-                    if vault.open_vault():
-                        print(f'The vault "{vault_name}" has been successfully opened')
-                        vault_menu(vault)
-                    else:
-                        print(f'Wrong master password! Failed to access "{vault_name}"')
-                        vault.close_vault()
-                except sqlite3.OperationalError:
+                    opened = vault.open_vault()
+                except VaultNotFoundError:
                     print(f'Vault "{vault_name}" does not exist. Try creating it first')
+                    continue
+                except (NotAVaultError, VaultLockedError) as error:
+                    print(error)
+                    vault.close_vault()
+                    continue
+
+                if opened:
+                    print(f'The vault "{vault_name}" has been successfully opened')
+                    vault_menu(vault)
+                else:
+                    print(f'Wrong master password! Failed to access "{vault_name}"')
+                    vault.close_vault()
 
             # Quit the app
             case 'Q':
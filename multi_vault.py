@@ -0,0 +1,80 @@
+import glob
+import multiprocessing
+import os
+import time
+
+from search_index import DEFAULT_LIMIT
+from vault import Vault
+
+# Unlock and search many vaults at once. Every vault is handled by its own worker process, which runs the key
+# derivation and decrypts the names and links for the search index, so the wall-clock time is close to that of
+# the slowest vault instead of the sum of all of them. Vaults not done by the deadline are reported and skipped
+
+# Statuses of a vault in the results
+SEARCHED = 'searched'
+WRONG_PASSWORD = 'wrong password'
+TIMED_OUT = 'timed out'
+
+DEFAULT_TIMEOUT = 30.0
+
+
+def list_vaults(vaults_dir=None):
+    # Names of the vaults in vaults_dir ('vaults' in the working directory by default)
+    folder_path = vaults_dir or os.path.join(os.getcwd(), 'vaults')
+    return sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(folder_path, '*.db')))
+
+
+def search_vault(vault_name, password, query, limit, vaults_dir):
+    # Runs in a worker process. Returns (status, [(score, name, link)])
+    vault = Vault(vault_name, password, vaults_dir=vaults_dir)
+    try:
+        if not vault.open_vault():
+            return WRONG_PASSWORD, []
+        return SEARCHED, vault.search_scored(query, limit)
+    finally:
+        vault.close_vault()
+
+
+def search_vaults(query, password, vault_names=None, vaults_dir=None, limit=DEFAULT_LIMIT, timeout=DEFAULT_TIMEOUT,
+                  workers=None):
+    # Search vault_names (every vault in vaults_dir by default) with one master password.
+    # password may also be a dict of vault name -> password.
+    # Returns the merged matches, best first, as (vault name, profile name, link, score), at most limit of them,
+    # and the status of every vault: SEARCHED, WRONG_PASSWORD, TIMED_OUT or the error message
+    if vault_names is None:
+        vault_names = list_vaults(vaults_dir)
+    if not vault_names:
+        return [], {}
+
+    workers = workers or min(len(vault_names), os.cpu_count() or 1)
+    deadline = time.monotonic() + timeout
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = {}
+        for vault_name in vault_names:
+            vault_password = password.get(vault_name) if isinstance(password, dict) else password
+            pending[vault_name] = pool.apply_async(search_vault,
+                                                   (vault_name, vault_password, query, limit, vaults_dir))
+
+        statuses = {}
+        matches = []
+        for vault_name, result in pending.items():
+            try:
+                status, found = result.get(max(0.0, deadline - time.monotonic()))
+            except multiprocessing.TimeoutError:
+                statuses[vault_name] = TIMED_OUT
+                continue
+            except Exception as error:
+                statuses[vault_name] = f'error: {error}'
+                continue
+
+            statuses[vault_name] = status
+            matches.extend((vault_name, name, link, score) for score, name, link in found)
+    finally:
+        # Workers still deriving keys after the deadline are killed instead of waited for
+        pool.terminate()
+        pool.join()
+
+    # Same order as within one vault: better score, then shorter name
+    matches.sort(key=lambda match: (-match[3], len(match[1]), match[1], match[0]))
+    return matches[:limit], statuses
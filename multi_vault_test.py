@@ -0,0 +1,58 @@
+import json
+import time
+import unittest
+
+from data_encryption import new_kdf_params
+from main_test import run_main
+from multi_vault import SEARCHED, TIMED_OUT, WRONG_PASSWORD, list_vaults, search_vaults
+from vault import Vault
+from vault_test import VaultDirTestCase
+
+
+class TestMultiVault(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, profiles in [('work', ['github', 'gitlab']), ('home', ['steam', 'github-personal'])]:
+            vault = Vault(name, '123', use_agent=False)
+            vault.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+            vault.add_profiles_bulk([(profile, None, 'pw', f'{profile}.com') for profile in profiles])
+            vault.close_vault()
+
+    def test_list_vaults(self):
+        self.assertEqual(list_vaults(), ['emptyvault', 'home', 'test', 'work'])
+
+    def test_search_vaults(self):
+        matches, statuses = search_vaults('git', '123')
+        self.assertEqual(statuses, {'emptyvault': WRONG_PASSWORD, 'home': SEARCHED, 'test': SEARCHED,
+                                    'work': SEARCHED})
+        self.assertEqual([(vault_name, name) for vault_name, name, _, _ in matches],
+                         [('work', 'github'), ('work', 'gitlab'), ('home', 'github-personal')])
+
+        matches, statuses = search_vaults('vk', {'test': '123', 'emptyvault': 'qwerty'}, ['test', 'emptyvault'])
+        self.assertEqual(matches[0][:3], ('test', 'vk', 'vk.com'))
+        self.assertEqual(set(statuses.values()), {SEARCHED})
+
+    def test_deadline(self):
+        # A vault whose key derivation takes far longer than the deadline
+        slow = Vault('slow', '123', use_agent=False)
+        slow.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+        with slow.transaction() as cursor:
+            cursor.execute("UPDATE meta SET value = ? WHERE key = 'kdf'",
+                           (json.dumps(new_kdf_params('pbkdf2', iterations=100000000)),))
+        slow.close_vault()
+
+        start = time.monotonic()
+        matches, statuses = search_vaults('github', '123', ['slow', 'work'], timeout=1.0, workers=2)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(statuses, {'slow': TIMED_OUT, 'work': SEARCHED})
+        self.assertEqual(matches[0][:2], ('work', 'github'))
+
+    def test_command(self):
+        result = run_main('search-all', 'github', '--vaults', 'work', 'home', 'emptyvault')
+        self.assertEqual(result.stdout.splitlines(), ['work\tgithub\tgithub.com',
+                                                      'home\tgithub-personal\tgithub-personal.com'])
+        self.assertEqual(result.stderr, 'emptyvault: wrong password\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
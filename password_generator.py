@@ -1,42 +1,165 @@
+import math
 import secrets
 import string
+from collections import namedtuple
 
 letters = string.ascii_letters
 digits = string.digits
 special_chars = string.punctuation
 
+# Character classes by name, as accepted by the passgen command
+CHARACTER_CLASSES = {
+    'lower': string.ascii_lowercase,
+    'upper': string.ascii_uppercase,
+    'letters': letters,
+    'digits': digits,
+    'special': special_chars,
+}
+DEFAULT_CLASSES = (letters, digits, special_chars)
+# Longest password the sampler accepts. Its setup takes about 0.2 s at this length and grows with the cube of it
+MAX_PASSWORD_LENGTH = 256
+
+# min_per_class - every class appears at least this many times
+# exclude - characters that are never used, e.g. look-alikes such as 'l1O0'
+PasswordPolicy = namedtuple('PasswordPolicy', ['min_per_class', 'exclude'], defaults=(1, ''))
+
 
 def if_intersect(str1, str2):
     # returns True if at least one character from str2 is in str1
     return any(character in str1 for character in str2)
 
 
-def generate_pass(length, characters=(letters, digits, special_chars,)):
-    # Create pool of characters
-    alphabet = ''
-    for element in characters:
-        alphabet += element
+class PasswordSampler:
+    # Draws passwords uniformly from all strings of the given length that satisfy the policy.
+    #
+    # Every valid password is given a number in [0, total). A password takes a single secrets.randbelow(total)
+    # call, and the number is decoded into the password, so class coverage holds by construction
+    # and nothing is ever generated and thrown away. Classes are decoded one after another: how many characters
+    # of the class the password has, which of the free positions they take, then the characters themselves.
+    # Only the counts of valid strings per (free positions, class) are kept, a table of length x classes entries
+    def __init__(self, length, classes=DEFAULT_CLASSES, policy=PasswordPolicy()):
+        # Classes are made disjoint and cleaned of excluded characters, so each character belongs to one class
+        seen = set(policy.exclude)
+        self.classes = []
+        for characters in classes:
+            unique = ''.join(dict.fromkeys(character for character in characters if character not in seen))
+            seen.update(unique)
+            if unique == '':
+                raise ValueError(f'Character class "{characters}" is empty after removing excluded characters')
+            self.classes.append(unique)
+
+        if length < policy.min_per_class * len(self.classes):
+            raise ValueError(f'Length {length} is too short to include {policy.min_per_class} characters '
+                             f'of each of {len(self.classes)} classes')
+        if length > MAX_PASSWORD_LENGTH:
+            raise ValueError(f'Length {length} is longer than the maximum of {MAX_PASSWORD_LENGTH}')
+
+        self.length = length
+        self.min_per_class = policy.min_per_class
+        # (remaining, class_idx) -> number of valid strings, filled in on demand
+        self.counts = {}
+        self.total = self.count(length, 0)
+
+    def count_range(self, remaining, class_idx):
+        # Possible numbers of characters of class class_idx when remaining positions are free
+        if class_idx == len(self.classes) - 1:
+            return range(remaining, remaining + 1) if remaining >= self.min_per_class else range(0)
+        later_classes = len(self.classes) - class_idx - 1
+        return range(self.min_per_class, remaining - self.min_per_class * later_classes + 1)
+
+    def count(self, remaining, class_idx):
+        # Strings of length remaining over the classes from class_idx on, each used at least min_per_class times
+        if class_idx == len(self.classes):
+            return 1 if remaining == 0 else 0
+        key = (remaining, class_idx)
+        found = self.counts.get(key)
+        if found is None:
+            size = len(self.classes[class_idx])
+            found = sum(math.comb(remaining, count) * size ** count * self.count(remaining - count, class_idx + 1)
+                        for count in self.count_range(remaining, class_idx))
+            self.counts[key] = found
+        return found
+
+    def entropy(self):
+        # Passwords are uniform over the valid ones, so this is the exact entropy in bits
+        return math.log2(self.total) if self.total > 1 else 0.0
+
+    def decode(self, number):
+        password = [None] * self.length
+        free_positions = list(range(self.length))
+        for class_idx, class_characters in enumerate(self.classes):
+            remaining = len(free_positions)
+            size = len(class_characters)
+
+            # Number of characters of this class
+            for count in self.count_range(remaining, class_idx):
+                rest_total = self.count(remaining - count, class_idx + 1)
+                block = math.comb(remaining, count) * size ** count * rest_total
+                if number < block:
+                    break
+                number -= block
+
+            # What is left: the rest of the password, the characters of this class, then their positions
+            number, rest_number = divmod(number, rest_total)
+            position_rank, character_number = divmod(number, size ** count)
 
-    password = ""
-    while True:
-        for i in range(length):
-            password += "".join(secrets.choice(alphabet))
+            # Unrank the combination of count free positions, choosing or skipping them in order
+            chosen = []
+            to_choose = count
+            # Combinations of the free positions after the current one that hold the rest of the chosen ones
+            combinations = math.comb(remaining - 1, to_choose - 1) if to_choose else 0
+            for index, position in enumerate(free_positions):
+                if to_choose == 0:
+                    break
+                left = remaining - index - 1
+                if position_rank < combinations:
+                    chosen.append(position)
+                    to_choose -= 1
+                    combinations = combinations * to_choose // left if left else 0
+                else:
+                    position_rank -= combinations
+                    combinations = combinations * (left - to_choose + 1) // left if left else 0
 
-        # Ensures all instances of character sets from alphabet are present in password
-        for element in characters:
-            if not if_intersect(element, password):
-                password = ""
-                continue
-        break
+            for position in chosen:
+                character_number, digit = divmod(character_number, size)
+                password[position] = class_characters[digit]
+            chosen_set = set(chosen)
+            free_positions = [position for position in free_positions if position not in chosen_set]
+            number = rest_number
 
-    return password
+        return ''.join(password)
+
+    def generate(self):
+        return self.decode(secrets.randbelow(self.total)) if self.total > 1 else self.decode(0)
+
+
+def iter_passwords(n, length, classes=DEFAULT_CLASSES, policy=PasswordPolicy()):
+    sampler = PasswordSampler(length, classes, policy)
+    for _ in range(n):
+        yield sampler.generate()
+
+
+def generate_passwords(n, length, classes=DEFAULT_CLASSES, policy=PasswordPolicy()):
+    return list(iter_passwords(n, length, classes, policy))
+
+
+def password_entropy(length, classes=DEFAULT_CLASSES, policy=PasswordPolicy()):
+    return PasswordSampler(length, classes, policy).entropy()
+
+
+def generate_pass(length, characters=(letters, digits, special_chars,)):
+    # Every character set from characters is present in the password
+    return PasswordSampler(length, characters).generate()
 
 
 def generate_random_string(length):
     alphabet = letters + digits + special_chars
-    result = ""
 
+    # One random number for the whole string, read as digits in base len(alphabet)
+    number = secrets.randbelow(len(alphabet) ** length) if length > 0 else 0
+    result = []
     for i in range(length):
-        result += "".join(secrets.choice(alphabet))
+        number, digit = divmod(number, len(alphabet))
+        result.append(alphabet[digit])
 
-    return result
+    return ''.join(result)
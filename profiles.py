@@ -0,0 +1,85 @@
+# Field order of a profile, the same as the vault table columns
+PROFILE_FIELDS = ('name', 'username', 'password', 'link')
+
+# Placeholder of a field that has not been decrypted yet
+NOT_DECRYPTED = object()
+
+
+class Profile:
+    # A profile read from the vault. It keeps the ciphertext and decrypts a field the first time it is used,
+    # so a listing that never touches the passwords never decrypts them (for legacy rows, where every field
+    # is a separate token; a packed record is decrypted as a whole on first use).
+    # Behaves like the [name, username, password, link] list it replaces: it can be indexed, iterated
+    # and compared with lists, which decrypts every field
+    __slots__ = ('id', 'cipher', 'record', 'tokens', 'values')
+
+    def __init__(self, profile_id, cipher, record, tokens):
+        self.id = profile_id
+        self.cipher = cipher
+        # Packed record, or None for a legacy row with one token per field in tokens
+        self.record = record
+        self.tokens = tokens
+        self.values = [NOT_DECRYPTED] * len(PROFILE_FIELDS)
+
+    @classmethod
+    def from_stored(cls, profile_id, cipher, row):
+        # row holds the stored columns: (record, name, username, password, link)
+        return cls(profile_id, cipher, row[0], row[1:])
+
+    @classmethod
+    def from_values(cls, profile_id, values):
+        # Profile with already decrypted fields
+        profile = cls(profile_id, None, None, None)
+        profile.values = list(values)
+        return profile
+
+    def field(self, index):
+        value = self.values[index]
+        if value is not NOT_DECRYPTED:
+            return value
+
+        if self.record is not None:
+            self.values = self.cipher.decrypt_record(self.record)
+            self.record = None
+        else:
+            token = self.tokens[index]
+            self.values[index] = None if token is None else self.cipher.decrypt(token)
+        return self.values[index]
+
+    @property
+    def name(self):
+        return self.field(0)
+
+    @property
+    def username(self):
+        return self.field(1)
+
+    @property
+    def password(self):
+        return self.field(2)
+
+    @property
+    def link(self):
+        return self.field(3)
+
+    def __len__(self):
+        return len(PROFILE_FIELDS)
+
+    def __iter__(self):
+        return (self.field(index) for index in range(len(PROFILE_FIELDS)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return self.field(range(len(PROFILE_FIELDS))[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (Profile, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        # Never shows the password
+        return f'Profile(id={self.id}, name={self.name!r})'
@@ -0,0 +1,133 @@
+import heapq
+from collections import Counter, defaultdict
+
+# Ranking of a match, higher is better. Fuzzy matches score their trigram similarity (at most 1.0),
+# which is below every substring match
+EXACT_SCORE = 4.0
+PREFIX_SCORE = 3.0
+NAME_SUBSTRING_SCORE = 2.0
+LINK_SUBSTRING_SCORE = 1.5
+# Share of the query trigrams a fuzzy match must contain
+MIN_SIMILARITY = 0.4
+DEFAULT_LIMIT = 10
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def add_postings(postings, text, profile_id):
+    for trigram in trigrams(text):
+        postings[trigram].add(profile_id)
+
+
+def remove_postings(postings, text, profile_id):
+    for trigram in trigrams(text):
+        posting = postings.get(trigram)
+        if posting is not None:
+            posting.discard(profile_id)
+            if not posting:
+                del postings[trigram]
+
+
+# Ids present in every posting of the query trigrams, i.e. the only entries that can contain the query
+def intersect(postings, query_trigrams):
+    found = sorted((postings.get(trigram, set()) for trigram in query_trigrams), key=len)
+    if not found[0]:
+        return set()
+    # Intersecting from the smallest set keeps it cheap even when some trigrams are very common
+    return found[0].intersection(*found[1:])
+
+
+def ranking_key(result):
+    # Shorter names first among equal scores, they are closer to the query
+    return -result[0], len(result[2]), result[2]
+
+
+class SearchIndex:
+    # In-memory trigram index over the plain names and links of an opened vault.
+    # It is never written anywhere and has to be cleared when the vault is closed
+    def __init__(self):
+        # id -> (name, link, lowercase name, lowercase link)
+        self.entries = {}
+        self.name_postings = defaultdict(set)
+        self.link_postings = defaultdict(set)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, profile_id, name, link=None):
+        # Adding an id that is already indexed replaces its entry
+        self.remove(profile_id)
+        name_lower = name.lower()
+        link_lower = (link or '').lower()
+        self.entries[profile_id] = (name, link, name_lower, link_lower)
+        add_postings(self.name_postings, name_lower, profile_id)
+        add_postings(self.link_postings, link_lower, profile_id)
+
+    def remove(self, profile_id):
+        entry = self.entries.pop(profile_id, None)
+        if entry is None:
+            return
+
+        _, _, name_lower, link_lower = entry
+        remove_postings(self.name_postings, name_lower, profile_id)
+        remove_postings(self.link_postings, link_lower, profile_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.name_postings.clear()
+        self.link_postings.clear()
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        # Ranked matches as (score, id, name, link): exact name, name prefix, name substring, link substring,
+        # then fuzzy name matches by the share of query trigrams they contain.
+        # Each tier is only looked at when the better ones gave fewer than limit results
+        query = query.lower().strip()
+        if query == '' or limit <= 0:
+            return []
+
+        query_trigrams = trigrams(query)
+        if query_trigrams:
+            name_candidates = intersect(self.name_postings, query_trigrams)
+        else:
+            # Too short for trigrams, check every entry instead
+            name_candidates = self.entries.keys()
+
+        results = []
+        for profile_id in name_candidates:
+            entry = self.entries[profile_id]
+            name_lower = entry[2]
+            if name_lower == query:
+                results.append((EXACT_SCORE, profile_id, entry[0], entry[1]))
+            elif name_lower.startswith(query):
+                results.append((PREFIX_SCORE, profile_id, entry[0], entry[1]))
+            elif query in name_lower:
+                results.append((NAME_SUBSTRING_SCORE, profile_id, entry[0], entry[1]))
+        results = heapq.nsmallest(limit, results, key=ranking_key)
+
+        if len(results) < limit:
+            found = {result[1] for result in results}
+            link_candidates = intersect(self.link_postings, query_trigrams) if query_trigrams else self.entries.keys()
+            link_results = []
+            for profile_id in link_candidates:
+                entry = self.entries[profile_id]
+                if profile_id not in found and query in entry[3]:
+                    link_results.append((LINK_SUBSTRING_SCORE, profile_id, entry[0], entry[1]))
+            results += heapq.nsmallest(limit - len(results), link_results, key=ranking_key)
+
+        if len(results) < limit and query_trigrams:
+            found = {result[1] for result in results}
+            counts = Counter()
+            for trigram in query_trigrams:
+                counts.update(self.name_postings.get(trigram, ()))
+
+            fuzzy_results = []
+            for profile_id, count in counts.items():
+                similarity = count / len(query_trigrams)
+                if similarity >= MIN_SIMILARITY and profile_id not in found:
+                    entry = self.entries[profile_id]
+                    fuzzy_results.append((similarity, profile_id, entry[0], entry[1]))
+            results += heapq.nsmallest(limit - len(results), fuzzy_results, key=ranking_key)
+
+        return results
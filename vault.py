@@ -1,121 +1,405 @@
 import sqlite3
 import os
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import cryptography
+from cryptography.exceptions import InvalidTag
 
+import instrumentation
 from data_encryption import *
+from key_agent import cache_key, get_cached_key
 from password_generator import generate_random_string
+from profiles import Profile
+from search_index import DEFAULT_LIMIT, SearchIndex
+
+# Version of the vault schema, stored in the database as PRAGMA user_version
+SCHEMA_VERSION = 5
+
+# Profiles table. New rows keep all their fields in a single encrypted record, the name, username, password
+# and link columns are only filled in rows written before schema version 3 (see data_encryption record formats)
+CREATE_VAULT_TABLE_QUERY = '''CREATE TABLE {table} (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        username TEXT,
+                        password TEXT,
+                        link TEXT,
+                        name_index BLOB,
+                        record BLOB
+                        )'''
+# Stored columns of a profile in the order Cipher.decrypt_records expects them
+PROFILE_COLUMNS = 'record, name, username, password, link'
+INSERT_PROFILE_QUERY = 'INSERT INTO vault (record, name_index) VALUES (?, ?)'
+
+CREATE_NAME_INDEX_QUERY = 'CREATE UNIQUE INDEX vault_name_index ON vault (name_index)'
+# Vault settings stored next to the data, such as the KDF parameters
+CREATE_META_TABLE_QUERY = 'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+# Append-only log of the profiles written by every change, numbered by seq. Incremental backups
+# export the current state of the profiles changed since a given seq (see backups.py)
+CREATE_CHANGES_TABLE_QUERY = '''CREATE TABLE changes (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        profile_id INTEGER NOT NULL
+                        )'''
+LOG_CHANGE_QUERY = 'INSERT INTO changes (profile_id) VALUES (?)'
+# Files stored next to a profile. The name and the random key of the attachment are encrypted under the vault key,
+# the content is split into chunks encrypted under the attachment key (see data_encryption.ChunkCipher).
+# Chunks live in their own table, so reading profiles never touches them
+CREATE_ATTACHMENTS_TABLE_QUERY = '''CREATE TABLE attachments (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        profile_id INTEGER NOT NULL,
+                        name BLOB NOT NULL,
+                        data_key BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        chunk_count INTEGER NOT NULL
+                        )'''
+CREATE_ATTACHMENTS_INDEX_QUERY = 'CREATE INDEX attachments_profile_index ON attachments (profile_id)'
+CREATE_CHUNKS_TABLE_QUERY = '''CREATE TABLE attachment_chunks (
+                        id INTEGER PRIMARY KEY,
+                        attachment_id INTEGER NOT NULL,
+                        chunk_index INTEGER NOT NULL,
+                        data BLOB NOT NULL,
+                        UNIQUE (attachment_id, chunk_index)
+                        )'''
+
+# Maximum number of name -> id pairs kept in memory by an opened vault
+DEFAULT_NAME_CACHE_SIZE = 4096
+
+# Number of profiles encrypted and inserted together by add_profiles_bulk
+BULK_BATCH_SIZE = 500
+
+# Number of profiles fetched and decrypted at once when the vault content is read
+DEFAULT_PAGE_SIZE = 100
+# Whole-vault reads with parallel decryption use larger pages to keep every worker busy
+PARALLEL_PAGE_SIZE = 16384
+
+# Seconds SQLite waits for a lock held by another connection before giving up
+DEFAULT_BUSY_TIMEOUT = 5.0
+# Extra attempts of an operation after SQLite gave up waiting for a lock, with an exponentially growing delay
+LOCK_RETRIES = 3
+LOCK_RETRY_DELAY = 0.05
+
+
+class VaultError(Exception):
+    pass
+
+
+class WrongPasswordError(VaultError):
+    pass
+
+
+class AttachmentError(VaultError):
+    pass
+
+
+class VaultNotFoundError(VaultError):
+    pass
+
+
+class VaultExistsError(VaultError):
+    pass
+
+
+class NotAVaultError(VaultError):
+    # The vault file exists but holds no basedpass vault, e.g. an empty file
+    pass
+
+
+class VaultLockedError(VaultError):
+    # Another connection kept the vault locked through every retry. Trying again later may succeed
+    pass
+
+
+def is_locked_error(error):
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+def retry_locked(operation, message):
+    # Run operation again while SQLite reports the database as locked. SQLite has already waited busy_timeout
+    # before giving up, the delay between attempts doubles and is randomized, so processes that collided do not
+    # retry in lockstep. Raises VaultLockedError with message when the last attempt fails as well
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            return operation()
+        except sqlite3.OperationalError as error:
+            if not is_locked_error(error):
+                raise
+            if attempt == LOCK_RETRIES:
+                raise VaultLockedError(message) from error
+        time.sleep(LOCK_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+class MirroredCursor:
+    # Cursor of the in-memory snapshot that runs every statement on the vault file first, then on the snapshot.
+    # The snapshot is brought up to date with the file under the write lock before the transaction starts,
+    # so both give the same results. Rows are read from the snapshot, new ids from the file
+    def __init__(self, cursor, file_cursor):
+        self.cursor = cursor
+        self.file_cursor = file_cursor
+
+    def execute(self, sql, parameters=()):
+        self.file_cursor.execute(sql, parameters)
+        self.cursor.execute(sql, parameters)
+        return self
+
+    def executemany(self, sql, parameters):
+        # Parameters may be an iterator, and they are used twice
+        parameters = list(parameters)
+        self.file_cursor.executemany(sql, parameters)
+        self.cursor.executemany(sql, parameters)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.file_cursor.lastrowid
+
+    def close(self):
+        self.file_cursor.close()
+        self.cursor.close()
 
 
 class Vault:
-    def __init__(self, name, password):
+    def __init__(self, name, password, name_cache_size=DEFAULT_NAME_CACHE_SIZE, workers=1, use_agent=True,
+                 vaults_dir=None, concurrent=False, busy_timeout=DEFAULT_BUSY_TIMEOUT, cache_size=None,
+                 snapshot=False, write_through=True):
+        if snapshot and concurrent:
+            raise ValueError('Snapshot mode can not be combined with concurrent mode')
+
         self.vault_name = name
+        # Directory with the vault files, 'vaults' in the working directory by default
+        self.vaults_dir = vaults_dir
+        # Writer connection. Without concurrent mode it serves reads as well
         self.connection = None
-        self.cursor = None
+        # Concurrent mode: WAL journal, one read connection per thread and writes serialized by write_lock,
+        # so a single Vault can be shared between threads
+        self.concurrent = concurrent
+        self.busy_timeout = busy_timeout
+        # SQLite page cache of every connection in KiB. None keeps the SQLite default of about 2 MiB
+        self.cache_size = cache_size
+        # Snapshot mode: the vault is loaded into an in-memory database that serves every query.
+        # Writes go to the file as well (write_through) or mark the snapshot dirty until flush() or close_vault()
+        # copies it back. The file is only written through SQLite transactions, so a crash never leaves it
+        # half written. Changes made to the file by other connections meanwhile are overwritten by a flush.
+        # Vaults with attachments are never loaded into memory: they are used from the file, as without snapshot mode
+        self.snapshot = snapshot
+        self.write_through = write_through
+        self.file_connection = None
+        # PRAGMA data_version of the file when the snapshot was last in sync with it. It changes with every commit
+        # made to the file by another connection
+        self.data_version = None
+        self.dirty = False
+        self.local = threading.local()
+        self.read_connections = []
+        self.write_lock = threading.RLock()
+        # Guards the name cache and the search index
+        self.state_lock = threading.RLock()
         self.master_password = password
         self.key = None
+        self.cipher = None
+        self.kdf_params = None
         self.validation_row_id = 1
+        # Least recently used profile names are evicted first. Size 0 turns the cache off
+        self.name_cache_size = name_cache_size
+        self.name_cache = OrderedDict()
+        # Whole-vault reads are decrypted on this many worker processes. 1 keeps them sequential
+        self.workers = workers
+        self.decryptor = None
+        # Ask the key agent for the derived key before running the KDF (only if an agent is running)
+        self.use_agent = use_agent
+        # Built from the decrypted names and links on the first search, then kept current by every change
+        self.search_index = None
+
+    def vault_path(self):
+        folder_path = self.vaults_dir or os.path.join(os.getcwd(), 'vaults')
+        return os.path.join(folder_path, f'{self.vault_name}.db')
 
-    def create_vault(self):
+    def create_vault(self, kdf_params=None):
         # Creating path to the new vault
-        current_directory = os.getcwd()
-        folder_path = os.path.join(current_directory, 'vaults')
+        vault_path = self.vault_path()
+        folder_path = os.path.dirname(vault_path)
+        if os.path.exists(vault_path):
+            raise VaultExistsError(f'Vault "{self.vault_name}" already exists')
 
         # Create directory if it does not exist
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
 
-        vault_path = os.path.join(folder_path, f'{self.vault_name}.db')
-
         # Connect to the new database
-        self.connection = sqlite3.connect(vault_path)
-        self.cursor = self.connection.cursor()
-        # Create table 'vault' to store all data
-        create_table_query = '''CREATE TABLE vault (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL UNIQUE,
-                    username TEXT,
-                    password TEXT NOT NULL,
-                    link TEXT
-                    )'''
+        self.connection = self.connect()
+        self.name_cache.clear()
 
-        self.cursor.execute(create_table_query)
+        # Generate a key for Fernet encryption based on master password.
+        # Every vault gets a random salt, by default with the standard PBKDF2 parameters
+        self.kdf_params = kdf_params or new_kdf_params()
+        self.key = derive_key(self.master_password, self.kdf_params)
+        self.start_session()
 
-        # Create a table to validate password when db is accessed in the future
-        # Stores randomly generated string and its encrypted version
-        create_validation_table_query = '''CREATE TABLE validation (
-                    id INTEGER PRIMARY KEY,
-                    plain_text TEXT,
-                    encrypted_text TEXT
-                    )'''
+        with self.transaction() as cursor:
+            # Create table 'vault' to store all data
+            # name_index holds a keyed digest of the plain profile name for indexed lookups
+            cursor.execute(CREATE_VAULT_TABLE_QUERY.format(table='vault'))
+            cursor.execute(CREATE_NAME_INDEX_QUERY)
 
-        self.cursor.execute(create_validation_table_query)
+            # Create a table to validate password when db is accessed in the future
+            # Stores randomly generated string and its encrypted version
+            create_validation_table_query = '''CREATE TABLE validation (
+                        id INTEGER PRIMARY KEY,
+                        plain_text TEXT,
+                        encrypted_text TEXT
+                        )'''
 
-        # Generate a key for Fernet encryption based on master password
-        self.key = generate_key(self.master_password, self.vault_name)
+            cursor.execute(create_validation_table_query)
 
-        # Populate validation table
-        plain_text = generate_random_string(32)
-        encrypted_text = encrypt(plain_text, self.key)
+            cursor.execute(CREATE_META_TABLE_QUERY)
+            cursor.execute("INSERT INTO meta (key, value) VALUES ('kdf', ?)", (json.dumps(self.kdf_params),))
+            cursor.execute(CREATE_CHANGES_TABLE_QUERY)
+            self.create_attachment_tables(cursor)
 
-        insert_validation_query = "INSERT INTO validation (id, plain_text, encrypted_text) VALUES (?, ?, ?)"
-        self.cursor.execute(insert_validation_query, (self.validation_row_id, plain_text, encrypted_text))
+            # Populate validation table
+            plain_text = generate_random_string(32)
+            encrypted_text = self.cipher.encrypt(plain_text)
 
-        self.connection.commit()
+            insert_validation_query = "INSERT INTO validation (id, plain_text, encrypted_text) VALUES (?, ?, ?)"
+            cursor.execute(insert_validation_query, (self.validation_row_id, plain_text, encrypted_text))
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
 
     def open_vault(self):
-        # Form path to the vault
-        current_directory = os.getcwd()
-        folder_path = os.path.join(current_directory, 'vaults')
-        vault_path = os.path.join(folder_path, f'{self.vault_name}.db')
+        # Form path to the vault. Connecting would create an empty file in place of a missing vault
+        vault_path = self.vault_path()
+        if not os.path.exists(vault_path):
+            raise VaultNotFoundError(f'Vault "{self.vault_name}" does not exist')
 
-        self.connection = sqlite3.connect(vault_path)
-        self.cursor = self.connection.cursor()
+        self.connection = self.connect()
+        self.name_cache.clear()
 
         # Extract data for master password validation
-        self.cursor.execute('SELECT plain_text, encrypted_text FROM validation WHERE id = ?', (self.validation_row_id,))
-        validation_samples = [sample for sample in self.cursor.fetchall()[0]]
+        validation_samples = retry_locked(self.read_validation_samples, self.locked_message())
+        encrypted_text_idx = 1
+        self.kdf_params = retry_locked(self.read_kdf_params, self.locked_message())
 
-        self.key = generate_key(self.master_password, self.vault_name)
+        # A key cached by the agent saves the key derivation. It is validated like a derived one
+        cached_key = get_cached_key(self.agent_vault_id(), self.master_password) if self.use_agent else None
+        if cached_key is not None and self.is_valid_key(cached_key, validation_samples[encrypted_text_idx]):
+            self.key = cached_key
+        else:
+            self.key = derive_key(self.master_password, self.kdf_params)
 
-        # If decrypted string matches its plain version return True, else return False
-        encrypted_text_idx = 1
-        try:
-            validation_samples[encrypted_text_idx] = decrypt(validation_samples[encrypted_text_idx], self.key)
-            return True
-        except cryptography.fernet.InvalidToken:
-            # Exception is thrown when data cannot be decrypted with a provided key
-            return False
+            # If decrypted string matches its plain version return True, else return False
+            if not self.is_valid_key(self.key, validation_samples[encrypted_text_idx]):
+                return False
+
+            if self.use_agent:
+                cache_key(self.agent_vault_id(), self.master_password, self.key)
+
+        self.start_session()
+        # Vaults created by older versions are brought up to date on first successful open
+        self.migrate()
+        return True
 
     def add_new_profile(self, profile_name, password, username=None, link=None):
-        if self.get_profile_id(profile_name) is not None:
-            # Profile already exists
+        # profile_name and password cannot be None
+        if profile_name is None or password is None:
             return None
 
-        insert_query = "INSERT INTO vault (name, username, password, link) VALUES (?, ?, ?, ?)"
-        # Encrypt all fields to provide them to insertion query
-        profile_data = encrypt_many([profile_name, username, password, link], self.key)
+        # Encrypt all fields into one record to provide it to insertion query
+        record = self.cipher.encrypt_record([profile_name, username, password, link])
 
         try:
-            self.cursor.execute(insert_query, tuple(profile_data))
-            self.connection.commit()
+            with self.transaction() as cursor:
+                cursor.execute(INSERT_PROFILE_QUERY, (record, self.cipher.blind_index(profile_name)))
+                profile_id = cursor.lastrowid
+                cursor.execute(LOG_CHANGE_QUERY, (profile_id,))
         except sqlite3.IntegrityError:
-            # Table constraints failed
-            # Fields contain invalid data. profile_name and password cannot be None
+            # Table constraints failed, the profile already exists
             return None
 
+        with self.state_lock:
+            self.cache_profile_id(profile_name, profile_id)
+            if self.search_index is not None:
+                self.search_index.add(profile_id, profile_name, link)
+
+    def add_profiles_bulk(self, profiles, batch_size=BULK_BATCH_SIZE):
+        # Add many profiles in a single transaction.
+        # profiles is an iterable of (name, username, password, link) sequences.
+        # Rows that cannot be added are skipped and reported as (row number, name, reason),
+        # the rest of the import goes on. Returns the number of added profiles and the conflicts
+        added = 0
+        conflicts = []
+        batch = []
+        batch_indexes = []
+
+        def flush():
+            records = self.cipher.encrypt_records(batch)
+            cursor.executemany(INSERT_PROFILE_QUERY, zip(records, batch_indexes))
+            batch.clear()
+            batch_indexes.clear()
+
+        with self.transaction() as cursor:
+            # Uniqueness is checked against the stored digests, no profile has to be decrypted
+            cursor.execute('SELECT name_index FROM vault')
+            known_indexes = {row[0] for row in cursor.fetchall()}
+            # Ids only grow, so the new profiles are the ones above the current largest id
+            last_id = cursor.execute('SELECT IFNULL(MAX(id), 0) FROM vault').fetchone()[0]
+
+            for row_number, profile in enumerate(profiles, start=1):
+                profile_name, username, password, link = profile
+                if not profile_name:
+                    conflicts.append((row_number, profile_name, 'profile name is empty'))
+                    continue
+                if not password:
+                    conflicts.append((row_number, profile_name, 'password is empty'))
+                    continue
+
+                name_index = self.cipher.blind_index(profile_name)
+                if name_index in known_indexes:
+                    conflicts.append((row_number, profile_name, 'profile name already exists'))
+                    continue
+
+                known_indexes.add(name_index)
+                batch.append((profile_name, username or None, password, link or None))
+                batch_indexes.append(name_index)
+                added += 1
+                if len(batch) >= batch_size:
+                    flush()
+
+            if batch:
+                flush()
+
+            cursor.execute('INSERT INTO changes (profile_id) SELECT id FROM vault WHERE id > ? ORDER BY id', (last_id,))
+
+        # Ids of the new rows are not known here. The index is rebuilt on the next search instead
+        with self.state_lock:
+            if added and self.search_index is not None:
+                self.search_index.clear()
+                self.search_index = None
+
+        return added, conflicts
+
     def update_profile(self, profile_name, username, password, link):
         # Find id that relates to profile_name
         search_id = self.get_profile_id(profile_name)
         if search_id is None:
             return None
 
-        # Encrypt new data and append found id to profile_data
-        profile_data = encrypt_many([username, password, link], self.key)
-        profile_data.append(search_id)
-        self.cursor.execute('UPDATE vault SET username = ?, password = ?, link = ? WHERE id = ?',
-                            tuple(profile_data))
-        self.connection.commit()
+        # The whole record is encrypted again. A legacy row is converted to a record on the way
+        record = self.cipher.encrypt_record([profile_name, username, password, link])
+        with self.transaction() as cursor:
+            cursor.execute('UPDATE vault SET record = ?, name = NULL, username = NULL, password = NULL, link = NULL '
+                           'WHERE id = ?', (record, search_id))
+            cursor.execute(LOG_CHANGE_QUERY, (search_id,))
+
+        with self.state_lock:
+            if self.search_index is not None:
+                self.search_index.add(search_id, profile_name, link)
 
     def delete_profile(self, profile_name):
         # Find id that relates to profile_name
@@ -123,22 +407,117 @@ class Vault:
         if search_id is None:
             return None
 
-        delete_query = f"DELETE FROM vault WHERE id='{search_id}'"
-        self.cursor.execute(delete_query)
-        self.connection.commit()
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM vault WHERE id = ?', (search_id,))
+            cursor.execute(LOG_CHANGE_QUERY, (search_id,))
+            # Attachments go with their profile
+            cursor.execute('DELETE FROM attachment_chunks WHERE attachment_id IN '
+                           '(SELECT id FROM attachments WHERE profile_id = ?)', (search_id,))
+            cursor.execute('DELETE FROM attachments WHERE profile_id = ?', (search_id,))
+
+        with self.state_lock:
+            self.name_cache.pop(profile_name, None)
+            if self.search_index is not None:
+                self.search_index.remove(search_id)
+
+    def add_attachment(self, profile_name, attachment_name, stream, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        # Store the content of the binary file object stream next to the profile, one encrypted chunk at a time,
+        # so memory use does not depend on the size of the file. Returns the attachment id,
+        # or None when the profile does not exist
+        profile_id = self.get_profile_id(profile_name)
+        if profile_id is None:
+            return None
+
+        # The chunks would be copied into the snapshot as well
+        self.leave_snapshot()
+        data_key = ChunkCipher.new_key()
+        chunk_cipher = ChunkCipher(data_key)
+        with self.transaction() as cursor:
+            cursor.execute('INSERT INTO attachments (profile_id, name, data_key, size, chunk_count) '
+                           'VALUES (?, ?, ?, 0, 0)',
+                           (profile_id, self.cipher.encrypt(attachment_name), self.cipher.wrap_key(data_key)))
+            attachment_id = cursor.lastrowid
+
+            # One chunk is read ahead to know which one is the last. An empty file is a single empty chunk
+            size = 0
+            index = 0
+            chunk = stream.read(chunk_size)
+            while True:
+                next_chunk = stream.read(chunk_size)
+                last = not next_chunk
+                cursor.execute('INSERT INTO attachment_chunks (attachment_id, chunk_index, data) VALUES (?, ?, ?)',
+                               (attachment_id, index, chunk_cipher.encrypt_chunk(attachment_id, index, last, chunk)))
+                size += len(chunk)
+                index += 1
+                if last:
+                    break
+                chunk = next_chunk
+
+            cursor.execute('UPDATE attachments SET size = ?, chunk_count = ? WHERE id = ?',
+                           (size, index, attachment_id))
+        return attachment_id
+
+    def list_attachments(self, profile_name):
+        # [(attachment id, name, size in bytes)] of the profile, None when the profile does not exist
+        profile_id = self.get_profile_id(profile_name)
+        if profile_id is None:
+            return None
+
+        rows = self.read('SELECT id, name, size FROM attachments WHERE profile_id = ? ORDER BY id',
+                         (profile_id,)).fetchall()
+        return [(attachment_id, self.cipher.decrypt(name), size) for attachment_id, name, size in rows]
+
+    def iter_attachment(self, attachment_id):
+        # Yield the decrypted chunks of an attachment. Every chunk is read through the SQLite blob API,
+        # so only one chunk is in memory at a time. Raises AttachmentError when the attachment does not exist
+        # or its chunks have been modified, reordered or cut off
+        found = self.read('SELECT data_key, chunk_count FROM attachments WHERE id = ?', (attachment_id,)).fetchone()
+        if found is None:
+            raise AttachmentError(f'Attachment {attachment_id} does not exist')
+
+        chunk_cipher = ChunkCipher(self.cipher.unwrap_key(found[0]))
+        chunk_count = found[1]
+        chunk_ids = self.read('SELECT id, chunk_index FROM attachment_chunks WHERE attachment_id = ? '
+                              'ORDER BY chunk_index', (attachment_id,)).fetchall()
+        if [index for _, index in chunk_ids] != list(range(chunk_count)):
+            raise AttachmentError(f'Chunks of attachment {attachment_id} are missing')
+
+        for chunk_id, index in chunk_ids:
+            data = retry_locked(lambda: self.read_blob('attachment_chunks', 'data', chunk_id), self.locked_message())
+            try:
+                yield chunk_cipher.decrypt_chunk(attachment_id, index, index == chunk_count - 1, data)
+            except InvalidTag:
+                raise AttachmentError(f'Chunk {index} of attachment {attachment_id} has been modified')
+
+    def delete_attachment(self, attachment_id):
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM attachment_chunks WHERE attachment_id = ?', (attachment_id,))
+            cursor.execute('DELETE FROM attachments WHERE id = ?', (attachment_id,))
 
     def get_vault_content(self):
-        # Extract all profiles from the vault
-        self.cursor.execute("SELECT name, username, password, link FROM vault")
-        vault_content = self.cursor.fetchall()
+        # Extract all profiles from the vault. Fields are decrypted on first use,
+        # unless the parallel decryptor is enabled: then every page is decrypted at once on its workers
+        page_size = DEFAULT_PAGE_SIZE if self.decryptor is None else PARALLEL_PAGE_SIZE
+        return list(self.iter_vault_content(page_size))
+
+    def get_vault_page(self, after_id=0, page_size=DEFAULT_PAGE_SIZE):
+        # Keyset pagination: return up to page_size profiles with ids greater than after_id,
+        # and the id to pass as after_id for the next page (None when this is the last page)
+        rows = self.read(f'SELECT id, {PROFILE_COLUMNS} FROM vault WHERE id > ? '
+                         'ORDER BY id LIMIT ?', (after_id, page_size + 1)).fetchall()
 
-        # Decrypt each profile
-        for i in range(len(vault_content)):
-            profile = list(vault_content[i])
-            profile = decrypt_many(profile, self.key)
-            vault_content[i] = profile
+        # One extra row is fetched only to learn whether another page follows
+        next_after_id = rows[page_size - 1][0] if len(rows) > page_size else None
+        rows = rows[:page_size]
 
-        return vault_content
+        return self.make_profiles(rows), next_after_id
+
+    def iter_vault_content(self, page_size=DEFAULT_PAGE_SIZE):
+        # Yield profiles one by one. Only a single page is held in memory at a time
+        after_id = 0
+        while after_id is not None:
+            profiles, after_id = self.get_vault_page(after_id, page_size)
+            yield from profiles
 
     def get_profile(self, profile_name):
         # Find id that relates to profile_name
@@ -146,33 +525,525 @@ class Vault:
         if search_id is None:
             return None
 
-        self.cursor.execute('SELECT name, username, password, link FROM vault WHERE id = ?', (search_id,))
-        # self.cursor.fetchall()[0] returns a tuple with all extracted data
-        profile = list(self.cursor.fetchall()[0])
+        found = self.read(f'SELECT id, {PROFILE_COLUMNS} FROM vault WHERE id = ?',
+                          (search_id,)).fetchone()
+        if found is None:
+            # Deleted by another thread or process after its id was cached
+            with self.state_lock:
+                self.name_cache.pop(profile_name, None)
+            return None
+
+        # found is a tuple with the id and the stored columns, decrypted when a field is used
+        return Profile.from_stored(found[0], self.cipher, found[1:])
+
+    def get_profiles(self, profile_names):
+        # Several profiles with one query for the ids that are not cached and one for the rows.
+        # Returns a list in the order of profile_names with None for the missing profiles
+        ids = {}
+        with self.state_lock:
+            for profile_name in profile_names:
+                if profile_name in self.name_cache:
+                    self.name_cache.move_to_end(profile_name)
+                    ids[profile_name] = self.name_cache[profile_name]
 
-        profile = decrypt_many(profile, self.key)
+        uncached = [profile_name for profile_name in dict.fromkeys(profile_names) if profile_name not in ids]
+        for start in range(0, len(uncached), BULK_BATCH_SIZE):
+            batch = uncached[start:start + BULK_BATCH_SIZE]
+            names_by_index = {self.cipher.blind_index(profile_name): profile_name for profile_name in batch}
+            rows = self.read(f'SELECT id, name_index FROM vault WHERE name_index IN '
+                             f'({", ".join("?" * len(batch))})', list(names_by_index)).fetchall()
+            with self.state_lock:
+                for profile_id, name_index in rows:
+                    ids[names_by_index[name_index]] = profile_id
+                    self.cache_profile_id(names_by_index[name_index], profile_id)
 
-        return profile
+        found = {}
+        unique_ids = list(dict.fromkeys(ids.values()))
+        for start in range(0, len(unique_ids), BULK_BATCH_SIZE):
+            batch = unique_ids[start:start + BULK_BATCH_SIZE]
+            rows = self.read(f'SELECT id, {PROFILE_COLUMNS} FROM vault WHERE id IN '
+                             f'({", ".join("?" * len(batch))})', batch).fetchall()
+            for row in rows:
+                found[row[0]] = Profile.from_stored(row[0], self.cipher, row[1:])
+
+        with self.state_lock:
+            for profile_name, profile_id in ids.items():
+                # Deleted by another thread or process after its id was cached
+                if profile_id not in found:
+                    self.name_cache.pop(profile_name, None)
+
+        return [found.get(ids.get(profile_name)) for profile_name in profile_names]
 
     def close_vault(self):
-        self.connection.close()
+        if self.dirty:
+            self.flush()
+        if self.file_connection is not None:
+            self.file_connection.close()
+            self.file_connection = None
+        for connection in self.read_connections:
+            connection.close()
+        self.read_connections.clear()
+        self.local = threading.local()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.decryptor is not None:
+            self.decryptor.close()
+            self.decryptor = None
+        # Forget everything learned about the vault contents during the session
+        with self.state_lock:
+            self.name_cache.clear()
+            if self.search_index is not None:
+                self.search_index.clear()
+                self.search_index = None
+        if self.cipher is not None:
+            self.cipher.close()
+        self.key = None
+        self.cipher = None
+
+    def __enter__(self):
+        # "with Vault(name, password) as vault:" opens the vault unless it is already open
+        if self.connection is None and not self.open_vault():
+            self.close_vault()
+            raise WrongPasswordError(f'Wrong master password for "{self.vault_name}"')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_vault()
+
+    def connect(self):
+        if self.snapshot:
+            return self.connect_snapshot()
+        return self.connect_file()
+
+    def connect_snapshot(self):
+        # Copy the vault file into a new in-memory database with the backup API
+        if self.file_connection is not None:
+            self.file_connection.close()
+        self.file_connection = self.connect_file()
+        if retry_locked(lambda: self.has_attachments(self.file_connection), self.locked_message()):
+            connection = self.file_connection
+            self.file_connection = None
+            self.snapshot = False
+            return connection
+
+        connection = sqlite3.connect(':memory:', factory=instrumentation.connection_factory())
+        retry_locked(lambda: self.file_connection.backup(connection), self.locked_message())
+        self.data_version = self.file_connection.execute('PRAGMA data_version').fetchone()[0]
+        self.dirty = False
+        return connection
+
+    def file_changed(self):
+        # True when another connection committed to the vault file since the snapshot was last in sync with it
+        return self.file_connection.execute('PRAGMA data_version').fetchone()[0] != self.data_version
+
+    def refresh_snapshot(self):
+        # Reload the snapshot when the file has changed. Ids cached from the old copy stay valid:
+        # ids are never given out twice. Must not run inside a transaction on the file
+        version = self.file_connection.execute('PRAGMA data_version').fetchone()[0]
+        if version == self.data_version:
+            return
+        if self.has_attachments(self.file_connection):
+            # Another process has added an attachment
+            self.leave_snapshot()
+            return
+        self.file_connection.backup(self.connection)
+        self.data_version = version
+        with self.state_lock:
+            self.name_cache.clear()
+            self.search_index = None
+
+    def leave_snapshot(self):
+        # Write back and drop the in-memory copy, the vault file serves everything from now on
+        if not self.snapshot:
+            return
+
+        with self.write_lock:
+            if self.dirty:
+                self.flush()
+            self.connection.close()
+            self.connection = self.file_connection
+            self.file_connection = None
+            self.snapshot = False
+
+    @staticmethod
+    def has_attachments(connection):
+        try:
+            return connection.execute('SELECT EXISTS (SELECT 1 FROM attachment_chunks)').fetchone()[0] == 1
+        except sqlite3.OperationalError as error:
+            # Vaults before schema version 5 have no attachments table
+            if is_locked_error(error):
+                raise
+            return False
+
+    def begin_mirrored(self):
+        # Start a transaction on the vault file with the snapshot equal to it. No one else can write to the file
+        # until the commit, so they stay equal. A stale snapshot is reloaded outside of the transaction first.
+        # Returns False when the snapshot has been dropped meanwhile, the file then is not in a transaction
+        while True:
+            retry_locked(lambda: self.file_connection.execute('BEGIN IMMEDIATE'), self.locked_message())
+            if not self.file_changed():
+                return True
+            self.file_connection.rollback()
+            retry_locked(self.refresh_snapshot, self.locked_message())
+            if not self.snapshot:
+                return False
+
+    def flush(self):
+        # Write the snapshot back to the vault file. The backup runs as a single transaction on the file,
+        # so after a crash the file holds either the old or the new content
+        if not self.snapshot:
+            return
+
+        with self.write_lock:
+            retry_locked(lambda: self.connection.backup(self.file_connection), self.locked_message())
+            self.dirty = False
+
+    def connect_file(self):
+        # Connections may be closed by another thread in close_vault, each one is used by a single thread otherwise
+        # SQL statements are timed when instrumentation is on
+        connection = sqlite3.connect(self.vault_path(), timeout=self.busy_timeout,
+                                     check_same_thread=not self.concurrent,
+                                     factory=instrumentation.connection_factory())
+        if self.concurrent:
+            # Readers never block the writer and see the last committed state while it writes.
+            # The journal mode is stored in the file, so it sticks for every later connection
+            retry_locked(lambda: connection.execute('PRAGMA journal_mode=WAL'), self.locked_message())
+        if self.cache_size is not None:
+            connection.execute(f'PRAGMA cache_size = -{int(self.cache_size)}')
+        return connection
+
+    def locked_message(self):
+        return f'Vault "{self.vault_name}" is locked by another process. Try again later'
+
+    @staticmethod
+    def stats():
+        # Snapshot of the instrumentation timers: {name: {'calls': ..., 'seconds': ...}}.
+        # Empty unless instrumentation.enable() was called before the vault was opened
+        return instrumentation.snapshot()
+
+    def reader(self):
+        # Connection for reads in the calling thread
+        if not self.concurrent:
+            return self.connection
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self.local.connection = connection
+            with self.state_lock:
+                self.read_connections.append(connection)
+        return connection
+
+    def read(self, sql, parameters=()):
+        # Run a query on the reader connection of the calling thread, retried while the vault is locked.
+        # A query holds its shared lock until its rows are fetched, so only the execute can find the vault locked.
+        # A write-through snapshot picks up the changes other processes made to the file first
+        if self.snapshot and self.write_through:
+            with self.write_lock:
+                retry_locked(self.refresh_snapshot, self.locked_message())
+        return retry_locked(lambda: self.reader().execute(sql, parameters), self.locked_message())
+
+    def read_blob(self, table, column, row_id):
+        with self.reader().blobopen(table, column, row_id, readonly=True) as blob:
+            return blob.read()
+
+    @contextmanager
+    def transaction(self):
+        # Serialized write transaction on the writer connection. Commits when the block succeeds,
+        # rolls back when it raises. BEGIN IMMEDIATE takes the write lock up front, so a transaction
+        # can only fail to start, never half way through because another connection got the lock first
+        with self.write_lock:
+            mirrored = self.snapshot and self.write_through and self.begin_mirrored()
+            cursor = self.connection.cursor()
+            if mirrored:
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor = MirroredCursor(cursor, self.file_connection.cursor())
+            else:
+                retry_locked(lambda: cursor.execute('BEGIN IMMEDIATE'), self.locked_message())
+
+            try:
+                yield cursor
+                # A commit that finds the database locked leaves the transaction open, so it can be retried
+                if mirrored:
+                    retry_locked(self.file_connection.commit, self.locked_message())
+                retry_locked(self.connection.commit, self.locked_message())
+            except BaseException:
+                if mirrored:
+                    self.file_connection.rollback()
+                self.connection.rollback()
+                raise
+
+            if self.snapshot and not self.write_through:
+                self.dirty = True
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        # Ranked substring and fuzzy matches of query in profile names and links, as (name, link) pairs
+        return [(name, link) for _, name, link in self.search_scored(query, limit)]
+
+    def search_scored(self, query, limit=DEFAULT_LIMIT):
+        # Same as search, as (score, name, link). Scores of different vaults can be compared
+        with self.state_lock:
+            if self.search_index is None:
+                self.build_search_index()
+
+            return [(score, name, link) for score, _, name, link in self.search_index.search(query, limit)]
+
+    def build_search_index(self):
+        search_index = SearchIndex()
+        after_id = 0
+        while True:
+            # Legacy usernames and passwords are not needed, so they are not decrypted
+            rows = self.read('SELECT id, record, name, NULL, NULL, link FROM vault WHERE id > ? ORDER BY id LIMIT ?',
+                             (after_id, PARALLEL_PAGE_SIZE)).fetchall()
+            if not rows:
+                break
+
+            for row, (name, _, _, link) in zip(rows, self.decrypt_rows([row[1:] for row in rows])):
+                search_index.add(row[0], name, link)
+            after_id = rows[-1][0]
+
+        self.search_index = search_index
 
     def extract_all_profile_names(self):
         # Extract all profile names with correlating ids
-        self.cursor.execute('SELECT id, name FROM vault')
-        all_profile_names = dict(self.cursor.fetchall())
-
+        rows = self.read('SELECT id, record, name, NULL, NULL, NULL FROM vault').fetchall()
+        ids = [row[0] for row in rows]
         # Decrypt all profile names
-        for id in all_profile_names:
-            all_profile_names[id] = decrypt(all_profile_names[id], self.key)
+        names = [profile[0] for profile in self.decrypt_rows([row[1:] for row in rows])]
+
+        return dict(zip(ids, names))
+
+    def read_validation_samples(self):
+        try:
+            found = self.connection.execute('SELECT plain_text, encrypted_text FROM validation WHERE id = ?',
+                                            (self.validation_row_id,)).fetchone()
+        except sqlite3.DatabaseError as error:
+            if is_locked_error(error):
+                raise
+            raise NotAVaultError(f'"{self.vault_name}" is not a basedpass vault') from error
 
-        return all_profile_names
+        if found is None:
+            raise NotAVaultError(f'"{self.vault_name}" is not a basedpass vault')
+        return found
+
+    def read_kdf_params(self):
+        # Vaults created before the meta table existed used fixed parameters
+        try:
+            found = self.connection.execute("SELECT value FROM meta WHERE key = 'kdf'").fetchone()
+        except sqlite3.OperationalError as error:
+            if is_locked_error(error):
+                raise
+            return legacy_kdf_params(self.vault_name)
+
+        if found is None:
+            return legacy_kdf_params(self.vault_name)
+        return json.loads(found[0])
+
+    def agent_vault_id(self):
+        # Keys cached by the agent are tied to the vault file and to its KDF parameters
+        return f'{self.vault_path()}\0{json.dumps(self.kdf_params, sort_keys=True)}'
+
+    def change_kdf(self, kdf_params, progress=None):
+        # Re-derive the key with new KDF parameters (and a new salt) and re-encrypt the whole vault under it
+        self.replace_key(self.master_password, kdf_params, progress)
+
+    def rekey(self, new_password, progress=None):
+        # Change the master password. The vault keeps its KDF algorithm and parameters, but gets a new salt
+        params = {name: value for name, value in self.kdf_params.items() if name not in ('algorithm', 'salt')}
+        self.replace_key(new_password, new_kdf_params(self.kdf_params['algorithm'], **params), progress)
+
+    def replace_key(self, password, kdf_params, progress=None):
+        # Re-encrypt the whole vault under the key derived from password and kdf_params.
+        # Profiles are converted in batches, so memory use does not grow with the vault, but everything happens
+        # in one transaction: after a crash SQLite rolls the journal back and the vault is left untouched.
+        # progress, if given, is called as progress(done, total) after every batch
+        new_key = derive_key(password, kdf_params)
+        new_cipher = Cipher(new_key)
+
+        with self.transaction() as cursor:
+            self.reencrypt_profiles(cursor, self.cipher, new_cipher, progress)
+
+            # Attachment contents stay as they are, only their names and keys are encrypted under the vault key
+            attachments = cursor.execute('SELECT id, name, data_key FROM attachments').fetchall()
+            cursor.executemany('UPDATE attachments SET name = ?, data_key = ? WHERE id = ?',
+                               [(new_cipher.encrypt(self.cipher.decrypt(name)),
+                                 new_cipher.wrap_key(self.cipher.unwrap_key(data_key)), attachment_id)
+                                for attachment_id, name, data_key in attachments])
+
+            plain_text = generate_random_string(32)
+            cursor.execute('UPDATE validation SET plain_text = ?, encrypted_text = ? WHERE id = ?',
+                           (plain_text, new_cipher.encrypt(plain_text), self.validation_row_id))
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('kdf', ?)", (json.dumps(kdf_params),))
+
+        if self.decryptor is not None:
+            self.decryptor.close()
+        self.master_password = password
+        self.key = new_key
+        self.kdf_params = kdf_params
+        self.start_session()
+        if self.use_agent:
+            cache_key(self.agent_vault_id(), self.master_password, self.key)
+
+    def reencrypt_profiles(self, cursor, old_cipher, new_cipher, progress=None, legacy_only=False):
+        # Re-encrypt every profile (or only the legacy rows) as a packed record and its name index in batches.
+        # Runs inside the caller's transaction
+        update_query = ('UPDATE vault SET record = ?, name_index = ?, name = NULL, username = NULL, password = NULL, '
+                        'link = NULL WHERE id = ?')
+        condition = ' AND record IS NULL' if legacy_only else ''
+        total = None
+        if progress is not None:
+            total = cursor.execute(f'SELECT COUNT(*) FROM vault WHERE 1{condition}').fetchone()[0]
+        done = 0
+        after_id = 0
+        while True:
+            cursor.execute(f'SELECT id, {PROFILE_COLUMNS} FROM vault WHERE id > ?{condition} ORDER BY id LIMIT ?',
+                           (after_id, BULK_BATCH_SIZE))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            profiles = old_cipher.decrypt_records([row[1:] for row in rows])
+            records = new_cipher.encrypt_records(profiles)
+            cursor.executemany(update_query, [(record, new_cipher.blind_index(profile[0]), row[0])
+                                              for row, profile, record in zip(rows, profiles, records)])
+            cursor.executemany(LOG_CHANGE_QUERY, [(row[0],) for row in rows])
+            after_id = rows[-1][0]
+            done += len(rows)
+            if progress is not None:
+                progress(done, total)
+
+    def convert_records(self, progress=None):
+        # Rewrite the rows left in the legacy format as packed records, in one transaction.
+        # Returns the number of converted rows. The file only shrinks after a VACUUM
+        with self.transaction() as cursor:
+            legacy_rows = cursor.execute('SELECT COUNT(*) FROM vault WHERE record IS NULL').fetchone()[0]
+            self.reencrypt_profiles(cursor, self.cipher, self.cipher, progress, legacy_only=True)
+        return legacy_rows
+
+    def vacuum(self):
+        # Give the space freed by deleted or converted rows back to the file system
+        with self.write_lock:
+            self.connection.execute('VACUUM')
+            if self.snapshot and self.write_through:
+                self.file_connection.execute('VACUUM')
+            elif self.snapshot:
+                # The next flush writes the compacted pages, and the file shrinks to their size
+                self.dirty = True
+
+    @staticmethod
+    def is_valid_key(key, encrypted_text):
+        try:
+            decrypt(encrypted_text, key)
+            return True
+        except cryptography.fernet.InvalidToken:
+            # Exception is thrown when data cannot be decrypted with a provided key
+            return False
+
+    @staticmethod
+    def create_attachment_tables(cursor):
+        cursor.execute(CREATE_ATTACHMENTS_TABLE_QUERY)
+        cursor.execute(CREATE_ATTACHMENTS_INDEX_QUERY)
+        cursor.execute(CREATE_CHUNKS_TABLE_QUERY)
+
+    def start_session(self):
+        # Set up encryption for the key of a successfully opened or created vault
+        self.cipher = Cipher(self.key)
+        if self.workers > 1:
+            self.decryptor = ParallelDecryptor(self.key, self.workers)
+
+    def decrypt_rows(self, rows):
+        # Decrypt rows of stored profile columns (PROFILE_COLUMNS).
+        # Large reads go to the parallel decryptor when it is enabled
+        if self.decryptor is None:
+            return self.cipher.decrypt_records(rows)
+        return self.decryptor.decrypt_records(rows)
+
+    def make_profiles(self, rows):
+        # Profiles from rows of (id, *PROFILE_COLUMNS)
+        if self.decryptor is None:
+            return [Profile.from_stored(row[0], self.cipher, row[1:]) for row in rows]
+        return [Profile.from_values(row[0], values)
+                for row, values in zip(rows, self.decryptor.decrypt_records([row[1:] for row in rows]))]
 
     def get_profile_id(self, profile_name):
-        # Find id that relates to profile_name
-        profiles = self.extract_all_profile_names()
-        for found_id, name in profiles.items():
-            if name == profile_name:
-                return found_id
+        # Find id that relates to profile_name. Recently used names are served from the cache,
+        # anything else costs a single indexed query
+        if profile_name is None:
+            return None
+
+        with self.state_lock:
+            if profile_name in self.name_cache:
+                self.name_cache.move_to_end(profile_name)
+                return self.name_cache[profile_name]
+
+        found = self.read('SELECT id FROM vault WHERE name_index = ?',
+                          (self.cipher.blind_index(profile_name),)).fetchone()
+        if found is None:
+            return None
+
+        with self.state_lock:
+            self.cache_profile_id(profile_name, found[0])
+        return found[0]
+
+    def cache_profile_id(self, profile_name, profile_id):
+        # Remember the id of profile_name, evicting the least recently used names over the size cap
+        if self.name_cache_size <= 0:
+            return
+
+        self.name_cache[profile_name] = profile_id
+        self.name_cache.move_to_end(profile_name)
+        while len(self.name_cache) > self.name_cache_size:
+            self.name_cache.popitem(last=False)
+
+    def migrate(self):
+        # Upgrade the vault schema in place. Each step runs in a single transaction
+        version = retry_locked(lambda: self.connection.execute('PRAGMA user_version').fetchone()[0],
+                               self.locked_message())
+        steps = [self.add_name_index, self.add_meta_table, self.add_record_column, self.add_change_log,
+                 self.create_attachment_tables]
+        for step_version, step in enumerate(steps, 1):
+            if version >= step_version:
+                continue
+            with self.transaction() as cursor:
+                # Another process opening the vault at the same time may have applied the step already
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version >= step_version:
+                    continue
+                step(cursor)
+                cursor.execute(f'PRAGMA user_version = {step_version}')
+                version = step_version
+
+    def add_name_index(self, cursor):
+        # Schema version 1: add the name_index column and backfill it from the decrypted names
+        cursor.execute('ALTER TABLE vault ADD COLUMN name_index BLOB')
+        rows = cursor.execute('SELECT id, name FROM vault').fetchall()
+        names = self.cipher.decrypt_column([row[1] for row in rows])
+        cursor.executemany('UPDATE vault SET name_index = ? WHERE id = ?',
+                           [(self.cipher.blind_index(name), row[0]) for row, name in zip(rows, names)])
+        cursor.execute(CREATE_NAME_INDEX_QUERY)
+
+    def add_meta_table(self, cursor):
+        # Schema version 2: record the KDF parameters the vault has been using so far in the new meta table
+        cursor.execute(CREATE_META_TABLE_QUERY)
+        cursor.execute("INSERT INTO meta (key, value) VALUES ('kdf', ?)", (json.dumps(self.kdf_params),))
+
+    def add_record_column(self, cursor):
+        # Schema version 3: rebuild the profiles table with the record column and without the NOT NULL constraints
+        # of the legacy columns. Rows are copied as they are and keep the legacy format until they are converted
+        cursor.execute(CREATE_VAULT_TABLE_QUERY.format(table='vault_v3'))
+        cursor.execute('INSERT INTO vault_v3 (id, name, username, password, link, name_index) '
+                       'SELECT id, name, username, password, link, name_index FROM vault')
+        # Ids of deleted profiles are never given out again
+        found = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'vault'").fetchone()
+        cursor.execute('DROP TABLE vault')
+        cursor.execute('ALTER TABLE vault_v3 RENAME TO vault')
+        if found is not None:
+            cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'vault'", found)
+        cursor.execute(CREATE_NAME_INDEX_QUERY)
 
-        return None
+    def add_change_log(self, cursor):
+        # Schema version 4: start the change log with every existing profile,
+        # so a backup since seq 0 holds the whole vault
+        cursor.execute(CREATE_CHANGES_TABLE_QUERY)
+        cursor.execute('INSERT INTO changes (profile_id) SELECT id FROM vault ORDER BY id')
@@ -0,0 +1,306 @@
+import argparse
+import hashlib
+import hmac
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import local_rpc
+from local_rpc import LocalServer
+from vault import DEFAULT_BUSY_TIMEOUT, Vault, VaultError
+
+# Path of the daemon socket, exported by "vault_daemon.py start"
+DAEMON_SOCKET_ENV = 'BASEDPASS_DAEMON_SOCK'
+
+# Unlocked vaults kept at once. The least recently used one is closed to make room for another
+DEFAULT_MAX_VAULTS = 8
+# Vaults nobody used for this many seconds are closed
+DEFAULT_IDLE_TIMEOUT = 900
+# Threads running vault operations. Every open vault has at most one read connection per thread
+DEFAULT_WORKERS = 4
+# SQLite page cache per connection in KiB and cached profile names per vault
+DEFAULT_CACHE_KIB = 1024
+DEFAULT_NAME_CACHE_SIZE = 4096
+# Rough size of one name cache entry, used to turn the memory cap into a number of vaults
+NAME_CACHE_ENTRY_SIZE = 200
+# Most profiles returned by one get_many request
+MAX_BATCH = 1000
+# get_many requests carry many names, so lines may be longer than for the key agent
+MAX_REQUEST_SIZE = 1024 * 1024
+
+EVICTION_INTERVAL = 5
+CLIENT_TIMEOUT = 30
+
+
+class OpenVault:
+    def __init__(self, vault, token, now):
+        self.vault = vault
+        self.token = token
+        self.last_used = now
+        # Requests running on this vault right now. Vaults in use are closed by the last of them
+        self.users = 0
+
+
+class VaultPool:
+    # Unlocked vaults shared by all clients.
+    # A vault is found by a keyed digest of its name and master password, so opening it again with the same
+    # password skips the key derivation, and a wrong password never reaches an unlocked vault.
+    # Clients refer to an open vault by a random session token
+    def __init__(self, vaults_dir=None, max_vaults=DEFAULT_MAX_VAULTS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 cache_kib=DEFAULT_CACHE_KIB, name_cache_size=DEFAULT_NAME_CACHE_SIZE, clock=time.monotonic,
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.vaults_dir = vaults_dir
+        self.max_vaults = max_vaults
+        self.idle_timeout = idle_timeout
+        self.cache_kib = cache_kib
+        self.name_cache_size = name_cache_size
+        self.clock = clock
+        self.busy_timeout = busy_timeout
+        self.secret = os.urandom(32)
+        # entry id -> OpenVault, least recently used first
+        self.entries = OrderedDict()
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def entry_id(self, vault_name, password):
+        return hmac.new(self.secret, f'{vault_name}\0{password}'.encode(), hashlib.sha256).digest()
+
+    # Token of the unlocked vault, or None when the vault does not exist or the password is wrong.
+    # Raises VaultLockedError when another process keeps the vault locked
+    def open(self, vault_name, password):
+        entry_id = self.entry_id(vault_name, password)
+        with self.lock:
+            entry = self.entries.get(entry_id)
+            if entry is not None:
+                self.entries.move_to_end(entry_id)
+                entry.last_used = self.clock()
+                return entry.token
+
+        vault = Vault(vault_name, password, name_cache_size=self.name_cache_size, vaults_dir=self.vaults_dir,
+                      concurrent=True, cache_size=self.cache_kib, busy_timeout=self.busy_timeout)
+        if not os.path.exists(vault.vault_path()):
+            return None
+        # The key derivation runs outside the lock, other vaults stay usable meanwhile
+        try:
+            opened = vault.open_vault()
+        except VaultError:
+            vault.close_vault()
+            raise
+        if not opened:
+            vault.close_vault()
+            return None
+
+        with self.lock:
+            entry = self.entries.get(entry_id)
+            if entry is not None:
+                # Another client opened the same vault meanwhile
+                vault.close_vault()
+            else:
+                entry = OpenVault(vault, secrets.token_urlsafe(32), self.clock())
+                self.entries[entry_id] = entry
+                self.tokens[entry.token] = entry_id
+            entry.last_used = self.clock()
+            self.evict(self.max_vaults)
+            return entry.token
+
+    @contextmanager
+    def use(self, token):
+        # Yields the vault of the session token, or None when it was closed or evicted
+        with self.lock:
+            entry_id = self.tokens.get(token)
+            entry = self.entries.get(entry_id) if entry_id is not None else None
+            if entry is not None:
+                self.entries.move_to_end(entry_id)
+                entry.last_used = self.clock()
+                entry.users += 1
+
+        try:
+            yield None if entry is None else entry.vault
+        finally:
+            if entry is not None:
+                with self.lock:
+                    entry.users -= 1
+                    if entry.users == 0 and entry.token not in self.tokens:
+                        # Closed by a client meanwhile
+                        entry.vault.close_vault()
+
+    def close(self, token):
+        with self.lock:
+            entry_id = self.tokens.get(token)
+            if entry_id is None:
+                return False
+            self.close_entry(entry_id)
+            return True
+
+    def close_entry(self, entry_id):
+        # Clients that opened the vault with the same password share the token, another one may still be using it.
+        # Later requests with the token find no vault
+        entry = self.entries.pop(entry_id)
+        del self.tokens[entry.token]
+        if entry.users == 0:
+            entry.vault.close_vault()
+
+    def evict(self, max_vaults):
+        # Close idle vaults, then the least recently used ones until at most max_vaults are left.
+        # Called with the lock held
+        now = self.clock()
+        for entry_id, entry in list(self.entries.items()):
+            if entry.users == 0 and now - entry.last_used >= self.idle_timeout:
+                self.close_entry(entry_id)
+
+        for entry_id, entry in list(self.entries.items()):
+            if len(self.entries) <= max_vaults:
+                break
+            if entry.users == 0:
+                self.close_entry(entry_id)
+
+    def evict_expired(self):
+        with self.lock:
+            self.evict(self.max_vaults)
+
+    def close_all(self):
+        with self.lock:
+            for entry_id in list(self.entries):
+                self.close_entry(entry_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class VaultDaemon(LocalServer):
+    max_request_size = MAX_REQUEST_SIZE
+
+    def __init__(self, socket_path, pool, workers=DEFAULT_WORKERS):
+        self.pool = pool
+        # Client connections get a thread each, vault operations run on a fixed pool of workers,
+        # which keeps the number of SQLite connections per vault at workers + 1
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='vault')
+        super().__init__(socket_path)
+        self.last_eviction = time.monotonic()
+
+    def dispatch(self, request):
+        if request['op'] == 'stop':
+            # shutdown() waits for serve_forever, so it can not be called from a request thread directly
+            threading.Thread(target=self.shutdown).start()
+            return {'ok': True}
+        return self.executor.submit(self.handle_request, request).result()
+
+    def handle_request(self, request):
+        match request['op']:
+            case 'open':
+                try:
+                    token = self.pool.open(request['vault'], request['password'])
+                except VaultError as error:
+                    return {'ok': False, 'error': str(error)}
+                if token is None:
+                    return {'ok': False, 'error': f'Failed to open "{request["vault"]}"'}
+                return {'ok': True, 'token': token}
+            case 'close':
+                return {'ok': self.pool.close(request['token'])}
+            case 'stats':
+                return {'ok': True, 'vaults': len(self.pool), 'max_vaults': self.pool.max_vaults}
+
+        with self.pool.use(request['token']) as vault:
+            if vault is None:
+                return {'ok': False, 'error': 'unknown session, open the vault again'}
+            try:
+                return self.handle_vault_request(vault, request)
+            except (sqlite3.Error, VaultError) as error:
+                return {'ok': False, 'error': str(error)}
+
+    def handle_vault_request(self, vault, request):
+        match request['op']:
+            case 'get':
+                profile = vault.get_profile(request['name'])
+                return {'ok': True, 'profile': None if profile is None else list(profile)}
+            case 'get_many':
+                if len(request['names']) > MAX_BATCH:
+                    return {'ok': False, 'error': f'at most {MAX_BATCH} names per request'}
+                return {'ok': True, 'profiles': [None if profile is None else list(profile)
+                                                 for profile in vault.get_profiles(request['names'])]}
+            case 'list':
+                return {'ok': True, 'names': [profile.name for profile in vault.iter_vault_content()]}
+            case 'add':
+                if vault.get_profile_id(request['name']) is not None:
+                    return {'ok': False, 'error': f'"{request["name"]}" already exists'}
+                vault.add_new_profile(request['name'], request['password'], request.get('username'),
+                                      request.get('link'))
+                return {'ok': True}
+            case 'delete':
+                vault.delete_profile(request['name'])
+                return {'ok': True}
+            case _:
+                return {'ok': False, 'error': f'unknown operation "{request["op"]}"'}
+
+    def service_actions(self):
+        # Called by serve_forever between requests
+        if time.monotonic() - self.last_eviction >= EVICTION_INTERVAL:
+            self.pool.evict_expired()
+            self.last_eviction = time.monotonic()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        self.pool.close_all()
+
+
+# Vaults that fit into max_memory bytes: every vault holds up to workers + 1 page caches and its name cache
+def vaults_within_memory(max_memory, workers, cache_kib=DEFAULT_CACHE_KIB,
+                         name_cache_size=DEFAULT_NAME_CACHE_SIZE):
+    vault_size = (workers + 1) * cache_kib * 1024 + name_cache_size * NAME_CACHE_ENTRY_SIZE
+    return max(1, max_memory // vault_size)
+
+
+# Send one request to the daemon. Returns None when no daemon is configured or reachable
+def daemon_request(request, socket_path=None):
+    return local_rpc.request(socket_path or os.environ.get(DAEMON_SOCKET_ENV), request, CLIENT_TIMEOUT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='basedpass vault daemon')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    start_parser = subparsers.add_parser('start', help='run the daemon in the foreground')
+    start_parser.add_argument('--socket', help='socket path (default: a new private temporary directory)')
+    start_parser.add_argument('--vaults-dir', help='directory with the vault files (default: ./vaults)')
+    start_parser.add_argument('--max-vaults', type=int, default=DEFAULT_MAX_VAULTS)
+    start_parser.add_argument('--max-memory', type=int, metavar='MIB',
+                              help='lower --max-vaults so the caches of open vaults fit into this many MiB')
+    start_parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                              help='seconds an unused vault stays unlocked')
+    start_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    subparsers.add_parser('stop', help='close all vaults and stop the daemon')
+    args = parser.parse_args(argv)
+
+    if args.command == 'start':
+        max_vaults = args.max_vaults
+        if args.max_memory is not None:
+            max_vaults = min(max_vaults, vaults_within_memory(args.max_memory * 1024 * 1024, args.workers))
+        socket_path = args.socket or os.path.join(tempfile.mkdtemp(prefix='basedpass-'), 'daemon.sock')
+        pool = VaultPool(args.vaults_dir, max_vaults, args.idle_timeout)
+        daemon = VaultDaemon(socket_path, pool, args.workers)
+        print(f'{DAEMON_SOCKET_ENV}={socket_path}; export {DAEMON_SOCKET_ENV};', flush=True)
+        try:
+            daemon.serve_forever(poll_interval=1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.server_close()
+        return 0
+
+    response = daemon_request({'op': args.command})
+    if not response or not response.get('ok'):
+        print(f'No daemon is reachable. Is {DAEMON_SOCKET_ENV} set?', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+import unittest
+from unittest import mock
+
+from key_agent_test import FakeClock
+from local_rpc import Client
+from vault_daemon import VaultDaemon, VaultPool, vaults_within_memory
+from vault_test import VaultDirTestCase
+
+
+class TestVaultPool(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.pool = VaultPool(max_vaults=1, idle_timeout=10, clock=self.clock)
+
+    def test_open_again_skips_key_derivation(self):
+        token = self.pool.open('test', '123')
+        self.assertIsNotNone(token)
+        with mock.patch('vault.derive_key', side_effect=AssertionError('key derived twice')):
+            self.assertEqual(self.pool.open('test', '123'), token)
+        self.assertIsNone(self.pool.open('test', 'qwerty'))
+        self.assertIsNone(self.pool.open('missing', '123'))
+
+    def test_lru_eviction(self):
+        token = self.pool.open('test', '123')
+        self.pool.open('emptyvault', 'qwerty')
+        self.assertEqual(len(self.pool), 1)
+        with self.pool.use(token) as vault:
+            self.assertIsNone(vault)
+
+    def test_idle_eviction(self):
+        token = self.pool.open('test', '123')
+        self.clock.now += 9
+        with self.pool.use(token) as vault:
+            self.assertEqual(vault.get_profile('vk')[2], 'qwerty123')
+            # Vaults in use are kept however long the request takes
+            self.clock.now += 20
+            self.pool.evict_expired()
+            self.assertEqual(len(self.pool), 1)
+
+        self.clock.now += 10
+        self.pool.evict_expired()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_close_while_in_use(self):
+        # Another client with the same token closes the vault during a request
+        token = self.pool.open('test', '123')
+        with self.pool.use(token) as vault:
+            self.assertTrue(self.pool.close(token))
+            self.assertEqual(vault.get_profile('vk')[2], 'qwerty123')
+            with self.pool.use(token) as closed:
+                self.assertIsNone(closed)
+        self.assertIsNone(vault.connection)
+        self.assertFalse(self.pool.close(token))
+
+    def test_vaults_within_memory(self):
+        self.assertEqual(vaults_within_memory(0, 4), 1)
+        self.assertEqual(vaults_within_memory(100 * 1024 * 1024, 3, cache_kib=1024, name_cache_size=0), 25)
+
+    def tearDown(self):
+        self.pool.close_all()
+        super().tearDown()
+
+
+class TestVaultDaemon(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket_path = os.path.join(self.temp_dir, 'daemon.sock')
+        self.daemon = VaultDaemon(self.socket_path, VaultPool(busy_timeout=0.01), workers=2)
+        self.thread = threading.Thread(target=self.daemon.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.client = Client(self.socket_path, timeout=10)
+
+    def open(self, name='test', password='123'):
+        response = self.client.call({'op': 'open', 'vault': name, 'password': password})
+        self.assertTrue(response['ok'])
+        return response['token']
+
+    def test_profile_requests(self):
+        token = self.open()
+        response = self.client.call({'op': 'get', 'token': token, 'name': 'vk'})
+        self.assertEqual(response['profile'][2], 'qwerty123')
+
+        self.assertTrue(self.client.call({'op': 'add', 'token': token, 'name': 'github', 'password': 'pw'})['ok'])
+        self.assertFalse(self.client.call({'op': 'add', 'token': token, 'name': 'github', 'password': 'pw'})['ok'])
+        self.assertIn('github', self.client.call({'op': 'list', 'token': token})['names'])
+        self.assertTrue(self.client.call({'op': 'delete', 'token': token, 'name': 'github'})['ok'])
+        self.assertIsNone(self.client.call({'op': 'get', 'token': token, 'name': 'github'})['profile'])
+
+    def test_get_many(self):
+        token = self.open()
+        response = self.client.call({'op': 'get_many', 'token': token, 'names': ['vk', 'missing', 'gmail', 'vk']})
+        profiles = response['profiles']
+        self.assertEqual([profile and profile[0] for profile in profiles], ['vk', None, 'gmail', 'vk'])
+        self.assertEqual(profiles[2], self.client.call({'op': 'get', 'token': token, 'name': 'gmail'})['profile'])
+
+    def test_sessions(self):
+        self.assertFalse(self.client.call({'op': 'open', 'vault': 'test', 'password': 'qwerty'})['ok'])
+        token = self.open()
+        self.assertEqual(self.client.call({'op': 'stats'})['vaults'], 1)
+        self.assertTrue(self.client.call({'op': 'close', 'token': token})['ok'])
+        self.assertFalse(self.client.call({'op': 'get', 'token': token, 'name': 'vk'})['ok'])
+        self.assertFalse(self.client.call({'op': 'get', 'name': 'vk'})['ok'])
+
+    def test_unexpected_error(self):
+        token = self.open()
+        with mock.patch.object(self.daemon, 'handle_error') as handle_error:
+            with mock.patch('vault.Vault.get_profile', side_effect=RuntimeError('broken')):
+                response = self.client.call({'op': 'get', 'token': token, 'name': 'vk'})
+        self.assertEqual(response, {'ok': False, 'error': 'internal error: broken'})
+        handle_error.assert_called_once()
+        # The connection survives the failed request
+        self.assertEqual(self.client.call({'op': 'get', 'token': token, 'name': 'vk'})['profile'][2], 'qwerty123')
+
+    def test_locked_vault(self):
+        token = self.open()
+        locks = []
+        for name in ('test', 'emptyvault'):
+            # Another process holding the write lock
+            lock = sqlite3.connect(os.path.join('vaults', f'{name}.db'), isolation_level=None)
+            lock.execute('BEGIN EXCLUSIVE')
+            locks.append(lock)
+
+        with mock.patch('vault.LOCK_RETRIES', 1):
+            response = self.client.call({'op': 'add', 'token': token, 'name': 'github', 'password': 'pw'})
+            self.assertFalse(response['ok'])
+            self.assertIn('locked', response['error'])
+            response = self.client.call({'op': 'open', 'vault': 'emptyvault', 'password': 'qwerty'})
+            self.assertFalse(response['ok'])
+            self.assertIn('locked', response['error'])
+
+        for lock in locks:
+            lock.close()
+        # The connection and the daemon are still usable
+        self.assertTrue(self.client.call({'op': 'add', 'token': token, 'name': 'github', 'password': 'pw'})['ok'])
+        self.open('emptyvault', 'qwerty')
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
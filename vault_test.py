@@ -1,12 +1,45 @@
+import itertools
+import json
+import math
+import os
+import shutil
+import sqlite3
+import string
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
 import password_generator
-from vault import Vault
+from data_encryption import Cipher, Fernet, ParallelDecryptor, SessionClosedError
+from importers import read_profiles
+from search_index import SearchIndex
+from data_encryption import calibrate_kdf, new_kdf_params
+from menu_options import PASSWORD_MASK, listing_rows
+from profiles import NOT_DECRYPTED, Profile
+from vault import (SCHEMA_VERSION, NotAVaultError, Vault, VaultExistsError, VaultLockedError, VaultNotFoundError,
+                   WrongPasswordError)
 from password_generator import *
 
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vaults')
 
-class TestVault(unittest.TestCase):
+
+class VaultDirTestCase(unittest.TestCase):
+    # Runs each test against fresh copies of the fixture vaults, so the checked-in files are never modified
+    def setUp(self):
+        self.previous_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        shutil.copytree(FIXTURES_DIR, os.path.join(self.temp_dir, 'vaults'))
+        os.chdir(self.temp_dir)
+
+    def tearDown(self):
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.temp_dir)
+
+
+class TestVault(VaultDirTestCase):
     def setUp(self):
+        super().setUp()
         self.vault = Vault('test', '123')
         self.vault.open_vault()
 
@@ -48,8 +81,557 @@ class TestVault(unittest.TestCase):
         self.assertEqual(self.vault2.open_vault(), True)
         self.assertEqual(self.vault3.open_vault(), False)
 
+    def test_add_update_delete_profile(self):
+        self.assertEqual(self.vault.add_new_profile('github', 'pa$$', username='octocat'), None)
+        self.assertEqual(self.vault.get_profile('github'), ['github', 'octocat', 'pa$$', None])
+        self.assertEqual(self.vault.add_new_profile('github', 'other'), None)
+        self.assertEqual(self.vault.get_profile('github'), ['github', 'octocat', 'pa$$', None])
+
+        self.vault.update_profile('github', username='octocat', password='new', link='github.com')
+        self.assertEqual(self.vault.get_profile('github'), ['github', 'octocat', 'new', 'github.com'])
+
+        self.vault.delete_profile('github')
+        self.assertEqual(self.vault.get_profile('github'), None)
+        self.assertEqual(self.vault.get_profile_id('github'), None)
+
+    def test_add_profiles_bulk(self):
+        profiles = [
+            ('github', 'octocat', 'pw1', 'github.com'),
+            ('gmail', 'other', 'pw2', None),
+            ('github', None, 'pw3', None),
+            ('', None, 'pw4', None),
+            ('nopass', None, None, None),
+            ('gitlab', '', 'pw5', ''),
+        ]
+        added, conflicts = self.vault.add_profiles_bulk(iter(profiles), batch_size=1)
+
+        self.assertEqual(added, 2)
+        self.assertEqual([(row, reason) for row, _, reason in conflicts],
+                         [(2, 'profile name already exists'), (3, 'profile name already exists'),
+                          (4, 'profile name is empty'), (5, 'password is empty')])
+        self.assertEqual(self.vault.get_profile('github'), ['github', 'octocat', 'pw1', 'github.com'])
+        self.assertEqual(self.vault.get_profile('gitlab'), ['gitlab', None, 'pw5', None])
+        self.assertEqual(len(self.vault.get_vault_content()), 7)
+
+    def test_import_files(self):
+        csv_path = os.path.join(self.temp_dir, 'keepass.csv')
+        with open(csv_path, 'w', encoding='utf-8') as file:
+            file.write('"Group","Title","Username","Password","URL","Notes"\n'
+                       '"Root","github","octocat","pw1","github.com",""\n'
+                       '"Root","gitlab","","pw2","",""\n')
+        json_path = os.path.join(self.temp_dir, 'bitwarden.json')
+        with open(json_path, 'w', encoding='utf-8') as file:
+            json.dump({'items': [{'type': 1, 'name': 'mail',
+                                  'login': {'username': 'me', 'password': 'pw3', 'uris': [{'uri': 'mail.com'}]}},
+                                 {'type': 2, 'name': 'note'}]}, file)
+
+        self.assertEqual(list(read_profiles(csv_path)),
+                         [('github', 'octocat', 'pw1', 'github.com'), ('gitlab', None, 'pw2', None)])
+        added, conflicts = self.empty_vault.add_profiles_bulk(read_profiles(json_path))
+        self.assertEqual(added, 1)
+        self.assertEqual(conflicts, [(2, 'note', 'password is empty')])
+        self.assertEqual(self.empty_vault.get_profile('mail'), ['mail', 'me', 'pw3', 'mail.com'])
+
+    def test_lazy_profiles(self):
+        # Legacy rows decrypt only the fields that are used
+        profile = self.vault.get_profile('gmail')
+        self.assertIsInstance(profile, Profile)
+        self.assertEqual(profile.name, 'gmail')
+        self.assertEqual(profile.values[1:], [NOT_DECRYPTED] * 3)
+
+        content = self.vault.get_vault_content()
+        rows = listing_rows(content)
+        self.assertEqual(rows[1], ['vk', 'newbox@yandex.ru', PASSWORD_MASK, 'vk.com'])
+        self.assertEqual(content[1].values[2], NOT_DECRYPTED)
+        self.assertEqual(listing_rows([profile], reveal_passwords=True)[0][2], r'6"T[~$v!vJf`<g/ea;0)bz')
+
+        # Packed records are decrypted once, on first use of any field
+        self.vault.add_new_profile('github', 'pw', username='octocat')
+        profile = self.vault.get_profile('github')
+        self.assertEqual(profile.username, 'octocat')
+        self.assertEqual(profile.values, ['github', 'octocat', 'pw', None])
+        self.assertEqual(profile.record, None)
+        # A masked listing of a packed record decrypts its password as well, it is only hidden from the screen
+        packed = self.vault.get_profile('github')
+        self.assertEqual(listing_rows([packed])[0][2], PASSWORD_MASK)
+        self.assertEqual(packed.values[2], 'pw')
+
+        self.assertEqual(profile[-1], None)
+        self.assertEqual(profile[:2], ['github', 'octocat'])
+        self.assertEqual(dict(zip(('name', 'password'), profile[::2])), {'name': 'github', 'password': 'pw'})
+        self.assertNotIn('pw', repr(profile))
+        with self.assertRaises(AttributeError):
+            profile.notes = 'slots only'
+
+    def test_profiles_after_close(self):
+        # Closing the vault ends the session of the profiles read from it, fields not decrypted yet stay encrypted
+        legacy = self.vault.get_profile('gmail')
+        self.assertEqual(legacy.name, 'gmail')
+        self.vault.add_new_profile('github', 'pw')
+        packed = self.vault.get_profile('github')
+        self.vault.close_vault()
+
+        self.assertEqual(legacy.name, 'gmail')
+        with self.assertRaises(SessionClosedError):
+            legacy.password
+        with self.assertRaises(SessionClosedError):
+            packed.password
+
+    def test_vault_pages(self):
+        names = ['gmail', 'vk', 'steam', 'ozon', 'Яндекс']
+        profiles, after_id = self.vault.get_vault_page(0, 2)
+        self.assertEqual([profile[0] for profile in profiles], names[:2])
+        profiles, after_id = self.vault.get_vault_page(after_id, 3)
+        self.assertEqual([profile[0] for profile in profiles], names[2:])
+        self.assertEqual(after_id, None)
+
+        self.assertEqual([profile[0] for profile in self.vault.iter_vault_content(page_size=2)], names)
+        self.assertEqual(self.empty_vault.get_vault_page(), ([], None))
+
+    def test_parallel_vault_content(self):
+        profiles = [(f'profile-{i}', f'user-{i}', f'pw-{i}', None) for i in range(1200)]
+        self.empty_vault.add_profiles_bulk(profiles)
+
+        parallel_vault = Vault('emptyvault', 'qwerty', workers=2)
+        parallel_vault.open_vault()
+        try:
+            self.assertEqual(parallel_vault.get_vault_content(), self.empty_vault.get_vault_content())
+            self.assertEqual(len(parallel_vault.extract_all_profile_names()), 1200)
+        finally:
+            parallel_vault.close_vault()
+
+    def test_search(self):
+        self.assertEqual(self.vault.search('vk')[0], ('vk', 'vk.com'))
+        self.assertEqual(self.vault.search('GMAIL.')[0], ('gmail', 'gmail.com'))
+        self.assertEqual(self.vault.search('stem')[0][0], 'steam')
+        self.assertEqual(self.vault.search('яНД')[0][0], 'Яндекс')
+        self.assertEqual(self.vault.search('qqqq'), [])
+
+        # The index follows changes made after it was built
+        self.vault.add_new_profile('steampowered', 'pw', link='store.steampowered.com')
+        self.assertEqual([name for name, _ in self.vault.search('steam')], ['steam', 'steampowered'])
+        self.vault.update_profile('steampowered', None, 'pw', 'steam.example')
+        self.assertEqual(self.vault.search('example'), [('steampowered', 'steam.example')])
+        self.vault.delete_profile('steampowered')
+        self.assertEqual([name for name, _ in self.vault.search('steam')], ['steam'])
+
+        self.vault.add_profiles_bulk([('steamdeck', None, 'pw', None)])
+        self.assertEqual([name for name, _ in self.vault.search('steam')], ['steam', 'steamdeck'])
+
+        self.vault.close_vault()
+        self.assertEqual(self.vault.search_index, None)
+        self.vault.open_vault()
+
+    def test_name_cache(self):
+        small_cache_vault = Vault('test', '123', name_cache_size=2)
+        small_cache_vault.open_vault()
+        for name in ['gmail', 'vk', 'steam']:
+            self.assertIsNotNone(small_cache_vault.get_profile_id(name))
+        self.assertEqual(list(small_cache_vault.name_cache), ['vk', 'steam'])
+
+        small_cache_vault.add_new_profile('github', 'pw')
+        self.assertEqual(list(small_cache_vault.name_cache), ['steam', 'github'])
+        small_cache_vault.delete_profile('github')
+        self.assertNotIn('github', small_cache_vault.name_cache)
+        self.assertEqual(small_cache_vault.get_profile_id('github'), None)
+
+        small_cache_vault.close_vault()
+        self.assertEqual(len(small_cache_vault.name_cache), 0)
+
+    def test_name_cache_disabled(self):
+        uncached_vault = Vault('test', '123', name_cache_size=0)
+        uncached_vault.open_vault()
+        self.assertEqual(uncached_vault.get_profile('vk')[0], 'vk')
+        self.assertEqual(len(uncached_vault.name_cache), 0)
+        uncached_vault.close_vault()
+
+    def test_name_index_migration(self):
+        # Fixture vaults predate the name_index column and are migrated on open
+        connection = sqlite3.connect(os.path.join('vaults', 'test.db'))
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM vault WHERE name_index IS NULL').fetchone()[0], 0)
+        connection.close()
+
+        reopened = Vault('test', '123')
+        self.assertTrue(reopened.open_vault())
+        self.assertEqual(reopened.get_profile('Яндекс')[0], 'Яндекс')
+        reopened.close_vault()
+
+    def test_concurrent_migration(self):
+        # Two processes open a legacy vault at once: the second one to take the write lock
+        # finds the schema upgraded already and skips the steps
+        os.mkdir('legacy')
+        shutil.copy(os.path.join(FIXTURES_DIR, 'test.db'), 'legacy')
+        first = Vault('test', '123', use_agent=False, vaults_dir='legacy')
+        with mock.patch.object(Vault, 'migrate'):
+            self.assertTrue(first.open_vault())
+
+        transaction = first.transaction
+        other_opened = []
+
+        def migrated_meanwhile():
+            if not other_opened:
+                with Vault('test', '123', use_agent=False, vaults_dir='legacy'):
+                    other_opened.append(True)
+            return transaction()
+
+        with mock.patch.object(first, 'transaction', side_effect=migrated_meanwhile):
+            first.migrate()
+        self.assertEqual(other_opened, [True])
+        self.assertEqual(first.connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        self.assertEqual(first.connection.execute('SELECT COUNT(*) FROM changes').fetchone()[0], 5)
+        self.assertEqual(first.get_profile('vk')[0], 'vk')
+        first.close_vault()
+
+    def test_record_formats(self):
+        # Fixture rows are in the legacy format, new rows are packed, and both are read the same way
+        self.vault.add_new_profile('github', 'pw', link='github.com')
+        formats = dict(self.vault.connection.execute('SELECT id, record IS NOT NULL FROM vault').fetchall())
+        self.assertEqual(sorted(formats.values()), [0, 0, 0, 0, 0, 1])
+        self.assertEqual(self.vault.get_profiles(['github', 'vk'])[0], ['github', None, 'pw', 'github.com'])
+
+        content = [list(profile) for profile in self.vault.get_vault_content()]
+        self.vault.update_profile('vk', 'newbox@yandex.ru', 'changed', 'vk.com')
+        self.assertEqual(self.vault.convert_records(), 4)
+        self.assertEqual(self.vault.convert_records(), 0)
+        self.assertEqual(self.vault.connection.execute('SELECT COUNT(*) FROM vault WHERE record IS NULL OR '
+                                                       'name IS NOT NULL').fetchone()[0], 0)
+        content[1][2] = 'changed'
+        self.assertEqual(self.vault.get_vault_content(), content)
+        self.assertEqual(self.vault.search('github')[0], ('github', 'github.com'))
+
+        with self.assertRaises(ValueError):
+            self.vault.cipher.decrypt_record(b'\x07' + self.vault.cipher.encrypt_record(['a'])[1:])
+
+    def test_legacy_kdf_params_recorded(self):
+        self.assertEqual(self.vault.kdf_params['iterations'], 600000)
+        self.assertEqual(self.vault.read_kdf_params(), self.vault.kdf_params)
+
+    def test_change_kdf(self):
+        content = self.vault.get_vault_content()
+        for kdf_params in [new_kdf_params('scrypt', n=2 ** 12), new_kdf_params('pbkdf2', iterations=1000)]:
+            self.vault.change_kdf(kdf_params)
+            self.assertEqual(self.vault.get_vault_content(), content)
+
+            reopened = Vault('test', '123', use_agent=False)
+            self.assertTrue(reopened.open_vault())
+            self.assertEqual(reopened.kdf_params, kdf_params)
+            self.assertEqual(reopened.get_profile('gmail'), content[0])
+            reopened.close_vault()
+            self.assertFalse(Vault('test', 'qwerty', use_agent=False).open_vault())
+
+    def test_rekey(self):
+        content = self.vault.get_vault_content()
+        calls = []
+        self.vault.rekey('new password', lambda done, total: calls.append((done, total)))
+        self.assertEqual(calls, [(5, 5)])
+        self.assertEqual(self.vault.get_profile('vk'), content[1])
+
+        self.assertFalse(Vault('test', '123', use_agent=False).open_vault())
+        reopened = Vault('test', 'new password', use_agent=False)
+        self.assertTrue(reopened.open_vault())
+        self.assertEqual(reopened.kdf_params['iterations'], 600000)
+        self.assertEqual(reopened.get_vault_content(), content)
+        reopened.close_vault()
+
+    def test_rekey_failure_leaves_vault_untouched(self):
+        def fail(done, total):
+            raise RuntimeError('interrupted')
+
+        self.empty_vault.add_new_profile('mail', 'pw')
+        with self.assertRaises(RuntimeError):
+            self.empty_vault.rekey('other', fail)
+        self.assertEqual(self.empty_vault.master_password, 'qwerty')
+        self.assertEqual(self.empty_vault.get_profile('mail'), ['mail', None, 'pw', None])
+        self.assertTrue(Vault('emptyvault', 'qwerty', use_agent=False).open_vault())
+
+    def test_calibrate_kdf(self):
+        self.assertGreaterEqual(calibrate_kdf(0.01, 'pbkdf2')['iterations'], 10000)
+        self.assertGreaterEqual(calibrate_kdf(0.01, 'scrypt')['n'], 2 ** 12)
+        with self.assertRaises(ValueError):
+            calibrate_kdf(0.01, 'md5')
+
+    def test_create_vault(self):
+        new_vault = Vault('created', 'secret')
+        new_vault.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+        new_vault.add_new_profile('mail', 'pw')
+        new_vault.close_vault()
+
+        reopened = Vault('created', 'secret')
+        self.assertTrue(reopened.open_vault())
+        self.assertEqual(reopened.get_profile('mail'), ['mail', None, 'pw', None])
+        reopened.close_vault()
+
+    def tearDown(self):
+        self.vault.close_vault()
+        self.empty_vault.close_vault()
+        super().tearDown()
+
+
+class TestConcurrentVault(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vault = Vault('shared', 'secret', use_agent=False, concurrent=True)
+        self.vault.create_vault(new_kdf_params('pbkdf2', iterations=1000))
+        for index in range(50):
+            self.vault.add_new_profile(f'profile-{index}', f'password-{index}')
+
+    def test_wal_mode(self):
+        self.assertEqual(self.vault.connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_parallel_readers_and_writers(self):
+        errors = []
+
+        def reader(thread_idx):
+            try:
+                for round_idx in range(100):
+                    index = (thread_idx + round_idx) % 50
+                    self.assertEqual(self.vault.get_profile(f'profile-{index}')[2], f'password-{index}')
+                    self.vault.search('profile-1', limit=5)
+                    self.vault.get_vault_page(page_size=10)
+            except Exception as error:
+                errors.append(error)
+
+        def writer(thread_idx):
+            try:
+                for round_idx in range(30):
+                    name = f'new-{thread_idx}-{round_idx}'
+                    self.vault.add_new_profile(name, 'pw')
+                    self.vault.update_profile(name, 'user', 'changed', None)
+                    if round_idx % 2:
+                        self.vault.delete_profile(name)
+            except Exception as error:
+                errors.append(error)
+
+        # A second Vault has its own writer connection, like another process would
+        other = Vault('shared', 'secret', use_agent=False, concurrent=True)
+        other.open_vault()
+
+        def other_writer():
+            try:
+                for round_idx in range(30):
+                    other.add_new_profile(f'other-{round_idx}', 'pw')
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=reader, args=(index,)) for index in range(4)]
+        threads += [threading.Thread(target=writer, args=(index,)) for index in range(3)]
+        threads.append(threading.Thread(target=other_writer))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        other.close_vault()
+
+        self.assertEqual(errors, [])
+        names = {profile[0] for profile in self.vault.get_vault_content()}
+        self.assertEqual(len(names), 50 + 3 * 15 + 30)
+        self.assertIn('new-2-28', names)
+        self.assertNotIn('new-2-29', names)
+        self.assertEqual(self.vault.get_profile('new-0-0'), ['new-0-0', 'user', 'changed', None])
+
+    def test_deleted_elsewhere(self):
+        self.assertIsNotNone(self.vault.get_profile_id('profile-1'))
+        with Vault('shared', 'secret', use_agent=False) as other:
+            other.delete_profile('profile-1')
+        self.assertEqual(self.vault.get_profile('profile-1'), None)
+        self.assertNotIn('profile-1', self.vault.name_cache)
+
+    def test_context_manager(self):
+        with Vault('shared', 'secret', use_agent=False) as vault:
+            self.assertEqual(vault.get_profile('profile-3')[2], 'password-3')
+        self.assertIsNone(vault.connection)
+
+        with self.assertRaises(WrongPasswordError):
+            with Vault('shared', 'wrong', use_agent=False):
+                pass
+
     def tearDown(self):
         self.vault.close_vault()
+        super().tearDown()
+
+
+class TestLockedVault(VaultDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vault = Vault('test', '123', use_agent=False, busy_timeout=0.01)
+        self.vault.open_vault()
+        # Another process holding the write lock
+        self.other = sqlite3.connect(os.path.join('vaults', 'test.db'), isolation_level=None, check_same_thread=False)
+
+    def test_missing_and_existing_vaults(self):
+        with self.assertRaises(VaultNotFoundError):
+            Vault('missing', '123', use_agent=False).open_vault()
+        # Opening a missing vault does not leave an empty file behind
+        self.assertFalse(os.path.exists(os.path.join('vaults', 'missing.db')))
+        with self.assertRaises(VaultExistsError):
+            Vault('test', '123', use_agent=False).create_vault()
+
+    def test_not_a_vault(self):
+        # Older versions left an empty file behind for every mistyped vault name
+        open(os.path.join('vaults', 'typo.db'), 'wb').close()
+        vault = Vault('typo', '123', use_agent=False)
+        with self.assertRaises(NotAVaultError):
+            vault.open_vault()
+        vault.close_vault()
+
+        with open(os.path.join('vaults', 'garbage.db'), 'wb') as file:
+            file.write(b'not a database' * 100)
+        with self.assertRaises(NotAVaultError):
+            Vault('garbage', '123', use_agent=False).open_vault()
+
+    def test_locked_vault(self):
+        self.other.execute('BEGIN EXCLUSIVE')
+        with self.assertRaises(VaultLockedError):
+            self.vault.add_new_profile('github', 'pw')
+        with self.assertRaises(VaultLockedError):
+            self.vault.get_profile('ozon')
+        with self.assertRaises(VaultLockedError):
+            Vault('test', '123', use_agent=False, busy_timeout=0.01).open_vault()
+
+        self.other.execute('ROLLBACK')
+        self.vault.add_new_profile('github', 'pw')
+        self.assertEqual(self.vault.get_profile('github').password, 'pw')
+
+    def test_retry_outlasts_short_lock(self):
+        # The lock is released while the vault waits between retries
+        self.other.execute('BEGIN EXCLUSIVE')
+        release = threading.Timer(0.03, self.other.execute, ('ROLLBACK',))
+        release.start()
+        self.vault.add_new_profile('github', 'pw')
+        release.join()
+        self.assertEqual(self.vault.get_profile('github').password, 'pw')
+
+    def tearDown(self):
+        self.other.close()
+        self.vault.close_vault()
+        super().tearDown()
+
+
+class TestSnapshotVault(VaultDirTestCase):
+    def file_profile(self, profile_name):
+        with Vault('test', '123', use_agent=False) as vault:
+            found = vault.get_profile(profile_name)
+            return None if found is None else list(found)
+
+    def test_write_through(self):
+        with Vault('test', '123', use_agent=False, snapshot=True) as vault:
+            self.assertEqual(vault.connection.execute('PRAGMA database_list').fetchone()[2], '')
+            # The migration of the legacy fixture reached the file as well
+            self.assertEqual(vault.file_connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+
+            vault.add_new_profile('github', 'pw')
+            self.assertFalse(vault.dirty)
+            self.assertEqual(self.file_profile('github'), ['github', None, 'pw', None])
+
+            # A failed statement leaves both copies as they were
+            self.assertEqual(vault.add_new_profile('github', 'other'), None)
+            vault.update_profile('github', 'octocat', 'changed', None)
+            self.assertEqual(self.file_profile('github'), ['github', 'octocat', 'changed', None])
+            vault.delete_profile('vk')
+            self.assertEqual(self.file_profile('vk'), None)
+            self.assertEqual(len(vault.get_vault_content()), 5)
+
+    def test_write_by_another_connection(self):
+        # Ids given out by the file and by the snapshot must not drift apart when another process writes
+        with Vault('test', '123', use_agent=False, snapshot=True) as vault:
+            vault.get_profile_id('vk')
+            with Vault('test', '123', use_agent=False) as other:
+                other.add_new_profile('cron-profile', 'pw')
+            self.assertEqual(vault.get_profile('cron-profile').password, 'pw')
+
+            with Vault('test', '123', use_agent=False) as other:
+                other.delete_profile('vk')
+                other.add_new_profile('cron-2', 'pw')
+            vault.add_new_profile('menu-profile', 'pw')
+            vault.update_profile('menu-profile', 'user', 'changed', None)
+            self.assertEqual(vault.get_profile('vk'), None)
+            vault.delete_profile('menu-profile')
+
+        self.assertEqual(self.file_profile('cron-profile'), ['cron-profile', None, 'pw', None])
+        self.assertEqual(self.file_profile('cron-2'), ['cron-2', None, 'pw', None])
+        self.assertEqual(self.file_profile('menu-profile'), None)
+
+    def test_deferred_write_back(self):
+        vault = Vault('test', '123', use_agent=False, snapshot=True, write_through=False)
+        vault.open_vault()
+        vault.add_profiles_bulk([('github', None, 'pw', None), ('gitlab', None, 'pw', None)])
+        self.assertTrue(vault.dirty)
+        self.assertEqual(self.file_profile('github'), None)
+        self.assertEqual(vault.get_profile('github').password, 'pw')
+
+        vault.flush()
+        self.assertFalse(vault.dirty)
+        self.assertEqual(self.file_profile('github'), ['github', None, 'pw', None])
+
+        vault.delete_profile('gitlab')
+        vault.close_vault()
+        self.assertEqual(self.file_profile('gitlab'), None)
+
+    def test_rejects_concurrent_mode(self):
+        with self.assertRaises(ValueError):
+            Vault('test', '123', snapshot=True, concurrent=True)
+
+
+class TestCipher(unittest.TestCase):
+    def setUp(self):
+        self.cipher = Cipher(Fernet.generate_key())
+
+    def test_rows_round_trip(self):
+        rows = [('gmail', 'me', 'pw', None), ('vk', None, 'pw2', 'vk.com')]
+        encrypted_rows = self.cipher.encrypt_rows(rows)
+        self.assertEqual(encrypted_rows[0][3], None)
+        self.assertEqual(self.cipher.decrypt_rows(encrypted_rows), [list(row) for row in rows])
+
+    def test_records_round_trip(self):
+        rows = [('gmail', 'me', 'pw', None), ('', None, 'пароль', 'vk.com')]
+        records = self.cipher.encrypt_records(rows)
+        self.assertEqual([self.cipher.decrypt_record(record) for record in records], [list(row) for row in rows])
+        legacy = self.cipher.encrypt_rows(rows[:1])[0]
+        self.assertEqual(self.cipher.decrypt_records([(records[1], None, None, None, None), (None,) + legacy]),
+                         [list(rows[1]), list(rows[0])])
+
+    def test_column_is_not_mutated(self):
+        values = ['a', None, 'c']
+        encrypted = self.cipher.encrypt_column(values)
+        self.assertEqual(values, ['a', None, 'c'])
+        self.assertEqual(self.cipher.decrypt_column(encrypted), values)
+
+    def test_parallel_decryptor_keeps_order(self):
+        rows = self.cipher.encrypt_rows([(str(i), None) for i in range(1000)])
+        for use_processes in (False, True):
+            decryptor = ParallelDecryptor(self.cipher.key, workers=3, use_processes=use_processes)
+            try:
+                self.assertEqual(decryptor.decrypt_rows(rows, chunk_size=64), [[str(i), None] for i in range(1000)])
+            finally:
+                decryptor.close()
+
+    def test_blind_index(self):
+        self.assertEqual(self.cipher.blind_index('gmail'), self.cipher.blind_index('gmail'))
+        self.assertNotEqual(self.cipher.blind_index('gmail'), self.cipher.blind_index('Gmail'))
+        self.assertNotEqual(self.cipher.blind_index('gmail'), Cipher(Fernet.generate_key()).blind_index('gmail'))
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex()
+        for profile_id, (name, link) in enumerate([('github', 'github.com'), ('gitlab', 'gitlab.com'),
+                                                   ('my github work', None), ('bank', 'online.bank.org')]):
+            self.index.add(profile_id, name, link)
+
+    def test_ranking(self):
+        self.assertEqual([name for _, _, name, _ in self.index.search('github')], ['github', 'my github work'])
+        self.assertEqual([name for _, _, name, _ in self.index.search('git')], ['github', 'gitlab', 'my github work'])
+        self.assertEqual([name for _, _, name, _ in self.index.search('online')], ['bank'])
+        self.assertEqual([name for _, _, name, _ in self.index.search('githb')][0], 'github')
+        self.assertEqual(len(self.index.search('g', limit=2)), 2)
+
+    def test_remove(self):
+        self.index.remove(0)
+        self.assertEqual([name for _, _, name, _ in self.index.search('github')], ['my github work'])
+        self.index.clear()
+        self.assertEqual(self.index.search('git'), [])
+        self.assertEqual(len(self.index.name_postings), 0)
 
 
 class TestPasswordGenerator(unittest.TestCase):
@@ -65,6 +647,45 @@ class TestPasswordGenerator(unittest.TestCase):
         self.assertTrue(if_intersect(digits, generate_pass(9, (digits,))))
         self.assertFalse(if_intersect(special_chars, generate_pass(64, (digits, letters))))
 
+    def test_generate_pass_covers_every_class(self):
+        for _ in range(200):
+            password = generate_pass(4, (string.ascii_lowercase, string.ascii_uppercase, digits, special_chars))
+            self.assertEqual(len(password), 4)
+            for characters in (string.ascii_lowercase, string.ascii_uppercase, digits, special_chars):
+                self.assertTrue(if_intersect(characters, password))
+        with self.assertRaises(ValueError):
+            generate_pass(2, (letters, digits, special_chars))
+
+    def test_generate_passwords_policy(self):
+        passwords = generate_passwords(100, 12, (letters, digits), PasswordPolicy(min_per_class=3, exclude='0Ol1'))
+        self.assertEqual(len(passwords), 100)
+        for password in passwords:
+            self.assertEqual(len(password), 12)
+            self.assertGreaterEqual(sum(character in digits for character in password), 3)
+            self.assertFalse(if_intersect('0Ol1', password))
+
+    def test_sampler_is_uniform_over_valid_passwords(self):
+        sampler = PasswordSampler(4, ('ab', '12', '-'))
+        passwords = {sampler.decode(number) for number in range(sampler.total)}
+        valid = {''.join(characters) for characters in itertools.product('ab12-', repeat=4)
+                 if all(if_intersect(class_characters, characters) for class_characters in ('ab', '12', '-'))}
+        self.assertEqual(passwords, valid)
+        self.assertAlmostEqual(password_entropy(4, ('ab', '12', '-')), math.log2(len(valid)))
+
+        sampler = PasswordSampler(5, ('ab', '1'), PasswordPolicy(min_per_class=2))
+        passwords = [sampler.decode(number) for number in range(sampler.total)]
+        valid = {''.join(characters) for characters in itertools.product('ab1', repeat=5)
+                 if 2 <= characters.count('1') <= 3}
+        self.assertEqual(len(passwords), len(valid))
+        self.assertEqual(set(passwords), valid)
+
+    def test_sampler_length_limit(self):
+        classes = [CHARACTER_CLASSES[name] for name in ('lower', 'upper', 'digits', 'special')]
+        password = PasswordSampler(MAX_PASSWORD_LENGTH, classes).generate()
+        self.assertEqual(len(password), MAX_PASSWORD_LENGTH)
+        with self.assertRaises(ValueError):
+            PasswordSampler(MAX_PASSWORD_LENGTH + 1, classes)
+
 
 if __name__ == '__main__':
     unittest.main()